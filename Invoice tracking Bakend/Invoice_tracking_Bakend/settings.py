@@ -247,14 +247,42 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'invoice.tasks.send_automated_reminders',
         'schedule': crontab(hour=9, minute=0),  # Daily at 9 AM
     },
-    'run-workflow-automation': {
-        'task': 'invoice.tasks.run_workflow_automation',
-        'schedule': crontab(minute='*/15'),  # Every 15 minutes
+    'dispatch-workflow-outbox': {
+        'task': 'invoice.tasks.dispatch_workflow_outbox',
+        'schedule': crontab(),  # Every minute; saves also trigger a dispatch on commit
+    },
+    'fire-workflow-timers': {
+        'task': 'invoice.tasks.fire_workflow_timers',
+        'schedule': crontab(),  # Every minute, due timers only
+    },
+    'deliver-queued-emails': {
+        'task': 'notifications.tasks.deliver_queued_emails',
+        'schedule': crontab(),  # Every minute; queueing also schedules a delivery on commit
     },
     'generate-predictive-insights': {
         'task': 'invoice.tasks.generate_predictive_insights',
         'schedule': crontab(hour=6, minute=0),  # Daily at 6 AM
     },
+    'predict-payment-delays': {
+        'task': 'ai_system.tasks.bulk_predict_payment_delay',
+        'schedule': crontab(hour=1, minute=30),  # Nightly, all open invoices
+    },
+    'rescore-invoice-priorities': {
+        'task': 'ai_system.tasks.rescore_invoice_priorities',
+        'schedule': crontab(hour=0, minute=30),  # Nightly, before the working day starts
+    },
+    'score-invoice-anomalies': {
+        'task': 'ai_system.tasks.score_invoice_anomalies',
+        'schedule': crontab(minute=20),  # Hourly, new invoices only
+    },
+    'sweep-invoice-anomalies': {
+        'task': 'ai_system.tasks.detect_anomalies',
+        'schedule': crontab(hour=2, minute=30),  # Nightly, resumes from its checkpoint
+    },
+    'train-ai-models': {
+        'task': 'ai_system.tasks.train_models',
+        'schedule': crontab(hour=3, minute=0, day_of_week=0),  # Weekly on Sunday at 3 AM
+    },
     'cleanup-old-data': {
         'task': 'invoice.tasks.cleanup_old_data',
         'schedule': crontab(hour=2, minute=0, day_of_week=0),  # Weekly on Sunday at 2 AM
@@ -294,6 +322,7 @@ AI_SETTINGS = {
     'ANOMALY_THRESHOLD': env.int('AI_ANOMALY_THRESHOLD', 70),
     'AUTO_APPROVAL_THRESHOLD': env.float('AI_AUTO_APPROVAL_THRESHOLD', 1000.0),
     'MODEL_UPDATE_INTERVAL': env.int('AI_MODEL_UPDATE_INTERVAL', 7),  # days
+    'MODEL_RELOAD_INTERVAL': env.int('AI_MODEL_RELOAD_INTERVAL', 60),  # seconds between artifact checks
 }
 
 # Security Configuration
@@ -312,6 +341,8 @@ NOTIFICATION_SETTINGS = {
     'PUSH_ENABLED': env.bool('NOTIFICATIONS_PUSH_ENABLED', True),
     'REMINDER_DAYS_BEFORE': env.list('REMINDER_DAYS_BEFORE', default=[7, 3, 1]),
     'MAX_NOTIFICATIONS_PER_USER': env.int('MAX_NOTIFICATIONS_PER_USER', 100),
+    'EMAIL_BATCH_SIZE': env.int('NOTIFICATIONS_EMAIL_BATCH_SIZE', 100),  # messages per SMTP connection
+    'EMAIL_RATE_LIMIT': env.float('NOTIFICATIONS_EMAIL_RATE_LIMIT', 10.0),  # messages per second, 0 = no limit
 }
 
 # Performance Configuration
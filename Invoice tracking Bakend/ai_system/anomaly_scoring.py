@@ -0,0 +1,97 @@
+"""
+Batch IsolationForest anomaly scoring.
+
+Every invoice is described by five columns of its stored feature vector
+(feature_store.ANOMALY_COLUMNS): its amount as a z-score within its vendor's
+history, days from invoice date to due date, weekday of the invoice date,
+tax / subtotal ratio and line-item count. Batch jobs read them per chunk from the
+feature store instead of recomputing them.
+
+The fitted StandardScaler + IsolationForest pipeline lives in the model registry
+(trained by training.fit_anomaly_model). Scores are the IsolationForest anomaly
+score scaled to 0..100: around 50 and below is ordinary, values near 100 are
+isolated after very few splits.
+"""
+import logging
+import time
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+from invoice.models import Invoice
+from .feature_store import ANOMALY_COLUMNS, anomaly_matrix, iter_feature_matrix
+from .model_registry import ANOMALY_MODEL, model_registry
+from .models import AIProcessingResult
+
+logger = logging.getLogger(__name__)
+
+FEATURE_NAMES = ANOMALY_COLUMNS
+DEFAULT_CHUNK_SIZE = 5000
+
+
+def iter_anomaly_features(queryset=None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Tuple[list, np.ndarray]]:
+    """Yield (invoice_ids, feature_matrix) per pk-ordered chunk."""
+    for ids, matrix in iter_feature_matrix(queryset, chunk_size):
+        yield ids, anomaly_matrix(matrix)
+
+
+def to_anomaly_scores(model, features: np.ndarray) -> np.ndarray:
+    """IsolationForest anomaly score s in (0, 1] (score_samples is -s), scaled to 0..100."""
+    return np.round(-model.score_samples(features) * 100, 2)
+
+
+def score_vector(features: np.ndarray) -> Optional[float]:
+    """Score one stored feature vector with the current model; None until a model has been fitted."""
+    loaded = model_registry.get(ANOMALY_MODEL)
+    if loaded is None:
+        return None
+    return float(to_anomaly_scores(loaded.model, anomaly_matrix(features[None, :]))[0])
+
+
+def score_invoice_anomalies(queryset=None, chunk_size: int = DEFAULT_CHUNK_SIZE, only_new: bool = True) -> Dict[str, Any]:
+    """
+    Score invoices in bulk and store AIProcessingResult.anomaly_score.
+    With only_new, invoices that already have an anomaly score are skipped.
+    """
+    loaded = model_registry.get(ANOMALY_MODEL)
+    if loaded is None:
+        return {'scored': 0, 'model_version': None, 'score_seconds': 0.0}
+
+    queryset = Invoice.objects.all() if queryset is None else queryset
+    if only_new:
+        queryset = queryset.exclude(ai_results__anomaly_score__isnull=False)
+
+    started = time.monotonic()
+    scored = 0
+    for ids, features in iter_anomaly_features(queryset, chunk_size):
+        scores = dict(zip(ids, to_anomaly_scores(loaded.model, features)))
+        _store_scores(scores, f"{ANOMALY_MODEL}@{loaded.version}")
+        scored += len(ids)
+
+    report = {
+        'scored': scored,
+        'model_version': loaded.version,
+        'score_seconds': round(time.monotonic() - started, 2),
+    }
+    logger.info(f"Scored {scored} invoices for anomalies in {report['score_seconds']}s")
+    return report
+
+
+def _store_scores(scores: Dict[int, float], model_label: str):
+    """Update each invoice's latest AIProcessingResult, creating one where none exists."""
+    latest = {}
+    for result_id, invoice_id in (AIProcessingResult.objects.filter(invoice_id__in=scores)
+                                  .order_by('invoice_id', 'id').values_list('id', 'invoice_id')):
+        latest[invoice_id] = result_id
+
+    AIProcessingResult.objects.bulk_update(
+        [AIProcessingResult(id=result_id, anomaly_score=float(scores[invoice_id]))
+         for invoice_id, result_id in latest.items()],
+        ['anomaly_score'],
+        batch_size=1000,
+    )
+    AIProcessingResult.objects.bulk_create(
+        [AIProcessingResult(invoice_id=invoice_id, anomaly_score=float(score), ai_model_version=model_label)
+         for invoice_id, score in scores.items() if invoice_id not in latest],
+        batch_size=1000,
+    )
@@ -0,0 +1,199 @@
+"""
+Resumable periodic anomaly sweep.
+
+The sweep walks the invoice table by primary key in chunks. For each chunk it
+  - joins the chunk's duplicate blocking keys against the index (two queries) and
+    reports each pair once, on the newer invoice
+  - flags open invoices above 3x the corpus average amount (the threshold is fixed
+    when a sweep starts, so a resumed sweep keeps using it)
+and merges the findings into each invoice's latest AIProcessingResult with bulk
+writes. Sweep findings are tagged with source=SWEEP_SOURCE and replaced on every
+pass, so re-processing a chunk after a crash or restart is harmless.
+
+The cursor is checkpointed in the cache after every chunk. run_sweep stops when
+its time budget is used up and the next call continues from the checkpoint; the
+checkpoint is cleared when the sweep reaches the end of the table.
+"""
+import logging
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Avg, Q
+from django.utils import timezone
+
+from invoice.models import Invoice
+from .duplicates import _sweep_block
+from .models import AIProcessingResult, DuplicateBlockingKey
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_KEY = 'ai_system:anomaly_sweep:checkpoint'
+LOCK_KEY = 'ai_system:anomaly_sweep:lock'
+CHECKPOINT_TIMEOUT = 7 * 24 * 3600
+SWEEP_SOURCE = 'periodic_sweep'
+HIGH_AMOUNT_FACTOR = 3
+HIGH_AMOUNT_STATUSES = (
+    Invoice.Status.PENDING_REVIEW, Invoice.Status.PENDING_APPROVAL, Invoice.Status.APPROVED,
+)
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def get_checkpoint() -> Optional[Dict[str, Any]]:
+    return cache.get(CHECKPOINT_KEY)
+
+
+def reset_checkpoint():
+    cache.delete(CHECKPOINT_KEY)
+
+
+def _start_checkpoint() -> Dict[str, Any]:
+    average = Invoice.objects.aggregate(avg=Avg('total_amount'))['avg'] or 0
+    return {
+        'cursor': 0,
+        'high_amount_threshold': float(average) * HIGH_AMOUNT_FACTOR,
+        'started_at': timezone.now().isoformat(),
+        'scanned': 0,
+        'findings': 0,
+    }
+
+
+def _duplicate_findings(invoice_ids: List[int]) -> Dict[int, List[dict]]:
+    """Duplicates of the chunk's invoices among invoices with a lower id."""
+    chunk_keys = list(
+        DuplicateBlockingKey.objects.filter(invoice_id__in=invoice_ids)
+        .values_list('vendor_key', 'invoice_id', 'number_key', 'amount', 'invoice_date',
+                     'amount_bucket', 'date_bucket')
+    )
+    if not chunk_keys:
+        return {}
+
+    vendors = {row[0] for row in chunk_keys}
+    numbers = {row[2] for row in chunk_keys if row[2]}
+    amount_buckets = {row[5] + delta for row in chunk_keys for delta in (-1, 0, 1)}
+    date_buckets = {row[6] + delta for row in chunk_keys if row[6] is not None for delta in (-1, 0, 1)}
+    candidates = (
+        DuplicateBlockingKey.objects
+        .filter(vendor_key__in=vendors, invoice_id__lt=max(invoice_ids))
+        .exclude(invoice_id__in=invoice_ids)
+        .filter(Q(number_key__in=numbers) | Q(amount_bucket__in=amount_buckets, date_bucket__in=date_buckets))
+        .values_list('vendor_key', 'invoice_id', 'number_key', 'amount', 'invoice_date',
+                     'amount_bucket', 'date_bucket')
+    )
+
+    blocks = defaultdict(list)
+    for vendor_key, *row in sorted([*chunk_keys, *candidates], key=lambda r: (r[0], r[1])):
+        blocks[vendor_key].append(row)
+
+    in_chunk = set(invoice_ids)
+    findings = defaultdict(list)
+    for rows in blocks.values():
+        for pair in _sweep_block(rows):
+            if pair['invoice_id'] not in in_chunk:
+                continue
+            findings[pair['invoice_id']].append({
+                'type': 'duplicate_invoice',
+                'description': f"Possible duplicate of invoice {pair['duplicate_of']}",
+                'severity': 'high',
+                'duplicate_of': pair['duplicate_of'],
+                'reason': pair['reason'],
+                'source': SWEEP_SOURCE,
+            })
+    return findings
+
+
+def _high_amount_findings(rows, threshold: float) -> Dict[int, List[dict]]:
+    findings = {}
+    for invoice_id, amount, status in rows:
+        if threshold and amount is not None and float(amount) > threshold and status in HIGH_AMOUNT_STATUSES:
+            findings[invoice_id] = [{
+                'type': 'high_amount',
+                'description': f'Amount {float(amount):.2f} is above {HIGH_AMOUNT_FACTOR}x the average invoice',
+                'severity': 'medium',
+                'total_amount': float(amount),
+                'threshold': threshold,
+                'source': SWEEP_SOURCE,
+            }]
+    return findings
+
+
+def _store_findings(invoice_ids: List[int], findings: Dict[int, List[dict]]):
+    """Replace sweep findings on each invoice's latest result; create results only where something was found."""
+    latest = {}
+    for result_id, invoice_id, detected in (AIProcessingResult.objects.filter(invoice_id__in=invoice_ids)
+                                            .order_by('invoice_id', 'id')
+                                            .values_list('id', 'invoice_id', 'anomalies_detected')):
+        latest[invoice_id] = (result_id, detected or [])
+
+    updates = []
+    for invoice_id, (result_id, detected) in latest.items():
+        kept = [a for a in detected if not (isinstance(a, dict) and a.get('source') == SWEEP_SOURCE)]
+        merged = kept + findings.get(invoice_id, [])
+        if merged != detected:
+            updates.append(AIProcessingResult(id=result_id, anomalies_detected=merged))
+    AIProcessingResult.objects.bulk_update(updates, ['anomalies_detected'], batch_size=1000)
+    AIProcessingResult.objects.bulk_create(
+        [AIProcessingResult(invoice_id=invoice_id, anomalies_detected=found, processing_status='completed')
+         for invoice_id, found in findings.items() if invoice_id not in latest],
+        batch_size=1000,
+    )
+
+
+def sweep_chunk(checkpoint: Dict[str, Any], chunk_size: int = DEFAULT_CHUNK_SIZE) -> bool:
+    """Process the chunk after checkpoint['cursor'] and advance it; False once the table is exhausted."""
+    rows = list(
+        Invoice.objects.filter(id__gt=checkpoint['cursor']).order_by('id')
+        .values_list('id', 'total_amount', 'status')[:chunk_size]
+    )
+    if not rows:
+        return False
+    invoice_ids = [row[0] for row in rows]
+
+    findings = defaultdict(list)
+    for source in (_duplicate_findings(invoice_ids),
+                   _high_amount_findings(rows, checkpoint['high_amount_threshold'])):
+        for invoice_id, found in source.items():
+            findings[invoice_id].extend(found)
+
+    with transaction.atomic():
+        _store_findings(invoice_ids, findings)
+
+    checkpoint['cursor'] = invoice_ids[-1]
+    checkpoint['scanned'] += len(invoice_ids)
+    checkpoint['findings'] += sum(len(found) for found in findings.values())
+    cache.set(CHECKPOINT_KEY, checkpoint, CHECKPOINT_TIMEOUT)
+    return True
+
+
+def run_sweep(chunk_size: int = DEFAULT_CHUNK_SIZE, max_seconds: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Continue (or start) the sweep until the table is done or max_seconds have passed.
+    Returns the checkpoint with 'complete' telling whether the sweep finished.
+    """
+    started = time.monotonic()
+    checkpoint = get_checkpoint() or _start_checkpoint()
+    complete = False
+    while True:
+        if not sweep_chunk(checkpoint, chunk_size):
+            complete = True
+            break
+        if max_seconds is not None and time.monotonic() - started >= max_seconds:
+            break
+
+    if complete:
+        reset_checkpoint()
+        logger.info(f"Anomaly sweep completed: {checkpoint['scanned']} invoices, {checkpoint['findings']} findings")
+    else:
+        logger.info(f"Anomaly sweep paused at invoice {checkpoint['cursor']}")
+    return {**checkpoint, 'complete': complete}
+
+
+def acquire_lock(timeout: int) -> bool:
+    """Only one sweep runs at a time; the lock expires on its own if a worker dies."""
+    return cache.add(LOCK_KEY, timezone.now().isoformat(), timeout)
+
+
+def release_lock():
+    cache.delete(LOCK_KEY)
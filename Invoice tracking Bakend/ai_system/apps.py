@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AiSystemConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "ai_system"
+
+    def ready(self):
+        # Keeps VendorProfile in sync with invoice saves
+        import ai_system.signals  # noqa: F401
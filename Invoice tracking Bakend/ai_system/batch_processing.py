@@ -0,0 +1,105 @@
+"""
+Chunked bulk AI processing.
+
+start_batch() records an AIProcessingBatch and dispatches one task per chunk of
+invoice ids as a single group, so a request for 10k invoices is a few dozen
+broker messages rather than 10k. Each chunk loads its invoices, feature vectors,
+vendor profiles, services and approvers once (SharedLookups) and runs the
+sequential pipeline for each invoice with them; an invoice's InvoiceHistory rows
+are buffered and written with one INSERT in the transaction that stores its
+results, so a failed invoice leaves none behind. After the chunk it adds its
+completed/failed counts to the batch with one F() update and broadcasts an
+"ai_batch_progress" event, so progress is reported per chunk, not per invoice.
+"""
+import logging
+from typing import Dict, List, Optional, Sequence
+
+from asgiref.sync import async_to_sync
+from celery import group
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from invoice.history import recording_history
+from invoice.models import Invoice
+from invoice.service import SharedLookups, workflow_service
+from invoice.unit_of_work import InvoiceUnitOfWork
+from .models import AIProcessingBatch, AIProcessingResult
+from .pipeline import begin_run, complete_run
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 100
+
+
+def start_batch(invoice_ids: Sequence[int], created_by=None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> AIProcessingBatch:
+    invoice_ids = sorted(set(invoice_ids))
+    batch = AIProcessingBatch.objects.create(
+        total=len(invoice_ids), chunk_size=chunk_size, created_by=created_by,
+        # No chunk will run to finish an empty batch
+        finished_at=None if invoice_ids else timezone.now(),
+    )
+
+    from .tasks import process_ai_batch_chunk
+    chunks = group(
+        process_ai_batch_chunk.si(str(batch.id), invoice_ids[start:start + chunk_size])
+        for start in range(0, len(invoice_ids), chunk_size)
+    )
+    # Workers must see the batch row
+    transaction.on_commit(chunks.apply_async)
+    return batch
+
+
+def process_chunk(batch_id: str, invoice_ids: List[int]) -> Dict[str, int]:
+    invoices = list(Invoice.objects.filter(id__in=invoice_ids).order_by('id'))
+    lookups = SharedLookups.load(invoices)
+    completed = failed = 0
+    for invoice in invoices:
+        with recording_history() as history:
+            try:
+                ai_result = begin_run(invoice, 'sequential')
+                unit_of_work = InvoiceUnitOfWork(invoice)
+                processing_result = workflow_service.process_new_invoice(invoice, unit_of_work, lookups)
+                if processing_result.get('overall_status') == 'failed':
+                    raise RuntimeError(processing_result.get('error', 'AI processing failed'))
+                complete_run(ai_result, unit_of_work, processing_result, history)
+                completed += 1
+            except Exception as e:
+                logger.error(f"Batch {batch_id}: AI processing failed for invoice {invoice.id}: {e}")
+                history.discard()
+                AIProcessingResult.objects.filter(invoice_id=invoice.id, processing_status='running').update(
+                    processing_status='failed', error_message=str(e)
+                )
+                failed += 1
+
+    # Ids that no longer exist count as failed so the batch still finishes
+    failed += len(set(invoice_ids)) - len(invoices)
+    record_progress(batch_id, completed, failed)
+    return {'completed': completed, 'failed': failed}
+
+
+def record_progress(batch_id: str, completed: int, failed: int) -> Optional[AIProcessingBatch]:
+    AIProcessingBatch.objects.filter(id=batch_id).update(
+        completed=F('completed') + completed, failed=F('failed') + failed,
+    )
+    batch = AIProcessingBatch.objects.filter(id=batch_id).first()
+    if batch is None:
+        return None
+    if batch.finished_at is None and batch.processed >= batch.total:
+        # Only the chunk that finishes the batch stamps it
+        if AIProcessingBatch.objects.filter(id=batch_id, finished_at__isnull=True).update(finished_at=timezone.now()):
+            batch.refresh_from_db(fields=['finished_at'])
+    _broadcast_progress(batch)
+    return batch
+
+
+def _broadcast_progress(batch: AIProcessingBatch):
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        return
+    async_to_sync(channel_layer.group_send)("invoice_updates", {
+        "type": "ai_batch_progress",
+        "batch": batch.progress(),
+        "timestamp": timezone.now().isoformat(),
+    })
@@ -0,0 +1,147 @@
+"""
+Set-based scoring of many invoices at once.
+
+Instead of building one feature dict per invoice (with its own vendor lookups) and
+calling the model on a one-row list, each chunk's precomputed feature vectors are
+read from the feature store in one query, the model's columns are sliced out with
+NumPy and the model is called once per chunk. Results are written back with
+bulk_update.
+
+Priorities are rescored the same way every night, since the due-date component
+changes as invoices age. Only AI-derived priorities are rescored (those set by a
+workflow rule or by hand are left alone), only changed rows are written, and
+listeners get one coalesced WebSocket event per affected service instead of one
+per invoice.
+"""
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.utils import timezone
+
+from invoice.models import Invoice
+from .feature_store import COL, iter_feature_matrix, load_matrix, payment_delay_matrix, priority_scores
+from .model_registry import PAYMENT_DELAY_MODEL, model_registry
+
+logger = logging.getLogger(__name__)
+
+CLOSED_STATUSES = (
+    Invoice.Status.PAID, Invoice.Status.REJECTED, Invoice.Status.CANCELLED, Invoice.Status.ARCHIVED,
+)
+DEFAULT_CHUNK_SIZE = 5000
+# Same cut-offs as PredictiveAnalyticsService._score_to_priority
+PRIORITY_THRESHOLDS = ((80, Invoice.Priority.CRITICAL), (60, Invoice.Priority.HIGH), (40, Invoice.Priority.MEDIUM))
+BROADCAST_ID_LIMIT = 1000
+
+
+def open_invoices():
+    return Invoice.objects.exclude(status__in=CLOSED_STATUSES)
+
+
+def iter_payment_delay_scores(queryset=None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Yield (invoice_ids, delay_probabilities) per chunk, walking the queryset by primary key."""
+    queryset = open_invoices() if queryset is None else queryset
+    loaded = model_registry.get(PAYMENT_DELAY_MODEL)
+    for ids, matrix in iter_feature_matrix(queryset, chunk_size):
+        features = payment_delay_matrix(matrix)
+        if loaded is not None:
+            probabilities = loaded.model.predict_proba(features)[:, 1]
+        else:
+            # Same fallback as the single-invoice path: the vendor's late rate
+            probabilities = 1 - matrix[:, COL['vendor_on_time_rate']].astype(float)
+        yield np.asarray(ids), probabilities
+
+
+def score_payment_delays(queryset=None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict:
+    """Score invoices (all open ones by default) and store Invoice.ai_delay_probability."""
+    scored = 0
+    for ids, probabilities in iter_payment_delay_scores(queryset, chunk_size):
+        Invoice.objects.bulk_update(
+            [Invoice(id=int(i), ai_delay_probability=float(p)) for i, p in zip(ids, probabilities)],
+            ['ai_delay_probability'],
+            batch_size=1000,
+        )
+        scored += len(ids)
+    loaded = model_registry.get(PAYMENT_DELAY_MODEL)
+    logger.info(f"Scored payment delay for {scored} invoices")
+    return {'scored': scored, 'model_version': loaded.version if loaded is not None else None}
+
+
+def priority_levels(scores: np.ndarray) -> np.ndarray:
+    """Vectorized _score_to_priority."""
+    return np.select(
+        [scores >= threshold for threshold, _ in PRIORITY_THRESHOLDS],
+        [str(level) for _, level in PRIORITY_THRESHOLDS],
+        default=str(Invoice.Priority.LOW),
+    )
+
+
+def rescore_priorities(queryset=None, chunk_size: int = DEFAULT_CHUNK_SIZE, now: Optional[datetime] = None,
+                       broadcast: bool = True) -> dict:
+    """
+    Recompute priority for invoices whose priority is AI-derived (all open ones by
+    default) and store the priorities and ai_priority_scores that changed. Returns
+    counts and the per-service summary of priority changes that was broadcast.
+    """
+    queryset = (open_invoices() if queryset is None else queryset).filter(priority_source=Invoice.PrioritySource.AI)
+    now = now or datetime.now()
+    changed_by_service: Dict[str, List[Tuple[int, str]]] = defaultdict(list)
+    scored = 0
+    last_id = 0
+    while True:
+        rows = list(
+            queryset.filter(id__gt=last_id).order_by('id')
+            .values_list('id', 'priority', 'ai_priority_score', 'current_service')[:chunk_size]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        ids, current, current_scores, services = zip(*rows)
+        scores = priority_scores(load_matrix(ids), now)
+        levels = priority_levels(scores)
+        # Stored 0..1 like the pipeline writes it
+        normalized = np.round(scores / 100, 6)
+        stored = np.array([np.nan if score is None else score for score in current_scores], dtype=float)
+        level_changed = levels != np.asarray(current, dtype=object)
+        changed = np.flatnonzero(level_changed)
+        written = np.flatnonzero(level_changed | ~np.isclose(normalized, stored))
+        Invoice.objects.bulk_update(
+            [Invoice(id=ids[i], priority=str(levels[i]), ai_priority_score=float(normalized[i])) for i in written],
+            ['priority', 'ai_priority_score'],
+            batch_size=1000,
+        )
+        for i in changed:
+            changed_by_service[services[i] or ''].append((ids[i], str(levels[i])))
+        scored += len(ids)
+
+    summary = {
+        service: {
+            'count': len(changes),
+            'by_priority': dict(Counter(level for _, level in changes)),
+            'invoice_ids': [invoice_id for invoice_id, _ in changes[:BROADCAST_ID_LIMIT]],
+        }
+        for service, changes in changed_by_service.items()
+    }
+    if broadcast:
+        _broadcast_priority_changes(summary)
+    updated = sum(item['count'] for item in summary.values())
+    logger.info(f"Rescored priority for {scored} invoices, {updated} changed")
+    return {'scored': scored, 'updated': updated, 'services': summary}
+
+
+def _broadcast_priority_changes(summary: Dict[str, dict]):
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        return
+    timestamp = timezone.now().isoformat()
+    for service, changes in summary.items():
+        async_to_sync(channel_layer.group_send)("invoice_updates", {
+            "type": "invoice_priorities_updated",
+            "service": service,
+            "changes": changes,
+            "timestamp": timestamp,
+        })
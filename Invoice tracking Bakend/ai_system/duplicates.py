@@ -0,0 +1,194 @@
+"""
+Duplicate-invoice candidate index built on blocking keys.
+
+Each invoice gets one DuplicateBlockingKey row holding its normalized vendor,
+normalized invoice number, a 5% log-scale amount bucket and a 30-day date bucket.
+Two invoices are duplicate candidates when they share a vendor and either have the
+same normalized number, or are within 5% in amount and 30 days in date.
+
+Ingest-time lookup probes the 3x3 neighbouring (amount, date) buckets plus the
+number key through the composite indexes. The full sweep streams the table ordered
+by vendor and hash-joins within each vendor block, so it is linear in the number of
+invoices instead of comparing every pair.
+"""
+import logging
+import math
+import re
+from collections import defaultdict
+from datetime import date
+from typing import Any, Dict, Iterator, List, Optional
+
+from django.db import transaction
+from django.db.models import Q
+
+from invoice.models import Invoice
+from .models import DuplicateBlockingKey
+from .vendor_profiles import normalize_vendor_key
+
+logger = logging.getLogger(__name__)
+
+AMOUNT_TOLERANCE = 0.05
+DATE_WINDOW_DAYS = 30
+NUMBER_PREFIXES = ('INVOICE', 'FACTURE', 'INV', 'FACT', 'NO', 'NUM', 'N')
+_LOG_STEP = math.log1p(AMOUNT_TOLERANCE)
+
+
+def normalize_invoice_number(number: str) -> str:
+    """'INV-00123', 'inv 123' and 'No. 123' all map to '123'."""
+    key = re.sub(r'[^0-9A-Z]', '', (number or '').upper())
+    for prefix in NUMBER_PREFIXES:
+        if key.startswith(prefix) and key[len(prefix):][:1].isdigit():
+            key = key[len(prefix):]
+            break
+    return key.lstrip('0') or key
+
+
+def amount_bucket(amount: float) -> int:
+    return math.floor(math.log(amount) / _LOG_STEP) if amount > 0 else -1
+
+
+def date_bucket(value: Optional[date]) -> Optional[int]:
+    return value.toordinal() // DATE_WINDOW_DAYS if value else None
+
+
+def blocking_key_for(invoice: Invoice) -> Optional[DuplicateBlockingKey]:
+    vendor_key = normalize_vendor_key(invoice.vendor_name)
+    if not vendor_key or invoice.total_amount is None:
+        return None
+    invoice_date = Invoice._meta.get_field('invoice_date').to_python(invoice.invoice_date)
+    amount = float(invoice.total_amount)
+    return DuplicateBlockingKey(
+        invoice_id=invoice.pk,
+        vendor_key=vendor_key,
+        number_key=normalize_invoice_number(invoice.number),
+        amount=amount,
+        amount_bucket=amount_bucket(amount),
+        invoice_date=invoice_date,
+        date_bucket=date_bucket(invoice_date),
+    )
+
+
+def index_invoice(invoice: Invoice):
+    """Insert or refresh the blocking key row for one invoice."""
+    key = blocking_key_for(invoice)
+    if key is None:
+        DuplicateBlockingKey.objects.filter(invoice_id=invoice.pk).delete()
+        return
+    DuplicateBlockingKey.objects.update_or_create(
+        invoice_id=invoice.pk,
+        defaults={
+            'vendor_key': key.vendor_key,
+            'number_key': key.number_key,
+            'amount': key.amount,
+            'amount_bucket': key.amount_bucket,
+            'invoice_date': key.invoice_date,
+            'date_bucket': key.date_bucket,
+        },
+    )
+
+
+def _is_near(a_amount, a_date, b_amount, b_date) -> bool:
+    if not a_date or not b_date or abs((a_date - b_date).days) > DATE_WINDOW_DAYS:
+        return False
+    low, high = sorted((a_amount, b_amount))
+    return high <= low * (1 + AMOUNT_TOLERANCE) if low > 0 else low == high
+
+
+def find_duplicate_candidates(vendor_name: str, amount: float, invoice_date: Optional[date],
+                              number: str = '', exclude_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Indexed candidate lookup for one (possibly unsaved) invoice."""
+    vendor_key = normalize_vendor_key(vendor_name)
+    if not vendor_key:
+        return []
+    number_key = normalize_invoice_number(number)
+
+    query = Q()
+    if invoice_date and amount:
+        a_bucket, d_bucket = amount_bucket(amount), date_bucket(invoice_date)
+        query |= Q(
+            amount_bucket__in=[a_bucket - 1, a_bucket, a_bucket + 1],
+            date_bucket__in=[d_bucket - 1, d_bucket, d_bucket + 1],
+        )
+    if number_key:
+        query |= Q(number_key=number_key)
+    if not query:
+        return []
+
+    rows = DuplicateBlockingKey.objects.filter(Q(vendor_key=vendor_key) & query)
+    if exclude_id:
+        rows = rows.exclude(invoice_id=exclude_id)
+
+    candidates = []
+    for invoice_id, other_number, other_amount, other_date in rows.values_list(
+            'invoice_id', 'number_key', 'amount', 'invoice_date'):
+        if number_key and other_number == number_key:
+            reason = 'same_number'
+        elif _is_near(amount, invoice_date, other_amount, other_date):
+            reason = 'similar_amount_and_date'
+        else:
+            continue
+        candidates.append({'invoice_id': invoice_id, 'reason': reason})
+    return candidates
+
+
+def _sweep_block(rows) -> Iterator[Dict[str, Any]]:
+    """Hash join one vendor's rows on number key and neighbouring (amount, date) buckets."""
+    by_number = defaultdict(list)
+    by_bucket = defaultdict(list)
+    for invoice_id, number_key, amount, invoice_date, a_bucket, d_bucket in rows:
+        if number_key:
+            for other_id in by_number[number_key]:
+                yield {'invoice_id': invoice_id, 'duplicate_of': other_id, 'reason': 'same_number'}
+            by_number[number_key].append(invoice_id)
+        if d_bucket is None:
+            continue
+        for da in (-1, 0, 1):
+            for dd in (-1, 0, 1):
+                for other_id, other_number, other_amount, other_date in by_bucket.get((a_bucket + da, d_bucket + dd), ()):
+                    if number_key and other_number == number_key:
+                        continue  # already reported as same_number
+                    if _is_near(amount, invoice_date, other_amount, other_date):
+                        yield {'invoice_id': invoice_id, 'duplicate_of': other_id, 'reason': 'similar_amount_and_date'}
+        by_bucket[(a_bucket, d_bucket)].append((invoice_id, number_key, amount, invoice_date))
+
+
+def sweep_duplicates(chunk_size: int = 5000) -> Iterator[Dict[str, Any]]:
+    """
+    Stream every duplicate pair in the corpus. Rows arrive ordered by vendor key, so
+    only one vendor block is held in memory at a time.
+    """
+    rows = (DuplicateBlockingKey.objects.order_by('vendor_key', 'invoice_id')
+            .values_list('vendor_key', 'invoice_id', 'number_key', 'amount', 'invoice_date',
+                         'amount_bucket', 'date_bucket')
+            .iterator(chunk_size=chunk_size))
+    current_vendor = None
+    block = []
+    for vendor_key, *row in rows:
+        if vendor_key != current_vendor and block:
+            for pair in _sweep_block(block):
+                yield {'vendor_key': current_vendor, **pair}
+            block = []
+        current_vendor = vendor_key
+        block.append(row)
+    if block:
+        for pair in _sweep_block(block):
+            yield {'vendor_key': current_vendor, **pair}
+
+
+def rebuild_duplicate_index(batch_size: int = 1000) -> int:
+    """Rebuild all blocking keys, walking invoices by primary key in batches."""
+    fields = ('id', 'vendor_name', 'number', 'total_amount', 'invoice_date')
+    DuplicateBlockingKey.objects.all().delete()
+    last_id = 0
+    indexed = 0
+    while True:
+        batch = list(Invoice.objects.filter(id__gt=last_id).order_by('id').only(*fields)[:batch_size])
+        if not batch:
+            break
+        last_id = batch[-1].id
+        keys = [key for key in (blocking_key_for(invoice) for invoice in batch) if key]
+        with transaction.atomic():
+            DuplicateBlockingKey.objects.bulk_create(keys)
+        indexed += len(keys)
+    logger.info(f"Indexed {indexed} invoices for duplicate detection")
+    return indexed
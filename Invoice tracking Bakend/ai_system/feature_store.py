@@ -0,0 +1,318 @@
+"""
+Precomputed per-invoice feature vectors shared by every scoring model.
+
+Each invoice has one InvoiceFeatures row holding a float32 vector laid out as
+FEATURES. Rows are computed when an invoice is created, recomputed when one of its
+inputs (or its line items) change, and read back as an (n, len(FEATURES)) NumPy
+matrix by batch jobs. The payment-delay, anomaly and priority models each take
+their own columns from that matrix (payment_delay_matrix, anomaly_matrix,
+priority_components), so feature logic lives in one place.
+
+Vendor aggregates are taken from VendorProfile with the invoice's own contribution
+left out, i.e. the vendor history as it looks from this invoice. Other invoices of
+the same vendor change the profile without touching this invoice's row, so the
+row also keeps its vendor key and its own contribution (own_counted, own_on_time),
+and load_matrix recomputes the vendor columns from the live profiles, read in the
+same query as the vectors.
+"""
+import logging
+from datetime import date, datetime
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+from django.db.models import Count, OuterRef, Subquery
+
+from invoice.models import Invoice, InvoiceLineItem
+from .models import InvoiceFeatures, VendorProfile
+from .vendor_profiles import normalize_vendor_key
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 2
+FEATURES = (
+    'amount',
+    'due_day',                # due date as days since 1970-01-01, NaN when unknown
+    'invoice_day',            # invoice date as days since 1970-01-01, NaN when unknown
+    'weekday',                # of the invoice date, Monday=0
+    'days_to_due',            # due date - invoice date, 30 when unknown
+    'tax_ratio',
+    'line_item_count',
+    'service_factor',
+    'service_priority',
+    'vendor_priority',
+    'vendor_history_count',
+    'vendor_mean_amount',
+    'vendor_amount_zscore',
+    'vendor_on_time_rate',
+    'own_counted',            # 1 when the invoice counts in its vendor profile
+    'own_on_time',            # 1 when it counts there as paid on time
+)
+VENDOR_STATS = ('invoice_count', 'mean_amount', 'm2_amount', 'paid_on_time_count')
+NO_PROFILE = (0, 0.0, 0.0, 0)
+COL = {name: index for index, name in enumerate(FEATURES)}
+INPUT_FIELDS = (
+    'vendor_name', 'total_amount', 'subtotal', 'tax_amount', 'invoice_date', 'due_date',
+    'current_service', 'status', 'payment_date',
+)
+
+PRIORITY_VENDORS = ('microsoft', 'google', 'amazon', 'oracle')
+SERVICE_PRIORITIES = {'finance': 15, 'accounting': 15, 'management': 20, 'purchasing': 10, 'hr': 5}
+PAYMENT_SERVICES = ('finance', 'accounting')
+_EPOCH = date(1970, 1, 1).toordinal()
+_EPOCH_DATETIME = datetime(1970, 1, 1)
+
+
+def vendor_priority(vendor_name: str) -> int:
+    name = (vendor_name or '').lower()
+    return 20 if any(vendor in name for vendor in PRIORITY_VENDORS) else 0
+
+
+def service_priority(service: str) -> int:
+    return SERVICE_PRIORITIES.get(service, 0)
+
+
+def _day(value) -> float:
+    if not value:
+        return np.nan
+    if not isinstance(value, date):
+        value = date.fromisoformat(str(value)[:10])
+    return float(value.toordinal() - _EPOCH)
+
+
+def _vendor_profiles(vendor_keys: Iterable[str]) -> Dict[str, Tuple[int, float, float, int]]:
+    return {
+        key: tuple(stats)
+        for key, *stats in VendorProfile.objects.filter(vendor_key__in=set(vendor_keys) - {''})
+        .values_list('vendor_key', *VENDOR_STATS)
+    }
+
+
+def _vendor_columns(matrix: np.ndarray, stats: Sequence[tuple], in_profile: bool = True):
+    """
+    Fill the vendor_* columns of a float64 matrix in place from per-row profile
+    stats (VENDOR_STATS), removing each invoice's own contribution when in_profile.
+    """
+    n = len(matrix)
+    amounts = matrix[:, COL['amount']]
+    counts, means, m2s, on_times = (np.zeros(n), np.zeros(n), np.zeros(n), np.zeros(n))
+    for i, (count, mean, m2, on_time) in enumerate(stats):
+        if in_profile and count and matrix[i, COL['own_counted']]:
+            # Welford removal
+            x = amounts[i]
+            if count > 1:
+                reduced = (count * mean - x) / (count - 1)
+                m2 = max(m2 - (x - mean) * (x - reduced), 0.0)
+                mean = reduced
+            else:
+                mean, m2 = 0.0, 0.0
+            count, on_time = count - 1, on_time - int(matrix[i, COL['own_on_time']])
+        counts[i], means[i], m2s[i], on_times[i] = count, mean, m2, on_time
+
+    stds = np.sqrt(np.divide(m2s, counts, out=np.zeros(n), where=counts > 0))
+    matrix[:, COL['vendor_history_count']] = counts
+    matrix[:, COL['vendor_mean_amount']] = means
+    matrix[:, COL['vendor_amount_zscore']] = np.divide(amounts - means, stds, out=np.zeros(n), where=stds > 0)
+    matrix[:, COL['vendor_on_time_rate']] = np.divide(on_times, counts, out=np.full(n, 0.5), where=counts > 0)
+
+
+def build_vectors(records: Sequence[dict], profiles: Dict[str, tuple], in_profile: bool = True) -> np.ndarray:
+    """
+    Feature matrix for invoice records (dicts with INPUT_FIELDS plus line_item_count).
+    `in_profile` says the invoices are already counted in their vendor profiles, in
+    which case their own contribution is removed first.
+    """
+    n = len(records)
+    matrix = np.empty((n, len(FEATURES)), dtype=np.float64)
+    amounts = np.array([float(r.get('total_amount') or 0) for r in records])
+    subtotals = np.array([float(r.get('subtotal') if r.get('subtotal') is not None else r.get('total_amount') or 0)
+                          for r in records])
+    taxes = np.array([float(r.get('tax_amount') or 0) for r in records])
+    invoice_days = np.array([_day(r.get('invoice_date')) for r in records])
+    due_days = np.array([_day(r.get('due_date')) for r in records])
+    services = [r.get('current_service') or '' for r in records]
+    payment_days = np.array([_day(r.get('payment_date')) for r in records])
+
+    matrix[:, COL['amount']] = amounts
+    matrix[:, COL['due_day']] = due_days
+    matrix[:, COL['invoice_day']] = invoice_days
+    matrix[:, COL['weekday']] = np.where(np.isnan(invoice_days), 0, (np.nan_to_num(invoice_days) + 3) % 7)
+    gap = due_days - invoice_days
+    matrix[:, COL['days_to_due']] = np.where(np.isnan(gap), 30, gap)
+    matrix[:, COL['tax_ratio']] = np.divide(taxes, subtotals, out=np.zeros(n), where=subtotals > 0)
+    matrix[:, COL['line_item_count']] = [r.get('line_item_count') or 0 for r in records]
+    matrix[:, COL['service_factor']] = [1.0 if s in PAYMENT_SERVICES else 0.5 for s in services]
+    matrix[:, COL['service_priority']] = [service_priority(s) for s in services]
+    matrix[:, COL['vendor_priority']] = [vendor_priority(r.get('vendor_name')) for r in records]
+    matrix[:, COL['own_counted']] = [bool(r.get('vendor_name')) and r.get('total_amount') is not None for r in records]
+    matrix[:, COL['own_on_time']] = (
+        np.array([r.get('status') == Invoice.Status.PAID for r in records], dtype=bool) & (payment_days <= due_days)
+    )
+    _vendor_columns(
+        matrix, [profiles.get(normalize_vendor_key(r.get('vendor_name')), NO_PROFILE) for r in records], in_profile,
+    )
+    return matrix.astype(np.float32)
+
+
+def vector_from_data(invoice_data: dict, profile: Optional[VendorProfile]) -> np.ndarray:
+    """Feature vector for an invoice dict (saved or not) and its already-loaded vendor profile."""
+    profiles = {}
+    if profile is not None:
+        profiles[profile.vendor_key] = (
+            profile.invoice_count, profile.mean_amount, profile.m2_amount, profile.paid_on_time_count,
+        )
+    return build_vectors([invoice_data], profiles, in_profile=bool(invoice_data.get('id')))[0]
+
+
+def compute_features(invoice_ids: Sequence[int]) -> Dict[int, Tuple[str, np.ndarray]]:
+    """Vendor key and feature vector of saved invoices, with three set-based queries."""
+    rows = list(Invoice.objects.filter(id__in=invoice_ids).values('id', *INPUT_FIELDS))
+    if not rows:
+        return {}
+    line_counts = dict(
+        InvoiceLineItem.objects.filter(invoice_id__in=[r['id'] for r in rows])
+        .values('invoice_id').annotate(count=Count('id')).values_list('invoice_id', 'count')
+    )
+    for row in rows:
+        row['line_item_count'] = line_counts.get(row['id'], 0)
+    keys = [normalize_vendor_key(r['vendor_name']) for r in rows]
+    matrix = build_vectors(rows, _vendor_profiles(keys))
+    return {row['id']: (keys[i], matrix[i]) for i, row in enumerate(rows)}
+
+
+def _store(features: Dict[int, Tuple[str, np.ndarray]]):
+    InvoiceFeatures.objects.bulk_create(
+        [InvoiceFeatures(invoice_id=invoice_id, vendor_key=vendor_key, vector=vector.astype('<f4').tobytes(),
+                         schema_version=SCHEMA_VERSION)
+         for invoice_id, (vendor_key, vector) in features.items()],
+        update_conflicts=True,
+        unique_fields=['invoice'],
+        update_fields=['vendor_key', 'vector', 'schema_version', 'updated_at'],
+        batch_size=1000,
+    )
+
+
+def refresh_features(invoice_ids: Sequence[int]) -> int:
+    """Recompute and upsert the stored vectors for these invoices."""
+    features = compute_features(invoice_ids)
+    _store(features)
+    return len(features)
+
+
+def _live_profile(stat: str) -> Subquery:
+    return Subquery(VendorProfile.objects.filter(vendor_key=OuterRef('vendor_key')).values(stat)[:1])
+
+
+def load_matrix(invoice_ids: Sequence[int]) -> np.ndarray:
+    """
+    Stored feature matrix for invoice_ids, in the given order, with the vendor
+    columns recomputed from the current vendor profiles. Invoices without a
+    current row are computed and stored on the way.
+    """
+    invoice_ids = list(invoice_ids)
+    rows = (InvoiceFeatures.objects.filter(invoice_id__in=invoice_ids, schema_version=SCHEMA_VERSION)
+            .annotate(**{f'profile_{stat}': _live_profile(stat) for stat in VENDOR_STATS})
+            .values_list('invoice_id', 'vector', *(f'profile_{stat}' for stat in VENDOR_STATS)))
+    stored, stats = {}, []
+    for invoice_id, blob, *profile in rows:
+        stored[invoice_id] = np.frombuffer(bytes(blob), dtype='<f4')
+        stats.append(NO_PROFILE if profile[0] is None else tuple(profile))
+    if stored:
+        overlaid = np.stack(list(stored.values())).astype(np.float64)
+        _vendor_columns(overlaid, stats)
+        stored = dict(zip(stored, overlaid.astype(np.float32)))
+    missing = [invoice_id for invoice_id in invoice_ids if invoice_id not in stored]
+    if missing:
+        computed = compute_features(missing)
+        _store(computed)
+        stored.update((invoice_id, vector) for invoice_id, (_, vector) in computed.items())
+    if not invoice_ids:
+        return np.empty((0, len(FEATURES)), dtype=np.float32)
+    return np.stack([stored[invoice_id] for invoice_id in invoice_ids]).astype(np.float32)
+
+
+def get_feature_vector(invoice_id: int) -> Optional[np.ndarray]:
+    try:
+        return load_matrix([invoice_id])[0]
+    except KeyError:  # no such invoice
+        return None
+
+
+def iter_feature_matrix(queryset=None, chunk_size: int = 5000):
+    """Yield (invoice_ids, feature_matrix) for a queryset, walking it by primary key."""
+    queryset = Invoice.objects.all() if queryset is None else queryset
+    last_id = 0
+    while True:
+        ids = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        last_id = ids[-1]
+        yield ids, load_matrix(ids)
+
+
+def rebuild_feature_store(chunk_size: int = 5000) -> int:
+    """Recompute every invoice's vector (e.g. after vendor profiles drift or FEATURES change)."""
+    rebuilt = 0
+    last_id = 0
+    while True:
+        ids = list(Invoice.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        last_id = ids[-1]
+        rebuilt += refresh_features(ids)
+    InvoiceFeatures.objects.exclude(schema_version=SCHEMA_VERSION).delete()
+    logger.info(f"Rebuilt feature vectors for {rebuilt} invoices")
+    return rebuilt
+
+
+# Model-specific views of the feature matrix
+
+def _days_from_now(day_column: np.ndarray, now: Optional[datetime]) -> np.ndarray:
+    """Whole days from `now` until each date, floored like timedelta.days."""
+    now_days = ((now or datetime.now()) - _EPOCH_DATETIME).total_seconds() / 86400
+    return np.floor(day_column - now_days)
+
+
+def payment_delay_matrix(matrix: np.ndarray, now: Optional[datetime] = None) -> np.ndarray:
+    """Capped amount / 10000, days until due (30 when unknown), vendor on-time rate, service factor."""
+    days_until_due = _days_from_now(matrix[:, COL['due_day']].astype(float), now)
+    return np.column_stack([
+        np.minimum(matrix[:, COL['amount']] / 10000, 10),
+        np.where(np.isnan(days_until_due), 30, np.maximum(days_until_due, 0)),
+        matrix[:, COL['vendor_on_time_rate']],
+        matrix[:, COL['service_factor']],
+    ]).astype(float)
+
+
+def payment_delay_training_matrix(matrix: np.ndarray) -> np.ndarray:
+    """Training view: days until due as known at receipt (from the invoice date)."""
+    features = payment_delay_matrix(matrix)
+    features[:, 1] = np.maximum(matrix[:, COL['days_to_due']], 0)
+    return features
+
+
+ANOMALY_COLUMNS = ['vendor_amount_zscore', 'days_to_due', 'weekday', 'tax_ratio', 'line_item_count']
+
+
+def anomaly_matrix(matrix: np.ndarray) -> np.ndarray:
+    return matrix[:, [COL[name] for name in ANOMALY_COLUMNS]].astype(float)
+
+
+PRIORITY_COMPONENTS = ['amount', 'due_date', 'vendor', 'service']
+
+
+def priority_components(matrix: np.ndarray, now: Optional[datetime] = None) -> np.ndarray:
+    """Points per PRIORITY_COMPONENTS for each invoice; their capped sum is the priority score."""
+    amounts = matrix[:, COL['amount']]
+    days_until_due = _days_from_now(matrix[:, COL['due_day']].astype(float), now)
+    with np.errstate(invalid='ignore'):
+        due_points = np.where(days_until_due <= 3, 40, np.where(days_until_due <= 7, 25, 0))
+    return np.column_stack([
+        np.where(amounts > 10000, 30, np.where(amounts > 5000, 20, 0)),
+        due_points,
+        matrix[:, COL['vendor_priority']],
+        matrix[:, COL['service_priority']],
+    ]).astype(float)
+
+
+def priority_scores(matrix: np.ndarray, now: Optional[datetime] = None) -> np.ndarray:
+    return np.minimum(priority_components(matrix, now).sum(axis=1), 100)
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.5 on 2026-10-19 03:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai_system", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="VendorProfile",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("vendor_key", models.CharField(max_length=255, unique=True)),
+                ("display_name", models.CharField(max_length=255)),
+                ("invoice_count", models.IntegerField(default=0)),
+                ("mean_amount", models.FloatField(default=0.0)),
+                ("m2_amount", models.FloatField(default=0.0)),
+                ("min_amount", models.FloatField(blank=True, null=True)),
+                ("max_amount", models.FloatField(blank=True, null=True)),
+                ("paid_count", models.IntegerField(default=0)),
+                ("paid_on_time_count", models.IntegerField(default=0)),
+                ("last_seen", models.DateField(blank=True, null=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
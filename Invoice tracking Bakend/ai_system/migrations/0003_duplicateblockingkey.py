@@ -0,0 +1,54 @@
+# Generated by Django 5.2.5 on 2026-10-19 03:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai_system", "0002_vendorprofile"),
+        ("invoice", "0005_invoice_ai_priority_score_invoice_ai_risk_score_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DuplicateBlockingKey",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("vendor_key", models.CharField(max_length=255)),
+                ("number_key", models.CharField(blank=True, max_length=100)),
+                ("amount", models.FloatField()),
+                ("amount_bucket", models.IntegerField()),
+                ("invoice_date", models.DateField(blank=True, null=True)),
+                ("date_bucket", models.IntegerField(blank=True, null=True)),
+                (
+                    "invoice",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="blocking_key",
+                        to="invoice.invoice",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["vendor_key", "amount_bucket", "date_bucket"],
+                        name="dup_block_amount_date_idx",
+                    ),
+                    models.Index(
+                        fields=["vendor_key", "number_key"], name="dup_block_number_idx"
+                    ),
+                ],
+            },
+        ),
+    ]
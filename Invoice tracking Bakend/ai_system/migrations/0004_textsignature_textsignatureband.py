@@ -0,0 +1,71 @@
+# Generated by Django 5.2.5 on 2026-10-19 03:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai_system", "0003_duplicateblockingkey"),
+        ("invoice", "0005_invoice_ai_priority_score_invoice_ai_risk_score_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TextSignature",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("signature", models.BinaryField()),
+                ("shingle_count", models.IntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "invoice",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="text_signature",
+                        to="invoice.invoice",
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="TextSignatureBand",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("band", models.SmallIntegerField()),
+                ("bucket", models.BigIntegerField()),
+                (
+                    "invoice",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="text_signature_bands",
+                        to="invoice.invoice",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["band", "bucket"], name="text_sig_band_bucket_idx"
+                    )
+                ],
+            },
+        ),
+    ]
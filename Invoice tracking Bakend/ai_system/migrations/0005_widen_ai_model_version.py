@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-19 03:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai_system", "0004_textsignature_textsignatureband"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="aiprocessingresult",
+            name="ai_model_version",
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
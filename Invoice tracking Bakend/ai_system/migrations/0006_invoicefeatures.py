@@ -0,0 +1,40 @@
+# Generated by Django 5.2.5 on 2026-10-19 03:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai_system", "0005_widen_ai_model_version"),
+        ("invoice", "0006_invoice_ai_delay_probability"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="InvoiceFeatures",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("vector", models.BinaryField()),
+                ("schema_version", models.SmallIntegerField(default=1)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "invoice",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="features",
+                        to="invoice.invoice",
+                    ),
+                ),
+            ],
+        ),
+    ]
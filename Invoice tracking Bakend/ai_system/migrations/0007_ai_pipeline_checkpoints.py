@@ -0,0 +1,32 @@
+# Generated by Django 5.2.5 on 2026-10-19 04:11
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai_system", "0006_invoicefeatures"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="aiprocessingresult",
+            name="pipeline_mode",
+            field=models.CharField(
+                blank=True,
+                choices=[("sequential", "Sequential"), ("canvas", "Canvas")],
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="aiprocessingresult",
+            name="stage_outputs",
+            field=models.JSONField(
+                blank=True,
+                default=dict,
+                encoder=django.core.serializers.json.DjangoJSONEncoder,
+            ),
+        ),
+    ]
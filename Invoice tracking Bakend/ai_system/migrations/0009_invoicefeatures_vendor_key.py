@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-19 04:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai_system", "0008_aiprocessingbatch"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="invoicefeatures",
+            name="vendor_key",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
@@ -0,0 +1,126 @@
+"""
+Process-wide registry of trained ML models.
+
+Artifacts live under ml_models/<name>/<version>.joblib, where versions sort
+lexically (training writes UTC timestamps). Each model is loaded once per process,
+memory-mapped so forked workers share the arrays' pages, and swapped for a newer
+artifact when one appears. Directory checks are throttled to one scandir per model
+every MODEL_RELOAD_INTERVAL seconds, so a lookup on the request path is normally a
+dict read. Nothing here trains: a model without an artifact is simply unavailable.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+import joblib
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_SUFFIX = '.joblib'
+PAYMENT_DELAY_MODEL = 'payment_delay'
+ANOMALY_MODEL = 'invoice_anomaly'
+
+
+@dataclass(frozen=True)
+class LoadedModel:
+    name: str
+    version: str
+    model: Any
+    path: str
+
+
+class ModelRegistry:
+    def __init__(self, root: str, reload_interval: float = 60):
+        self.root = root
+        self.reload_interval = reload_interval
+        self._models: Dict[str, LoadedModel] = {}
+        self._checked_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _model_dir(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def latest_version(self, name: str) -> Optional[str]:
+        try:
+            versions = [
+                entry.name[:-len(ARTIFACT_SUFFIX)]
+                for entry in os.scandir(self._model_dir(name))
+                if entry.is_file() and entry.name.endswith(ARTIFACT_SUFFIX)
+            ]
+        except FileNotFoundError:
+            return None
+        return max(versions) if versions else None
+
+    def get(self, name: str) -> Optional[LoadedModel]:
+        """The newest loaded model for `name`, or None when no artifact exists."""
+        loaded = self._models.get(name)
+        now = time.monotonic()
+        if name in self._checked_at and now - self._checked_at[name] < self.reload_interval:
+            return loaded
+
+        with self._lock:
+            loaded = self._models.get(name)
+            if name in self._checked_at and now - self._checked_at[name] < self.reload_interval:
+                return loaded
+            self._checked_at[name] = now
+            version = self.latest_version(name)
+            if version is None or (loaded is not None and loaded.version == version):
+                return loaded
+            path = os.path.join(self._model_dir(name), version + ARTIFACT_SUFFIX)
+            try:
+                model = joblib.load(path, mmap_mode='r')
+            except Exception as e:
+                logger.error(f"Failed to load model {name} version {version}: {e}")
+                return loaded
+            loaded = LoadedModel(name=name, version=version, model=model, path=path)
+            self._models[name] = loaded
+            logger.info(f"Loaded model {name} version {version}")
+            return loaded
+
+    def publish(self, name: str, model: Any, version: Optional[str] = None,
+                report: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Write a new artifact atomically (temp file + rename) and return its version.
+        Saved uncompressed so that loading can memory-map the numpy arrays. A training
+        report, if given, is stored next to it as <version>.json.
+        """
+        version = version or timezone.now().strftime('%Y%m%dT%H%M%S')
+        directory = self._model_dir(name)
+        os.makedirs(directory, exist_ok=True)
+        if report is not None:
+            report['version'] = version
+            with open(os.path.join(directory, f"{version}.json"), 'w') as handle:
+                json.dump(report, handle, indent=2)
+        path = os.path.join(directory, version + ARTIFACT_SUFFIX)
+        tmp_path = f"{path}.tmp"
+        joblib.dump(model, tmp_path)
+        os.replace(tmp_path, path)
+        # Make the next get() look at the directory immediately
+        self._checked_at.pop(name, None)
+        return version
+
+    def versions(self) -> Dict[str, str]:
+        return {name: loaded.version for name, loaded in self._models.items()}
+
+    def version_label(self, *names: str) -> str:
+        """'name@version' pairs for AIProcessingResult.ai_model_version."""
+        versions = self.versions()
+        names = names or sorted(versions)
+        return ','.join(f"{name}@{versions.get(name, 'none')}" for name in names)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._checked_at.clear()
+
+
+model_registry = ModelRegistry(
+    os.path.join(settings.BASE_DIR, 'ml_models'),
+    reload_interval=settings.AI_SETTINGS.get('MODEL_RELOAD_INTERVAL', 60),
+)
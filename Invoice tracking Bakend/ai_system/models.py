@@ -1,8 +1,11 @@
 from django.db import models
 
 # Create your models here
+import uuid
+
 from django.db import models
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from invoice.models import Invoice
 
 class AIProcessingResult(models.Model):
@@ -12,6 +15,10 @@ class AIProcessingResult(models.Model):
         ('completed', 'Completed'),
         ('failed', 'Failed'),
     ]
+    PIPELINE_MODE_CHOICES = [
+        ('sequential', 'Sequential'),
+        ('canvas', 'Canvas'),
+    ]
 
     invoice = models.ForeignKey(Invoice, on_delete=models.CASCADE, related_name='ai_results')
     ocr_text = models.TextField(blank=True, null=True)
@@ -25,10 +32,13 @@ class AIProcessingResult(models.Model):
     processing_started_at = models.DateTimeField(null=True, blank=True)
     processing_completed_at = models.DateTimeField(null=True, blank=True)
     processing_time_ms = models.IntegerField(null=True, blank=True)
-    ai_model_version = models.CharField(max_length=50, blank=True, null=True)
+    ai_model_version = models.CharField(max_length=255, blank=True, null=True)  # 'name@version,...' of loaded models
     error_message = models.TextField(blank=True, null=True)
     ai_recommendations = models.JSONField(blank=True, null=True)
     suggested_actions = models.JSONField(blank=True, null=True)
+    # Canvas pipeline checkpoints: {stage: {'output': ..., 'duration_ms': ...}}
+    stage_outputs = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    pipeline_mode = models.CharField(max_length=20, choices=PIPELINE_MODE_CHOICES, blank=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -36,3 +46,153 @@ class AIProcessingResult(models.Model):
 
     def __str__(self):
         return f"AI Result for Invoice {self.invoice.number}"
+
+
+class VendorProfile(models.Model):
+    """Running per-vendor statistics, maintained incrementally from invoice saves.
+
+    Amount mean/variance use Welford's algorithm (m2_amount is the running sum of
+    squared deviations), so adding or removing one invoice never rescans history.
+    min/max are the extremes ever observed and are not narrowed on removal.
+    """
+    vendor_key = models.CharField(max_length=255, unique=True)
+    display_name = models.CharField(max_length=255)
+
+    invoice_count = models.IntegerField(default=0)
+    mean_amount = models.FloatField(default=0.0)
+    m2_amount = models.FloatField(default=0.0)
+    min_amount = models.FloatField(null=True, blank=True)
+    max_amount = models.FloatField(null=True, blank=True)
+
+    paid_count = models.IntegerField(default=0)
+    paid_on_time_count = models.IntegerField(default=0)
+    last_seen = models.DateField(null=True, blank=True)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def variance_amount(self) -> float:
+        return self.m2_amount / self.invoice_count if self.invoice_count > 1 else 0.0
+
+    @property
+    def std_amount(self) -> float:
+        return self.variance_amount ** 0.5
+
+    @property
+    def reliability_score(self) -> float:
+        return self.paid_on_time_count / self.invoice_count if self.invoice_count else 0.5
+
+    def add_amount(self, amount: float):
+        self.invoice_count += 1
+        delta = amount - self.mean_amount
+        self.mean_amount += delta / self.invoice_count
+        self.m2_amount += delta * (amount - self.mean_amount)
+        self.min_amount = amount if self.min_amount is None else min(self.min_amount, amount)
+        self.max_amount = amount if self.max_amount is None else max(self.max_amount, amount)
+
+    def remove_amount(self, amount: float):
+        if self.invoice_count <= 1:
+            self.invoice_count = 0
+            self.mean_amount = 0.0
+            self.m2_amount = 0.0
+            return
+        mean_without = (self.invoice_count * self.mean_amount - amount) / (self.invoice_count - 1)
+        self.m2_amount = max(self.m2_amount - (amount - mean_without) * (amount - self.mean_amount), 0.0)
+        self.mean_amount = mean_without
+        self.invoice_count -= 1
+
+    def __str__(self):
+        return f"Vendor profile {self.display_name} ({self.invoice_count} invoices)"
+
+
+class DuplicateBlockingKey(models.Model):
+    """Blocking keys used to find duplicate-invoice candidates without scanning.
+
+    amount_bucket is a 5%-wide log bucket and date_bucket a 30-day window, so any two
+    invoices within 5% / 30 days of each other land in the same or adjacent buckets.
+    """
+    invoice = models.OneToOneField(Invoice, on_delete=models.CASCADE, related_name='blocking_key')
+    vendor_key = models.CharField(max_length=255)
+    number_key = models.CharField(max_length=100, blank=True)
+    amount = models.FloatField()
+    amount_bucket = models.IntegerField()
+    invoice_date = models.DateField(null=True, blank=True)
+    date_bucket = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['vendor_key', 'amount_bucket', 'date_bucket'], name='dup_block_amount_date_idx'),
+            models.Index(fields=['vendor_key', 'number_key'], name='dup_block_number_idx'),
+        ]
+
+    def __str__(self):
+        return f"Blocking key for invoice {self.invoice_id}"
+
+
+class TextSignature(models.Model):
+    """MinHash signature of an invoice's OCR text (NUM_PERM little-endian uint32 values)."""
+    invoice = models.OneToOneField(Invoice, on_delete=models.CASCADE, related_name='text_signature')
+    signature = models.BinaryField()
+    shingle_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Text signature for invoice {self.invoice_id}"
+
+
+class TextSignatureBand(models.Model):
+    """One LSH band of a TextSignature; invoices sharing any (band, bucket) are near-duplicate candidates."""
+    invoice = models.ForeignKey(Invoice, on_delete=models.CASCADE, related_name='text_signature_bands')
+    band = models.SmallIntegerField()
+    bucket = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['band', 'bucket'], name='text_sig_band_bucket_idx'),
+        ]
+
+    def __str__(self):
+        return f"Band {self.band} of invoice {self.invoice_id}"
+
+
+class InvoiceFeatures(models.Model):
+    """Precomputed feature vector of an invoice (float32 values laid out as feature_store.FEATURES)."""
+    invoice = models.OneToOneField(Invoice, on_delete=models.CASCADE, related_name='features')
+    # Normalized vendor name, used to read the live VendorProfile alongside the vector
+    vendor_key = models.CharField(max_length=255, blank=True)
+    vector = models.BinaryField()
+    schema_version = models.SmallIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Features for invoice {self.invoice_id}"
+
+
+class AIProcessingBatch(models.Model):
+    """Progress of one bulk AI processing request, updated once per processed chunk."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    total = models.IntegerField()
+    completed = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    chunk_size = models.IntegerField()
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def processed(self) -> int:
+        return self.completed + self.failed
+
+    def progress(self) -> dict:
+        return {
+            'batch_id': str(self.id),
+            'total': self.total,
+            'completed': self.completed,
+            'failed': self.failed,
+            'pending': max(self.total - self.processed, 0),
+            'finished': self.finished_at is not None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    def __str__(self):
+        return f"AI batch {self.id} ({self.processed}/{self.total})"
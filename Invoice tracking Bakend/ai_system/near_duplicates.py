@@ -0,0 +1,167 @@
+"""
+Near-duplicate detection on invoice OCR text with MinHash and LSH banding.
+
+The normalized raw_text is cut into overlapping character shingles, each hashed to
+32 bits. NUM_PERM universal hash functions turn the shingle set into a MinHash
+signature whose per-position agreement rate estimates the Jaccard similarity of two
+texts. The signature is split into BANDS bands of ROWS values; every band is hashed
+into a TextSignatureBand row, and only invoices sharing at least one (band, bucket)
+pair are compared, so a lookup touches a handful of index entries instead of every
+stored document.
+"""
+import hashlib
+import logging
+import re
+import zlib
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Q
+
+from invoice.models import Invoice
+from .models import TextSignature, TextSignatureBand
+
+logger = logging.getLogger(__name__)
+
+NUM_PERM = 128
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 5
+MIN_SHINGLES = 20
+SIMILARITY_THRESHOLD = 0.8
+
+_PRIME = np.uint64((1 << 31) - 1)
+_rng = np.random.RandomState(20250101)  # fixed so signatures are comparable across processes
+_A = _rng.randint(1, (1 << 31) - 1, size=NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, (1 << 31) - 1, size=NUM_PERM).astype(np.uint64)
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r'\s+', ' ', (text or '').casefold()).strip()
+
+
+def shingle_hashes(text: str) -> np.ndarray:
+    text = _normalize(text)
+    hashes = {
+        zlib.crc32(text[i:i + SHINGLE_SIZE].encode('utf-8'))
+        for i in range(len(text) - SHINGLE_SIZE + 1)
+    }
+    return np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+
+
+def minhash_signature(text: str, shingles: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
+    """uint32 MinHash signature, or None when the text is too short to compare."""
+    if shingles is None:
+        shingles = shingle_hashes(text)
+    if len(shingles) < MIN_SHINGLES:
+        return None
+    # a, b and x are all below p = 2**31 - 1, so a*x + b cannot overflow uint64
+    hashed = (_A[:, None] * (shingles % _PRIME)[None, :] + _B[:, None]) % _PRIME
+    return hashed.min(axis=1).astype(np.uint32)
+
+
+def band_buckets(signature: np.ndarray) -> List[int]:
+    return [
+        int.from_bytes(
+            hashlib.blake2b(signature[band * ROWS:(band + 1) * ROWS].tobytes(), digest_size=8).digest(),
+            'big', signed=True,
+        )
+        for band in range(BANDS)
+    ]
+
+
+def _decode(blob) -> np.ndarray:
+    return np.frombuffer(bytes(blob), dtype='<u4')
+
+
+def _signature_rows(invoice_id: int, text: str):
+    shingles = shingle_hashes(text)
+    signature = minhash_signature(text, shingles)
+    if signature is None:
+        return None, []
+    row = TextSignature(
+        invoice_id=invoice_id,
+        signature=signature.astype('<u4').tobytes(),
+        shingle_count=len(shingles),
+    )
+    bands = [
+        TextSignatureBand(invoice_id=invoice_id, band=band, bucket=bucket)
+        for band, bucket in enumerate(band_buckets(signature))
+    ]
+    return row, bands
+
+
+def index_invoice_text(invoice_id: int, text: str):
+    """Replace the stored signature and bands for one invoice."""
+    row, bands = _signature_rows(invoice_id, text)
+    with transaction.atomic():
+        TextSignature.objects.filter(invoice_id=invoice_id).delete()
+        TextSignatureBand.objects.filter(invoice_id=invoice_id).delete()
+        if row is not None:
+            row.save()
+            TextSignatureBand.objects.bulk_create(bands)
+
+
+def find_near_duplicates(text: Optional[str] = None, invoice_id: Optional[int] = None,
+                         threshold: float = SIMILARITY_THRESHOLD) -> List[Dict[str, Any]]:
+    """
+    Invoices whose OCR text has an estimated Jaccard similarity >= threshold.
+    Pass the text directly, or an invoice_id to reuse its stored signature.
+    """
+    if text:
+        signature = minhash_signature(text)
+    elif invoice_id:
+        blob = TextSignature.objects.filter(invoice_id=invoice_id).values_list('signature', flat=True).first()
+        signature = _decode(blob) if blob is not None else None
+    else:
+        signature = None
+    if signature is None:
+        return []
+
+    query = Q()
+    for band, bucket in enumerate(band_buckets(signature)):
+        query |= Q(band=band, bucket=bucket)
+    candidate_ids = TextSignatureBand.objects.filter(query).values_list('invoice_id', flat=True).distinct()
+    if invoice_id:
+        candidate_ids = candidate_ids.exclude(invoice_id=invoice_id)
+
+    rows = list(TextSignature.objects.filter(invoice_id__in=candidate_ids).values_list('invoice_id', 'signature'))
+    if not rows:
+        return []
+    matrix = np.stack([_decode(blob) for _, blob in rows])
+    similarity = (matrix == signature[None, :]).mean(axis=1)
+
+    matches = [
+        {'invoice_id': candidate, 'similarity': round(float(score), 3)}
+        for (candidate, _), score in zip(rows, similarity)
+        if score >= threshold
+    ]
+    return sorted(matches, key=lambda match: match['similarity'], reverse=True)
+
+
+def rebuild_text_index(batch_size: int = 500) -> int:
+    """Recompute every signature, walking invoices by primary key in batches."""
+    TextSignatureBand.objects.all().delete()
+    TextSignature.objects.all().delete()
+    last_id = 0
+    indexed = 0
+    while True:
+        batch = list(
+            Invoice.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'raw_text')[:batch_size]
+        )
+        if not batch:
+            break
+        last_id = batch[-1][0]
+        signatures, bands = [], []
+        for invoice_id, text in batch:
+            row, row_bands = _signature_rows(invoice_id, text)
+            if row is not None:
+                signatures.append(row)
+                bands.extend(row_bands)
+        with transaction.atomic():
+            TextSignature.objects.bulk_create(signatures)
+            TextSignatureBand.objects.bulk_create(bands)
+        indexed += len(signatures)
+    logger.info(f"Indexed OCR text of {indexed} invoices for near-duplicate detection")
+    return indexed
@@ -0,0 +1,208 @@
+"""
+AI pipeline as a Celery canvas.
+
+    ocr --+-- anomaly --+-- routing
+          +-- priority -+
+
+build_pipeline() chains the OCR stage into a chord whose header runs anomaly
+detection and priority scoring in parallel and whose body routes the invoice.
+Each stage checkpoints its output and duration into AIProcessingResult.stage_outputs
+before returning. A failing stage is retried on its own (PipelineStageTask) while
+the finished stages' outputs stay in place, and a pipeline started with
+resume=True skips every stage that already has a checkpoint.
+
+Both this and the sequential process_invoice_ai_pipeline task record
+dispatch-to-completion latency in processing_time_ms, tagged by pipeline_mode;
+the ai_pipeline_latency command compares the two.
+"""
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from celery import Task, chain, chord
+from celery.result import AsyncResult
+from celery.utils import uuid
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.utils import timezone
+
+from invoice.history import HistoryRecorder
+from invoice.models import Invoice, WorkflowOutbox
+from invoice.outbox import record_invoice_event
+from invoice.service import workflow_service
+from invoice.unit_of_work import InvoiceUnitOfWork
+from .model_registry import model_registry
+from .models import AIProcessingResult
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineStageTask(Task):
+    """Stage tasks retry individually with backoff and mark the run failed once retries run out."""
+    autoretry_for = (Exception,)
+    dont_autoretry_for = (ObjectDoesNotExist,)
+    retry_backoff = True
+    retry_kwargs = {'max_retries': 3}
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        result_id = args[1] if len(args) > 1 else kwargs.get('result_id')
+        stage = self.name.rsplit('.', 1)[-1]
+        logger.error(f"AI pipeline stage {stage} failed for result {result_id}: {exc}")
+        AIProcessingResult.objects.filter(id=result_id).update(
+            processing_status='failed', error_message=f"{stage}: {exc}", updated_at=timezone.now(),
+        )
+
+
+def begin_run(invoice: Invoice, mode: str, resume: bool = False) -> AIProcessingResult:
+    """The invoice's latest AIProcessingResult, reset for a new run (checkpoints kept when resuming)."""
+    ai_result = invoice.ai_results.order_by('-id').first() or AIProcessingResult(invoice=invoice)
+    if not resume:
+        ai_result.stage_outputs = {}
+    ai_result.pipeline_mode = mode
+    ai_result.processing_status = 'running'
+    ai_result.processing_started_at = timezone.now()
+    ai_result.processing_completed_at = None
+    ai_result.error_message = None
+    ai_result.save()
+    return ai_result
+
+
+def get_checkpoint(result_id: int, stage: str) -> Optional[Dict[str, Any]]:
+    """{'output', 'duration_ms'} of a finished stage, or None"""
+    outputs = AIProcessingResult.objects.filter(id=result_id).values_list('stage_outputs', flat=True).first()
+    return (outputs or {}).get(stage)
+
+
+def save_checkpoint(result_id: int, stage: str, output, started: float, **fields):
+    """Merge one stage's output into stage_outputs; parallel stages lock the row so neither overwrites the other."""
+    entry = {'output': output, 'duration_ms': int((time.monotonic() - started) * 1000)}
+    with transaction.atomic():
+        ai_result = AIProcessingResult.objects.select_for_update().get(id=result_id)
+        ai_result.stage_outputs = {**(ai_result.stage_outputs or {}), stage: entry}
+        for name, value in fields.items():
+            setattr(ai_result, name, value)
+        ai_result.save(update_fields=['stage_outputs', 'updated_at', *fields])
+
+
+def complete_run(ai_result: AIProcessingResult, unit_of_work: InvoiceUnitOfWork, processing_result: Dict[str, Any],
+                 history: Optional[HistoryRecorder] = None):
+    """
+    Store the run's results and scores, flush the invoice and record the routing
+    event in one transaction; history buffered by the caller is written in it too.
+    """
+    invoice = unit_of_work.invoice
+    ai_result.processing_status = 'completed'
+    ai_result.processing_completed_at = timezone.now()
+    ai_result.processing_time_ms = int(
+        (ai_result.processing_completed_at - ai_result.processing_started_at).total_seconds() * 1000
+    )
+    ai_result.ai_recommendations = processing_result.get('recommendations', [])
+    ai_result.suggested_actions = processing_result.get('next_actions', [])
+    if 'risk_score' in processing_result:
+        ai_result.fraud_risk_score = processing_result['risk_score']
+    if processing_result.get('anomaly_score') is not None:
+        ai_result.anomaly_score = processing_result['anomaly_score']
+    if 'priority_score' in processing_result:
+        ai_result.priority_score = processing_result['priority_score']
+    ai_result.ai_model_version = model_registry.version_label() or None
+
+    # Copy the scores onto the indexed invoice columns (0..1)
+    if 'priority_score' in processing_result:
+        unit_of_work.set(ai_priority_score=processing_result['priority_score'] / 100)
+    if 'risk_score' in processing_result:
+        unit_of_work.set(ai_risk_score=processing_result['risk_score'] / 100)
+
+    # Results, invoice changes and the workflow routing event commit together
+    with transaction.atomic():
+        ai_result.save()
+        unit_of_work.flush()
+        record_invoice_event(invoice.id, WorkflowOutbox.Event.AI_COMPLETED)
+        if history is not None:
+            history.flush()
+
+
+# Stages
+
+def ocr_stage(invoice_id: int, result_id: int):
+    if get_checkpoint(result_id, 'ocr') is not None:
+        return
+    started = time.monotonic()
+    invoice = Invoice.objects.get(id=invoice_id)
+    unit_of_work = InvoiceUnitOfWork(invoice)
+    ocr_result = workflow_service.run_ocr_stage(unit_of_work)
+    fields = {}
+    if ocr_result is not None:
+        fields = {'ocr_text': ocr_result.get('raw_text'), 'extracted_data': ocr_result.get('extracted_data')}
+    with transaction.atomic():
+        # Later stages read the invoice as OCR left it
+        unit_of_work.flush()
+        save_checkpoint(result_id, 'ocr', ocr_result, started, **fields)
+
+
+def anomaly_stage(invoice_id: int, result_id: int):
+    if get_checkpoint(result_id, 'anomaly') is not None:
+        return
+    started = time.monotonic()
+    anomaly_result = workflow_service.run_anomaly_stage(Invoice.objects.get(id=invoice_id))
+    save_checkpoint(result_id, 'anomaly', anomaly_result, started)
+
+
+def priority_stage(invoice_id: int, result_id: int):
+    if get_checkpoint(result_id, 'priority') is not None:
+        return
+    started = time.monotonic()
+    priority_result = workflow_service.run_priority_stage(Invoice.objects.get(id=invoice_id))
+    save_checkpoint(result_id, 'priority', priority_result, started)
+
+
+def routing_stage(invoice_id: int, result_id: int) -> Dict[str, Any]:
+    ai_result = AIProcessingResult.objects.get(id=result_id)
+    outputs = ai_result.stage_outputs or {}
+    if 'routing' in outputs:
+        return outputs['routing']['output']
+    missing = [stage for stage in ('anomaly', 'priority') if stage not in outputs]
+    if missing:
+        raise RuntimeError(f"Missing checkpoints for stages: {', '.join(missing)}")
+
+    started = time.monotonic()
+    invoice = Invoice.objects.get(id=invoice_id)
+    unit_of_work = InvoiceUnitOfWork(invoice)
+    processing_result = workflow_service.run_routing_stage(
+        unit_of_work, outputs['anomaly']['output'], outputs['priority']['output'],
+        (outputs.get('ocr') or {}).get('output'),
+    )
+    ai_result.stage_outputs = {
+        **outputs, 'routing': {'output': processing_result, 'duration_ms': int((time.monotonic() - started) * 1000)},
+    }
+    complete_run(ai_result, unit_of_work, processing_result)
+    logger.info(f"AI pipeline completed for invoice {invoice_id} in {ai_result.processing_time_ms} ms")
+    return processing_result
+
+
+# Canvas
+
+def build_pipeline(invoice_id: int, result_id: int):
+    from .tasks import ai_pipeline_anomaly, ai_pipeline_ocr, ai_pipeline_priority, ai_pipeline_routing
+
+    return chain(
+        ai_pipeline_ocr.si(invoice_id, result_id),
+        chord(
+            [ai_pipeline_anomaly.si(invoice_id, result_id), ai_pipeline_priority.si(invoice_id, result_id)],
+            ai_pipeline_routing.si(invoice_id, result_id),
+        ),
+    )
+
+
+def start_pipeline(invoice_id: int, resume: bool = False):
+    """
+    Dispatch the canvas for one invoice once the reset AIProcessingResult commits
+    (workers must not see the old row, or none); returns the AsyncResult of the
+    routing stage, whose id is assigned up front.
+    """
+    invoice = Invoice.objects.get(id=invoice_id)
+    ai_result = begin_run(invoice, 'canvas', resume=resume)
+    canvas = build_pipeline(invoice.id, ai_result.id)
+    # A chain's task_id goes to its last task, here the chord's routing body
+    task_id = uuid()
+    transaction.on_commit(lambda: canvas.apply_async(task_id=task_id))
+    return AsyncResult(task_id)
@@ -12,19 +12,26 @@ import numpy as np
 import pytesseract
 from PIL import Image
 import requests
-from sklearn.ensemble import IsolationForest
-from sklearn.preprocessing import StandardScaler
-import joblib
 import os
 
 from invoice.models import Invoice, InvoiceTemplate
 from notifications.service import NotificationService
+from .anomaly_scoring import score_vector
+from .models import VendorProfile
+from .model_registry import PAYMENT_DELAY_MODEL, model_registry
+from .duplicates import find_duplicate_candidates
+from .feature_store import (
+    COL, PRIORITY_COMPONENTS, get_feature_vector, payment_delay_matrix, priority_components, vector_from_data,
+)
+from .near_duplicates import find_near_duplicates
+from .vendor_profiles import get_vendor_profile
 from django.contrib.auth import get_user_model
 
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
+
 class OCRService:
     """Advanced OCR service with AI enhancement"""
     
@@ -152,30 +159,39 @@ class PredictiveAnalyticsService:
     """Machine learning service for predictions and insights"""
     
     def __init__(self):
-        self.model_path = os.path.join(settings.BASE_DIR, 'ml_models')
-        os.makedirs(self.model_path, exist_ok=True)
+        self.model_registry = model_registry
     
     def predict_payment_delay(self, invoice_data: Dict[str, Any]) -> Dict[str, Any]:
         """Predict likelihood of payment delay using ML"""
         try:
+            invoice_data = self._with_features(invoice_data)
+            profile = self._vendor_profile(invoice_data)
+            
             # Extract features for ML model
-            features = self._extract_payment_features(invoice_data)
+            features = self._extract_payment_features(invoice_data, profile)
             
-            # Load or train model
-            model = self._get_payment_delay_model()
+            # Model is loaded once per process by the registry
+            loaded = self._get_payment_delay_model()
             
             # Make prediction
-            delay_probability = model.predict_proba([features])[0][1]  # Probability of delay
+            if loaded is not None:
+                delay_probability = float(loaded.model.predict_proba([features])[0][1])  # Probability of delay
+                confidence = 0.85
+            else:
+                # No trained artifact yet: fall back to the vendor's on-time record
+                delay_probability = 1 - float(self._feature_vector(invoice_data, profile)[COL['vendor_on_time_rate']])
+                confidence = 0.5
             
             # Calculate risk factors
-            risk_factors = self._analyze_payment_risk_factors(invoice_data)
+            risk_factors = self._analyze_payment_risk_factors(invoice_data, profile)
             
             return {
                 'delay_probability': float(delay_probability),
                 'risk_level': self._get_risk_level(delay_probability),
                 'risk_factors': risk_factors,
                 'recommendations': self._get_payment_recommendations(delay_probability, risk_factors),
-                'confidence': 0.85  # Model confidence
+                'confidence': confidence,
+                'model_version': loaded.version if loaded is not None else None
             }
             
         except Exception as e:
@@ -192,17 +208,19 @@ class PredictiveAnalyticsService:
     def detect_anomalies(self, invoice_data: Dict[str, Any]) -> Dict[str, Any]:
         """Detect anomalies in invoice data"""
         try:
+            invoice_data = self._with_features(invoice_data)
             anomalies = []
             risk_score = 0
+            profile = self._vendor_profile(invoice_data)
             
             # Check amount anomalies
-            amount_anomaly = self._check_amount_anomaly(invoice_data)
+            amount_anomaly = self._check_amount_anomaly(invoice_data, profile)
             if amount_anomaly:
                 anomalies.append(amount_anomaly)
                 risk_score += 30
             
             # Check vendor anomalies
-            vendor_anomaly = self._check_vendor_anomaly(invoice_data)
+            vendor_anomaly = self._check_vendor_anomaly(invoice_data, profile)
             if vendor_anomaly:
                 anomalies.append(vendor_anomaly)
                 risk_score += 25
@@ -219,11 +237,29 @@ class PredictiveAnalyticsService:
                 anomalies.append(duplicate_risk)
                 risk_score += 40
             
+            # Check near-duplicate OCR text
+            near_duplicate = self._check_near_duplicate(invoice_data)
+            if near_duplicate:
+                anomalies.append(near_duplicate)
+                risk_score += 35
+            
+            # Check statistical outliers with the batch-fitted IsolationForest
+            anomaly_score = score_vector(self._feature_vector(invoice_data, profile))
+            if anomaly_score is not None and anomaly_score >= settings.AI_SETTINGS.get('ANOMALY_THRESHOLD', 70):
+                anomalies.append({
+                    'type': 'statistical_outlier',
+                    'description': f'Invoice is unusual compared to the corpus (anomaly score {anomaly_score:.0f}/100)',
+                    'severity': 'medium',
+                    'anomaly_score': anomaly_score
+                })
+                risk_score += 30
+            
             return {
                 'anomalies': anomalies,
                 'risk_score': min(risk_score, 100),
                 'risk_level': self._get_risk_level(risk_score / 100),
                 'requires_review': risk_score > 50,
+                'anomaly_score': anomaly_score,
                 'confidence': 0.90
             }
             
@@ -241,40 +277,28 @@ class PredictiveAnalyticsService:
     def calculate_priority_score(self, invoice_data: Dict[str, Any]) -> Dict[str, Any]:
         """Calculate invoice priority using AI scoring"""
         try:
-            score = 0
+            features = self._feature_vector(self._with_features(invoice_data), None)
+            points = dict(zip(PRIORITY_COMPONENTS, priority_components(features[None, :])[0]))
+            score = int(sum(points.values()))
             factors = []
             
             # Amount factor (higher amounts = higher priority)
-            amount = float(invoice_data.get('total_amount', 0))
-            if amount > 10000:
-                score += 30
-                factors.append({'factor': 'High amount', 'impact': 30})
-            elif amount > 5000:
-                score += 20
-                factors.append({'factor': 'Medium amount', 'impact': 20})
+            if points['amount']:
+                label = 'High amount' if points['amount'] >= 30 else 'Medium amount'
+                factors.append({'factor': label, 'impact': int(points['amount'])})
             
             # Due date factor
-            due_date = invoice_data.get('due_date')
-            if due_date:
-                days_until_due = (datetime.fromisoformat(due_date) - datetime.now()).days
-                if days_until_due <= 3:
-                    score += 40
-                    factors.append({'factor': 'Due very soon', 'impact': 40})
-                elif days_until_due <= 7:
-                    score += 25
-                    factors.append({'factor': 'Due soon', 'impact': 25})
+            if points['due_date']:
+                label = 'Due very soon' if points['due_date'] >= 40 else 'Due soon'
+                factors.append({'factor': label, 'impact': int(points['due_date'])})
             
             # Vendor relationship factor
-            vendor_priority = self._get_vendor_priority(invoice_data.get('vendor_name', ''))
-            score += vendor_priority
-            if vendor_priority > 0:
-                factors.append({'factor': 'Important vendor', 'impact': vendor_priority})
+            if points['vendor'] > 0:
+                factors.append({'factor': 'Important vendor', 'impact': int(points['vendor'])})
             
             # Service priority
-            service_priority = self._get_service_priority(invoice_data.get('current_service', ''))
-            score += service_priority
-            if service_priority > 0:
-                factors.append({'factor': 'Critical service', 'impact': service_priority})
+            if points['service'] > 0:
+                factors.append({'factor': 'Critical service', 'impact': int(points['service'])})
             
             priority_level = self._score_to_priority(score)
             
@@ -297,63 +321,33 @@ class PredictiveAnalyticsService:
                 'error': str(e)
             }
     
-    def _extract_payment_features(self, invoice_data: Dict[str, Any]) -> List[float]:
+    def _vendor_profile(self, invoice_data: Dict[str, Any]) -> Optional[VendorProfile]:
+        """Profile attached by a bulk caller, otherwise one indexed lookup"""
+        if 'vendor_profile' in invoice_data:
+            return invoice_data['vendor_profile']
+        return get_vendor_profile(invoice_data.get('vendor_name', ''))
+    
+    def _with_features(self, invoice_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Attach the stored feature vector of a saved invoice (one indexed read)"""
+        if invoice_data.get('features') is not None or not invoice_data.get('id'):
+            return invoice_data
+        return {**invoice_data, 'features': get_feature_vector(invoice_data['id'])}
+    
+    def _feature_vector(self, invoice_data: Dict[str, Any], profile: Optional[VendorProfile]) -> np.ndarray:
+        """Stored features when attached, otherwise computed from the dict (e.g. unsaved invoices)"""
+        features = invoice_data.get('features')
+        return features if features is not None else vector_from_data(invoice_data, profile)
+    
+    def _extract_payment_features(self, invoice_data: Dict[str, Any], profile: Optional[VendorProfile]) -> List[float]:
         """Extract features for payment delay prediction"""
-        features = []
-        
-        # Amount (normalized)
-        amount = float(invoice_data.get('total_amount', 0))
-        features.append(min(amount / 10000, 10))  # Normalize to 0-10 range
-        
-        # Days until due
-        due_date = invoice_data.get('due_date')
-        if due_date:
-            days_until_due = (datetime.fromisoformat(due_date) - datetime.now()).days
-            features.append(max(days_until_due, 0))
-        else:
-            features.append(30)  # Default
-        
-        # Vendor history (simplified)
-        vendor_name = invoice_data.get('vendor_name', '')
-        vendor_score = self._get_vendor_reliability_score(vendor_name)
-        features.append(vendor_score)
-        
-        # Service factor
-        service = invoice_data.get('current_service', '')
-        service_score = 1.0 if service in ['finance', 'accounting'] else 0.5
-        features.append(service_score)
-        
-        return features
+        features = self._feature_vector(invoice_data, profile)
+        return payment_delay_matrix(features[None, :])[0].tolist()
     
     def _get_payment_delay_model(self):
-        """Load or create payment delay prediction model"""
-        model_file = os.path.join(self.model_path, 'payment_delay_model.pkl')
-        
-        try:
-            if os.path.exists(model_file):
-                return joblib.load(model_file)
-        except:
-            pass
-        
-        # Create simple model if none exists
-        from sklearn.ensemble import RandomForestClassifier
-        model = RandomForestClassifier(n_estimators=100, random_state=42)
-        
-        # Train with dummy data (replace with real historical data)
-        X_dummy = [[1000, 30, 0.8, 1.0], [5000, 15, 0.6, 0.5], [2000, 45, 0.9, 1.0]]
-        y_dummy = [0, 1, 0]  # 0 = on time, 1 = delayed
-        
-        model.fit(X_dummy, y_dummy)
-        
-        # Save model
-        try:
-            joblib.dump(model, model_file)
-        except:
-            pass
-        
-        return model
+        """Current payment delay model, or None until one has been trained"""
+        return self.model_registry.get(PAYMENT_DELAY_MODEL)
     
-    def _analyze_payment_risk_factors(self, invoice_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    def _analyze_payment_risk_factors(self, invoice_data: Dict[str, Any], profile: Optional[VendorProfile]) -> List[Dict[str, Any]]:
         """Analyze factors that contribute to payment delay risk"""
         factors = []
         
@@ -365,8 +359,7 @@ class PredictiveAnalyticsService:
                 'risk_increase': 25
             })
         
-        vendor_name = invoice_data.get('vendor_name', '')
-        if self._is_new_vendor(vendor_name):
+        if self._is_new_vendor(invoice_data, profile):
             factors.append({
                 'factor': 'New vendor',
                 'impact': 'Requires additional verification',
@@ -375,13 +368,12 @@ class PredictiveAnalyticsService:
         
         return factors
     
-    def _check_amount_anomaly(self, invoice_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    def _check_amount_anomaly(self, invoice_data: Dict[str, Any], profile: Optional[VendorProfile]) -> Optional[Dict[str, Any]]:
         """Check for amount-based anomalies"""
         amount = float(invoice_data.get('total_amount', 0))
-        vendor_name = invoice_data.get('vendor_name', '')
         
         # Get historical average for this vendor
-        historical_avg = self._get_vendor_average_amount(vendor_name)
+        historical_avg = self._get_vendor_average_amount(invoice_data, profile)
         
         if historical_avg and amount > historical_avg * 3:
             return {
@@ -394,11 +386,11 @@ class PredictiveAnalyticsService:
         
         return None
     
-    def _check_vendor_anomaly(self, invoice_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    def _check_vendor_anomaly(self, invoice_data: Dict[str, Any], profile: Optional[VendorProfile]) -> Optional[Dict[str, Any]]:
         """Check for vendor-related anomalies"""
         vendor_name = invoice_data.get('vendor_name', '')
         
-        if self._is_new_vendor(vendor_name):
+        if self._is_new_vendor(invoice_data, profile):
             return {
                 'type': 'new_vendor',
                 'description': 'Invoice from previously unknown vendor',
@@ -439,88 +431,53 @@ class PredictiveAnalyticsService:
         return None
     
     def _check_duplicate_risk(self, invoice_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        """Check for potential duplicate invoices"""
+        """Check for potential duplicate invoices through the blocking-key index"""
         vendor_name = invoice_data.get('vendor_name', '')
         amount = float(invoice_data.get('total_amount', 0))
-        invoice_date = invoice_data.get('invoice_date')
+        invoice_date = Invoice._meta.get_field('invoice_date').to_python(invoice_data.get('invoice_date'))
+        number = invoice_data.get('number', '')
         
-        if not all([vendor_name, amount, invoice_date]):
+        if not vendor_name or not (number or (amount and invoice_date)):
             return None
         
-        # Look for similar invoices in the last 30 days
-        date_threshold = datetime.now() - timedelta(days=30)
-        
-        similar_invoices = Invoice.objects.filter(
-            vendor_name__icontains=vendor_name,
-            total_amount__range=(amount * 0.95, amount * 1.05),
-            invoice_date__gte=date_threshold
-        ).count()
+        candidates = find_duplicate_candidates(
+            vendor_name, amount, invoice_date, number=number, exclude_id=invoice_data.get('id')
+        )
         
-        if similar_invoices > 0:
+        if candidates:
             return {
                 'type': 'potential_duplicate',
-                'description': f'Found {similar_invoices} similar invoice(s) in last 30 days',
+                'description': f'Found {len(candidates)} similar invoice(s) within 30 days or with the same number',
                 'severity': 'high',
-                'similar_count': similar_invoices
+                'similar_count': len(candidates),
+                'candidate_ids': [c['invoice_id'] for c in candidates]
             }
         
         return None
     
-    def _get_vendor_average_amount(self, vendor_name: str) -> Optional[float]:
-        """Get historical average amount for vendor"""
-        try:
-            avg_data = Invoice.objects.filter(
-                vendor_name__icontains=vendor_name
-            ).aggregate(avg_amount=Avg('total_amount'))
-            
-            return float(avg_data['avg_amount']) if avg_data['avg_amount'] else None
-        except:
-            return None
-    
-    def _is_new_vendor(self, vendor_name: str) -> bool:
-        """Check if vendor is new (no previous invoices)"""
-        return not Invoice.objects.filter(vendor_name__icontains=vendor_name).exists()
-    
-    def _get_vendor_reliability_score(self, vendor_name: str) -> float:
-        """Get vendor reliability score based on payment history"""
-        try:
-            # Simple scoring based on payment history
-            total_invoices = Invoice.objects.filter(vendor_name__icontains=vendor_name).count()
-            paid_on_time = Invoice.objects.filter(
-                vendor_name__icontains=vendor_name,
-                status='paid',
-                payment_date__lte=models.F('due_date')
-            ).count()
-            
-            if total_invoices == 0:
-                return 0.5  # Unknown vendor
-            
-            return paid_on_time / total_invoices
-        except:
-            return 0.5
-    
-    def _get_vendor_priority(self, vendor_name: str) -> int:
-        """Get vendor priority score"""
-        # Check if vendor is in high-priority list
-        high_priority_vendors = ['Microsoft', 'Google', 'Amazon', 'Oracle']
+    def _check_near_duplicate(self, invoice_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Check for invoices whose OCR text is nearly identical (MinHash/LSH index)"""
+        matches = find_near_duplicates(text=invoice_data.get('raw_text'), invoice_id=invoice_data.get('id'))
         
-        for priority_vendor in high_priority_vendors:
-            if priority_vendor.lower() in vendor_name.lower():
-                return 20
+        if matches:
+            return {
+                'type': 'near_duplicate_document',
+                'description': f'Found {len(matches)} invoice(s) with nearly identical document text',
+                'severity': 'high',
+                'similar_count': len(matches),
+                'matches': matches[:5]
+            }
         
-        return 0
+        return None
     
-    def _get_service_priority(self, service: str) -> int:
-        """Get service priority score"""
-        priority_services = {
-            'finance': 15,
-            'accounting': 15,
-            'management': 20,
-            'purchasing': 10,
-            'hr': 5
-        }
-        
-        return priority_services.get(service, 0)
+    def _get_vendor_average_amount(self, invoice_data: Dict[str, Any], profile: Optional[VendorProfile]) -> Optional[float]:
+        """Get historical average amount for vendor, excluding the invoice being scored"""
+        features = self._feature_vector(invoice_data, profile)
+        return float(features[COL['vendor_mean_amount']]) if features[COL['vendor_history_count']] else None
+    
+    def _is_new_vendor(self, invoice_data: Dict[str, Any], profile: Optional[VendorProfile]) -> bool:
+        """Check if vendor is new (no previous invoices)"""
+        return not self._feature_vector(invoice_data, profile)[COL['vendor_history_count']]
     
     def _score_to_priority(self, score: int) -> str:
         """Convert numeric score to priority level"""
@@ -0,0 +1,91 @@
+import logging
+
+from django.db.models.signals import post_delete, post_init, post_save, pre_save
+from django.dispatch import receiver
+
+from invoice.models import Invoice, InvoiceLineItem
+from .duplicates import index_invoice
+from .feature_store import INPUT_FIELDS as FEATURE_INPUT_FIELDS, refresh_features
+from .near_duplicates import index_invoice_text
+from .vendor_profiles import TRACKED_FIELDS, apply_invoice_change, contribution, saved_values, snapshot
+
+logger = logging.getLogger(__name__)
+
+BLOCKING_FIELDS = ('vendor_name', 'number', 'total_amount', 'invoice_date')
+
+
+def _changed(previous, new_values, fields) -> bool:
+    if previous is None or new_values is None:
+        return True
+    return any(str(previous.get(field)) != str(new_values.get(field)) for field in fields)
+
+
+@receiver(post_init, sender=Invoice)
+def remember_vendor_fields(sender, instance: Invoice, **kwargs):
+    """Keep the loaded values so saves can be diffed without re-reading the row."""
+    instance._vendor_snapshot = snapshot(instance)
+
+
+@receiver(pre_save, sender=Invoice)
+def capture_previous_vendor_fields(sender, instance: Invoice, **kwargs):
+    if instance.pk is None:
+        instance._vendor_previous = None
+    elif instance._state.adding or getattr(instance, '_vendor_snapshot', None) is None:
+        # Built by hand with a pk, or loaded with deferred fields: read what is stored
+        instance._vendor_previous = Invoice.objects.filter(pk=instance.pk).values(*TRACKED_FIELDS).first()
+    else:
+        instance._vendor_previous = instance._vendor_snapshot
+
+
+@receiver(post_save, sender=Invoice)
+def update_vendor_profile(sender, instance: Invoice, created: bool, update_fields=None, **kwargs):
+    previous = getattr(instance, '_vendor_previous', None)
+    # A partially loaded instance only changes the fields it wrote
+    new_values = saved_values(instance, previous, update_fields)
+    if new_values is None:
+        return
+    try:
+        apply_invoice_change(contribution(previous), contribution(new_values))
+    except Exception:
+        logger.exception(f"Failed to update vendor profile for invoice {instance.pk}")
+
+    if created or _changed(previous, new_values, BLOCKING_FIELDS):
+        try:
+            index_invoice(instance)
+        except Exception:
+            logger.exception(f"Failed to update duplicate index for invoice {instance.pk}")
+
+    # After the vendor profile, which the features read
+    if created or _changed(previous, new_values, FEATURE_INPUT_FIELDS):
+        try:
+            refresh_features([instance.pk])
+        except Exception:
+            logger.exception(f"Failed to update features for invoice {instance.pk}")
+
+    text = instance.__dict__.get('raw_text')
+    previous_text = previous.get('raw_text') if previous else None
+    if text is not None and text != (previous_text or ''):
+        try:
+            index_invoice_text(instance.pk, text)
+        except Exception:
+            logger.exception(f"Failed to update text signature for invoice {instance.pk}")
+    instance._vendor_snapshot = new_values
+
+
+@receiver(post_delete, sender=Invoice)
+def remove_from_vendor_profile(sender, instance: Invoice, **kwargs):
+    try:
+        apply_invoice_change(contribution(getattr(instance, '_vendor_snapshot', None)), None)
+    except Exception:
+        logger.exception(f"Failed to update vendor profile for deleted invoice {instance.pk}")
+
+
+@receiver(post_save, sender=InvoiceLineItem)
+@receiver(post_delete, sender=InvoiceLineItem)
+def refresh_line_item_count(sender, instance: InvoiceLineItem, origin=None, **kwargs):
+    if isinstance(origin, Invoice):
+        return  # the invoice itself is being deleted
+    try:
+        refresh_features([instance.invoice_id])
+    except Exception:
+        logger.exception(f"Failed to update features for invoice {instance.invoice_id}")
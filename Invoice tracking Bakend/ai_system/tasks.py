@@ -9,10 +9,15 @@ from decimal import Decimal, InvalidOperation
 import logging
 from .ocr.engine import OcrEngine, TemplateHint
 
-from invoice.models import Invoice, InvoiceTemplate,WorkflowRule
+from invoice.models import Invoice, InvoiceTemplate,WorkflowRule, WorkflowOutbox
+from invoice.outbox import record_invoice_event
+from invoice.unit_of_work import InvoiceUnitOfWork
 from notifications.models import Notification
 from ai_system.models import AIProcessingResult
-from invoice.service import WorkflowAutomationService
+from ai_system.batch_scoring import rescore_priorities, score_payment_delays
+from ai_system import anomaly_scoring, anomaly_sweep, batch_processing, pipeline, training
+from ai_system.model_registry import ANOMALY_MODEL, model_registry
+from invoice.service import WorkflowAutomationService, workflow_service
 #import workflow service
 
 
@@ -99,6 +104,7 @@ def process_invoice_ocr(invoice_id: int) -> dict:
                     logger.warning(f"Could not parse date: {result.fields['date']}")
             
             invoice.save()
+            record_invoice_event(invoice.id, WorkflowOutbox.Event.OCR_COMPLETED)
             
         logger.info(f"OCR processing completed for invoice {invoice_id}")
         return {
@@ -115,40 +121,19 @@ def process_invoice_ocr(invoice_id: int) -> dict:
 
 @shared_task
 def process_invoice_ai_pipeline(invoice_id: int) -> dict:
-    """Complete AI processing pipeline for new invoices"""
+    """Complete AI processing pipeline for new invoices, every stage in this one task"""
     try:
         invoice = Invoice.objects.get(id=invoice_id)
         
         # Update processing status
-        ai_result, created = AIProcessingResult.objects.get_or_create(
-            invoice=invoice,
-            defaults={'processing_status': 'processing', 'processing_started_at': timezone.now()}
-        )
-        
-        if not created:
-            ai_result.processing_status = 'processing'
-            ai_result.processing_started_at = timezone.now()
-            ai_result.save()
-        
-        # Run complete AI pipeline
-        processing_result = WorkflowAutomationService.process_new_invoice(invoice)
-        
-        # Update AI result
-        ai_result.processing_status = 'completed'
-        ai_result.processing_completed_at = timezone.now()
-        ai_result.ai_recommendations = processing_result.get('recommendations', [])
-        ai_result.suggested_actions = processing_result.get('next_actions', [])
-        ai_result.save()
+        ai_result = pipeline.begin_run(invoice, 'sequential')
         
-        # Update invoice with AI results
-        invoice.ai_processing_status = 'completed'
-        if 'priority_score' in processing_result:
-            invoice.ai_priority_score = processing_result['priority_score']
-        if 'risk_score' in processing_result:
-            invoice.ai_risk_score = processing_result['risk_score']
-        invoice.save()
+        # Run complete AI pipeline; its invoice changes are written below in one UPDATE
+        unit_of_work = InvoiceUnitOfWork(invoice)
+        processing_result = workflow_service.process_new_invoice(invoice, unit_of_work)
+        pipeline.complete_run(ai_result, unit_of_work, processing_result)
         
-        logger.info(f"AI pipeline completed for invoice {invoice_id}")
+        logger.info(f"AI pipeline completed for invoice {invoice_id} in {ai_result.processing_time_ms} ms")
         return {
             "success": True,
             "processing_result": processing_result,
@@ -162,56 +147,113 @@ def process_invoice_ai_pipeline(invoice_id: int) -> dict:
         logger.error(f"AI pipeline failed for invoice {invoice_id}: {e}")
         
         # Update status to failed
-        try:
-            ai_result = AIProcessingResult.objects.get(invoice_id=invoice_id)
-            ai_result.processing_status = 'failed'
-            ai_result.error_message = str(e)
-            ai_result.save()
-        except:
-            pass
+        AIProcessingResult.objects.filter(invoice_id=invoice_id, processing_status='running').update(
+            processing_status='failed', error_message=str(e)
+        )
         
         return {"success": False, "error": str(e)}
 
 
+# Stages of the canvas pipeline (ai_system.pipeline.build_pipeline); each retries on its own
+
+@shared_task(base=pipeline.PipelineStageTask)
+def ai_pipeline_ocr(invoice_id: int, result_id: int):
+    pipeline.ocr_stage(invoice_id, result_id)
+
+
+@shared_task(base=pipeline.PipelineStageTask)
+def ai_pipeline_anomaly(invoice_id: int, result_id: int):
+    pipeline.anomaly_stage(invoice_id, result_id)
+
+
+@shared_task(base=pipeline.PipelineStageTask)
+def ai_pipeline_priority(invoice_id: int, result_id: int):
+    pipeline.priority_stage(invoice_id, result_id)
+
+
+@shared_task(base=pipeline.PipelineStageTask)
+def ai_pipeline_routing(invoice_id: int, result_id: int) -> dict:
+    return pipeline.routing_stage(invoice_id, result_id)
+
+
 @shared_task
-def detect_anomalies() -> dict:
-    """Run periodic anomaly detection over invoices."""
+def process_ai_batch_chunk(batch_id: str, invoice_ids: list) -> dict:
+    """Run the AI pipeline for one chunk of a bulk batch with lookups shared across the chunk"""
     try:
-        anomalies = []
-        
-        # Check for duplicate invoices
-        duplicates = Invoice.objects.values('vendor_name', 'number').annotate(
-            count=Count('id')
-        ).filter(count__gt=1)
-        
-        for dup in duplicates:
-            anomalies.append({
-                "type": "duplicate_invoice",
-                "vendor_name": dup['supplier'],
-                "number": dup['number'],
-                "count": dup['count']
-            })
-        
-        # Check for unusually high amounts
-        avg_amount = Invoice.objects.aggregate(avg=Avg('total_amount'))['avg'] or 0
-        high_threshold = avg_amount * 3  # 3x average
-        
-        high_amount_invoices = Invoice.objects.filter(
-            amount__gt=high_threshold,
-            status__in=[Invoice.Status.PENDING, Invoice.Status.APPROVED]
-        )
-        
-        for invoice in high_amount_invoices:
-            anomalies.append({
-                "type": "high_amount",
-                "id": invoice.id,
-                "total_amount": float(invoice.amount),
-                "threshold": float(high_threshold)
-            })
-        
-        logger.info(f"Anomaly detection completed. Found {len(anomalies)} anomalies")
-        return {"success": True, "anomalies": anomalies}
-        
+        return {"success": True, **batch_processing.process_chunk(batch_id, invoice_ids)}
+    except Exception as e:
+        logger.error(f"AI batch {batch_id} chunk failed: {e}")
+        batch_processing.record_progress(batch_id, 0, len(invoice_ids))
+        return {"success": False, "error": str(e)}
+
+
+@shared_task
+def bulk_predict_payment_delay(invoice_ids=None, chunk_size: int = 5000) -> dict:
+    """Score payment delay for the given invoices, or every open invoice, in chunks."""
+    try:
+        queryset = Invoice.objects.filter(id__in=invoice_ids) if invoice_ids else None
+        result = score_payment_delays(queryset, chunk_size=chunk_size)
+        return {"success": True, **result}
+    except Exception as e:
+        logger.error(f"Bulk payment delay prediction failed: {e}")
+        return {"success": False, "error": str(e)}
+
+
+@shared_task
+def rescore_invoice_priorities(chunk_size: int = 5000) -> dict:
+    """Recompute priority of every open invoice as due dates approach; stores only changes."""
+    try:
+        result = rescore_priorities(chunk_size=chunk_size)
+        return {"success": True, "scored": result["scored"], "updated": result["updated"]}
+    except Exception as e:
+        logger.error(f"Priority rescoring failed: {e}")
+        return {"success": False, "error": str(e)}
+
+
+@shared_task
+def train_models(model: str = None) -> dict:
+    """Retrain models from invoice history and publish new versions to the registry."""
+    try:
+        reports = training.train_models(model=model)
+        return {"success": True, "reports": reports}
+    except Exception as e:
+        logger.error(f"Model training failed: {e}")
+        return {"success": False, "error": str(e)}
+
+
+@shared_task
+def score_invoice_anomalies(refit: bool = False) -> dict:
+    """Score not-yet-scored invoices with the IsolationForest model, fitting it first if needed."""
+    try:
+        fit_report = None
+        if refit or model_registry.get(ANOMALY_MODEL) is None:
+            fit_report = training.fit_anomaly_model()
+        score_report = anomaly_scoring.score_invoice_anomalies(only_new=not refit)
+        return {"success": True, "fit": fit_report, **score_report}
+    except Exception as e:
+        logger.error(f"Batch anomaly scoring failed: {e}")
+        return {"success": False, "error": str(e)}
+
+
+@shared_task
+def detect_anomalies(chunk_size: int = anomaly_sweep.DEFAULT_CHUNK_SIZE) -> dict:
+    """
+    Run the periodic anomaly sweep over invoices in checkpointed chunks. Stops well
+    before CELERY_TASK_TIME_LIMIT and re-enqueues itself to continue from the cursor.
+    """
+    time_limit = getattr(settings, 'CELERY_TASK_TIME_LIMIT', 30 * 60)
+    if not anomaly_sweep.acquire_lock(timeout=time_limit):
+        logger.info("Anomaly sweep already running, skipping")
+        return {"success": True, "skipped": True}
+    try:
+        result = anomaly_sweep.run_sweep(chunk_size=chunk_size, max_seconds=time_limit * 0.8)
     except Exception as e:
         logger.error(f"Anomaly detection failed: {e}")
         return {"success": False, "error": str(e)}
+    finally:
+        anomaly_sweep.release_lock()
+
+    if not result["complete"]:
+        detect_anomalies.delay(chunk_size=chunk_size)
+    logger.info(f"Anomaly detection pass done. {result['findings']} findings so far")
+    return {"success": True, **result}
@@ -204,4 +204,675 @@
 #     client = APIClient()
 #     client.force_authenticate(user=default_user)
 #     resp = client.get("/api/invoices/")  # adjust to your real endpoint
-#     assert resp.status_code in (200, 204)"""
\ No newline at end of file
+#     assert resp.status_code in (200, 204)"""
+
+import statistics
+from datetime import date
+from decimal import Decimal
+
+import pytest
+from django.contrib.auth import get_user_model
+
+from departments.models import Service
+from invoice.models import Invoice, InvoiceLineItem
+from .batch_scoring import score_payment_delays
+from .duplicates import normalize_invoice_number, rebuild_duplicate_index, sweep_duplicates
+from .feature_store import COL, iter_feature_matrix, load_matrix, rebuild_feature_store
+from .model_registry import ModelRegistry
+from .models import AIProcessingResult, DuplicateBlockingKey, InvoiceFeatures, TextSignature, VendorProfile
+from .anomaly_scoring import score_invoice_anomalies
+from .training import fit_anomaly_model, train_payment_delay_model
+from .near_duplicates import find_near_duplicates, rebuild_text_index
+from .service import PredictiveAnalyticsService
+from .vendor_profiles import normalize_vendor_key, rebuild_vendor_profiles
+
+User = get_user_model()
+
+
+@pytest.fixture
+def default_user(db):
+    service = Service.objects.create(name="Finance", code="FIN")
+    return User.objects.create_user(
+        email="ai@example.com",
+        password="secret",
+        name="AI User",
+        role="manager",
+        service_id=service,
+    )
+
+
+def make_invoice(user, number, amount, vendor_name="Acme Corp", **kwargs):
+    fields = dict(
+        subtotal=Decimal(amount),
+        tax_amount=Decimal("0.00"),
+        total_amount=Decimal(amount),
+        invoice_date=date(2025, 1, 1),
+        issue_date=date(2025, 1, 1),
+        due_date=date(2025, 2, 1),
+        current_service="finance",
+        created_by=user,
+    )
+    fields.update(kwargs)
+    return Invoice.objects.create(vendor_name=vendor_name, number=number, **fields)
+
+
+def test_normalize_vendor_key():
+    assert normalize_vendor_key("  ACME, Corp. ") == "acme"
+    assert normalize_vendor_key("Société Générale SA") == "societe generale"
+
+
+@pytest.mark.django_db
+def test_vendor_profile_tracks_saves_payments_and_deletes(default_user):
+    first = make_invoice(default_user, "VP-1", "100")
+    make_invoice(default_user, "VP-2", "200", vendor_name="ACME corp.")
+    third = make_invoice(default_user, "VP-3", "300")
+
+    profile = VendorProfile.objects.get(vendor_key="acme")
+    assert profile.invoice_count == 3
+    assert profile.mean_amount == pytest.approx(200)
+    assert profile.variance_amount == pytest.approx(statistics.pvariance([100, 200, 300]))
+
+    third.total_amount = Decimal("600")
+    third.status = Invoice.Status.PAID
+    third.payment_date = date(2025, 1, 15)
+    third.save()
+    first.delete()
+
+    profile.refresh_from_db()
+    assert profile.invoice_count == 2
+    assert profile.mean_amount == pytest.approx(400)
+    assert profile.variance_amount == pytest.approx(statistics.pvariance([200, 600]))
+    assert (profile.paid_count, profile.paid_on_time_count) == (1, 1)
+    assert (profile.min_amount, profile.max_amount) == (100, 600)
+
+    rebuild_vendor_profiles()
+    rebuilt = VendorProfile.objects.get(vendor_key="acme")
+    assert rebuilt.invoice_count == 2
+    assert rebuilt.m2_amount == pytest.approx(profile.m2_amount)
+    assert rebuilt.paid_on_time_count == 1
+
+    # Partially loaded instances keep their contribution and only change what they write
+    partial = Invoice.objects.only("id", "status").get(number="VP-2")
+    partial.status = Invoice.Status.APPROVED
+    partial.save(update_fields=["status"])
+    Invoice.objects.only("id", "notes").get(number="VP-2").save(update_fields=["notes"])
+    partial = Invoice.objects.only("id", "total_amount").get(number="VP-2")
+    partial.total_amount = Decimal("400")
+    partial.save(update_fields=["total_amount"])
+    profile = VendorProfile.objects.get(vendor_key="acme")
+    assert profile.invoice_count == 2
+    assert profile.mean_amount == pytest.approx(500)
+
+
+@pytest.mark.django_db
+def test_anomaly_checks_read_vendor_profile(default_user, django_assert_num_queries):
+    for i in range(3):
+        make_invoice(default_user, f"AN-{i}", "100")
+    spike = make_invoice(default_user, "AN-SPIKE", "1000")
+    service = PredictiveAnalyticsService()
+    invoice_data = {"id": spike.id, "vendor_name": "acme corp", "total_amount": 1000.0}
+
+    profile = VendorProfile.objects.get(vendor_key="acme")
+    with django_assert_num_queries(0):
+        anomaly = service._check_amount_anomaly(invoice_data, profile)
+        assert not service._is_new_vendor(invoice_data, profile)
+    assert anomaly["historical_average"] == pytest.approx(100)
+
+    assert service._is_new_vendor({"vendor_name": "Initech"}, None)
+
+
+def test_normalize_invoice_number():
+    assert normalize_invoice_number("INV-00123") == "123"
+    assert normalize_invoice_number("inv 123") == "123"
+    assert normalize_invoice_number("No. 0123") == "123"
+    assert normalize_invoice_number("A-77") == "A77"
+
+
+@pytest.mark.django_db
+def test_duplicate_index_lookup_and_sweep(default_user):
+    original = make_invoice(default_user, "INV-0042", "1000")
+    resubmitted = make_invoice(default_user, "42", "1200", vendor_name="ACME Corp.", invoice_date=date(2025, 3, 1))
+    near = make_invoice(default_user, "DX-2", "1030", invoice_date=date(2025, 1, 20))
+    make_invoice(default_user, "DX-3", "1500", invoice_date=date(2025, 1, 5))
+    make_invoice(default_user, "DX-4", "1000", vendor_name="Initech")
+    assert DuplicateBlockingKey.objects.count() == 5
+
+    service = PredictiveAnalyticsService()
+    risk = service._check_duplicate_risk({
+        "id": original.id, "vendor_name": "acme", "number": "INV-0042",
+        "total_amount": 1000.0, "invoice_date": "2025-01-01",
+    })
+    assert sorted(risk["candidate_ids"]) == sorted([resubmitted.id, near.id])
+
+    expected = {
+        (resubmitted.id, original.id, "same_number"),
+        (near.id, original.id, "similar_amount_and_date"),
+    }
+    pairs = {(p["invoice_id"], p["duplicate_of"], p["reason"]) for p in sweep_duplicates(chunk_size=2)}
+    assert pairs == expected
+
+    near.total_amount = Decimal("2000")
+    near.save()
+    assert DuplicateBlockingKey.objects.get(invoice=near).amount == 2000
+    assert rebuild_duplicate_index(batch_size=2) == 5
+    pairs = {(p["invoice_id"], p["duplicate_of"], p["reason"]) for p in sweep_duplicates()}
+    assert pairs == {(resubmitted.id, original.id, "same_number")}
+
+
+OCR_TEXT = """
+ACME Corp, 12 Industrial Road, Springfield
+Invoice number INV-2025-0042  Date 2025-01-01
+Bill to: Finance department
+Consulting services January 40 hours at 25.00 = 1000.00
+Subtotal 1000.00  Tax 0.00  Total due 1000.00 USD
+Payment terms: net 30. Bank transfer to account 0011 2233 4455.
+"""
+
+
+@pytest.mark.django_db
+def test_near_duplicate_ocr_text(default_user):
+    original = make_invoice(default_user, "TX-1", "1000", raw_text=OCR_TEXT)
+    resubmitted = make_invoice(
+        default_user, "TX-2", "1000", invoice_date=date(2025, 1, 3),
+        raw_text=OCR_TEXT.replace("INV-2025-0042", "INV-2025-0043").replace("2025-01-01", "2025-01-03"),
+    )
+    unrelated = make_invoice(
+        default_user, "TX-3", "80", vendor_name="Initech",
+        raw_text="Initech office supplies: 4 staplers, 2 boxes of paper, toner cartridge. Total 80.00 EUR",
+    )
+    assert TextSignature.objects.count() == 3
+
+    matches = find_near_duplicates(invoice_id=original.id)
+    assert [m["invoice_id"] for m in matches] == [resubmitted.id]
+    assert matches[0]["similarity"] >= 0.8
+    assert find_near_duplicates(invoice_id=unrelated.id) == []
+
+    anomalies = PredictiveAnalyticsService().detect_anomalies(
+        {"id": resubmitted.id, "vendor_name": "Acme Corp", "number": "TX-2", "total_amount": 1000.0}
+    )["anomalies"]
+    near = next(a for a in anomalies if a["type"] == "near_duplicate_document")
+    assert near["matches"][0]["invoice_id"] == original.id
+
+    resubmitted.raw_text = ""
+    resubmitted.save()
+    assert find_near_duplicates(invoice_id=original.id) == []
+    assert rebuild_text_index(batch_size=1) == 2
+
+
+def test_model_registry_loads_once_and_hot_reloads(tmp_path):
+    from sklearn.linear_model import LogisticRegression
+
+    registry = ModelRegistry(str(tmp_path), reload_interval=0)
+    assert registry.get("payment_delay") is None
+
+    first = LogisticRegression().fit([[0.0], [1.0]], [0, 1])
+    registry.publish("payment_delay", first, version="20250101T000000")
+    loaded = registry.get("payment_delay")
+    assert loaded.version == "20250101T000000"
+    assert registry.get("payment_delay") is loaded
+
+    second = LogisticRegression().fit([[0.0], [1.0]], [1, 0])
+    registry.publish("payment_delay", second, version="20250201T000000")
+    assert registry.get("payment_delay").version == "20250201T000000"
+    assert registry.version_label() == "payment_delay@20250201T000000"
+
+
+def test_payment_delay_never_trains_without_artifact(tmp_path):
+    service = PredictiveAnalyticsService()
+    service.model_registry = ModelRegistry(str(tmp_path))
+    prediction = service.predict_payment_delay({"vendor_name": "", "total_amount": 100.0})
+    assert prediction["model_version"] is None
+    assert prediction["delay_probability"] == pytest.approx(0.5)
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.django_db
+def test_bulk_payment_delay_matches_single_invoice_path(
+        default_user, tmp_path, monkeypatch, django_assert_max_num_queries):
+    from rest_framework.test import APIClient
+    from sklearn.linear_model import LogisticRegression
+
+    registry = ModelRegistry(str(tmp_path))
+    registry.publish(
+        "payment_delay",
+        LogisticRegression().fit([[0.1, 30, 0.9, 1.0], [5.0, 2, 0.1, 0.5], [0.3, 20, 0.7, 1.0], [2.0, 0, 0.2, 0.5]],
+                                 [0, 1, 0, 1]),
+    )
+    monkeypatch.setattr("ai_system.batch_scoring.model_registry", registry)
+
+    invoices = [
+        make_invoice(default_user, "PD-1", "100", due_date=date(2099, 1, 1)),
+        make_invoice(default_user, "PD-2", "25000", status=Invoice.Status.PAID,
+                     payment_date=date(2025, 1, 10)),
+        make_invoice(default_user, "PD-3", "4000", vendor_name="Initech", current_service="sales",
+                     due_date=date(2099, 6, 1)),
+        make_invoice(default_user, "PD-4", "900", due_date=date(2020, 1, 1)),
+    ]
+
+    with django_assert_max_num_queries(8):
+        result = score_payment_delays(chunk_size=2)
+    assert result["scored"] == 3  # the paid invoice is not open
+
+    service = PredictiveAnalyticsService()
+    service.model_registry = registry
+    fields = ("id", "vendor_name", "total_amount", "due_date", "current_service")
+    for invoice in invoices:
+        invoice.refresh_from_db()
+        if invoice.status == Invoice.Status.PAID:
+            assert invoice.ai_delay_probability is None
+            continue
+        data = {field: getattr(invoice, field) for field in fields}
+        data["total_amount"] = float(data["total_amount"])
+        data["due_date"] = data["due_date"].isoformat()
+        single = service.predict_payment_delay(data)["delay_probability"]
+        assert invoice.ai_delay_probability == pytest.approx(single)
+
+    client = APIClient()
+    client.force_authenticate(default_user)
+    response = client.post(
+        "/api/invoices/bulk-predict-payment-delay/", {"invoice_ids": [invoices[0].id]}, format="json"
+    )
+    assert response.status_code == 200
+    assert response.data["scored"] == 1
+    assert [row["id"] for row in response.data["results"]] == [invoices[0].id]
+    for bad_ids in (["abc"], [1.5], [True], "1,2"):
+        response = client.post("/api/invoices/bulk-predict-payment-delay/", {"invoice_ids": bad_ids}, format="json")
+        assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_train_payment_delay_model_publishes_versioned_artifact(default_user, tmp_path, monkeypatch):
+    import io
+    import json
+    from datetime import timedelta
+    from django.core.management import call_command
+
+    registry = ModelRegistry(str(tmp_path), reload_interval=0)
+    monkeypatch.setattr("ai_system.training.model_registry", registry)
+    for i in range(60):
+        late = i % 3 == 0
+        due = date(2025, 2, 1)
+        make_invoice(
+            default_user, f"TR-{i}", str(500 + 1000 * late + i),
+            vendor_name="Slowpay Ltd" if late else "Acme Corp",
+            status=Invoice.Status.PAID,
+            payment_date=due + timedelta(days=10 if late else -5),
+        )
+
+    report = train_payment_delay_model(chunk_size=25, folds=3)
+    assert report["rows"] == 60
+    assert report["late_rate"] == pytest.approx(20 / 60, abs=1e-3)
+    assert set(report["metrics"]) == {"roc_auc", "accuracy", "brier"}
+    assert report["metrics"]["roc_auc"] > 0.75
+
+    loaded = registry.get("payment_delay")
+    assert loaded.version == report["version"]
+    saved = json.loads((tmp_path / "payment_delay" / f"{report['version']}.json").read_text())
+    assert saved["rows"] == 60
+
+    # The command reports every model from its own keys
+    out = io.StringIO()
+    call_command("train_models", "--dry-run", "--folds", "3", "--chunk-size", "25", stdout=out)
+    output = out.getvalue()
+    assert "payment_delay (not published): 60 rows, 3-fold CV roc_auc=" in output
+    assert "invoice_anomaly (not published): 60 rows, mean_score=" in output
+
+
+@pytest.mark.django_db
+def test_isolation_forest_batch_scoring_and_reuse(default_user, tmp_path, monkeypatch):
+    registry = ModelRegistry(str(tmp_path), reload_interval=0)
+    monkeypatch.setattr("ai_system.training.model_registry", registry)
+    monkeypatch.setattr("ai_system.anomaly_scoring.model_registry", registry)
+    for i in range(80):
+        make_invoice(default_user, f"IF-{i}", str(1000 + (i % 7) * 10), tax_amount=Decimal("100"))
+    outlier = make_invoice(
+        default_user, "IF-OUT", "90000", tax_amount=Decimal("40000"),
+        invoice_date=date(2025, 1, 4), due_date=date(2025, 1, 5),
+    )
+    scored_before = make_invoice(default_user, "IF-OLD", "1000")
+    AIProcessingResult.objects.create(invoice=scored_before, anomaly_score=Decimal("12.5"))
+
+    report = fit_anomaly_model(chunk_size=30)
+    assert report["rows"] == 82
+    assert report["fit_seconds"] >= 0
+
+    result = score_invoice_anomalies(chunk_size=30)
+    assert result["scored"] == 81
+    assert result["model_version"] == report["version"]
+    scores = dict(AIProcessingResult.objects.values_list("invoice__number", "anomaly_score"))
+    assert scores["IF-OLD"] == Decimal("12.5")
+    assert scores["IF-OUT"] == max(scores.values())
+
+    service = PredictiveAnalyticsService()
+    data = {
+        "id": outlier.id, "vendor_name": "Acme Corp", "number": "IF-OUT", "total_amount": 90000.0,
+        "subtotal": 90000.0, "tax_amount": 40000.0, "invoice_date": "2025-01-04", "due_date": "2025-01-05",
+    }
+    detected = service.detect_anomalies(data)
+    assert float(scores["IF-OUT"]) == pytest.approx(detected["anomaly_score"], abs=0.01)
+    assert any(a["type"] == "statistical_outlier" for a in detected["anomalies"])
+
+
+@pytest.mark.django_db
+def test_feature_store_is_maintained_incrementally(default_user, django_assert_num_queries):
+    first = make_invoice(default_user, "FS-1", "1000", tax_amount=Decimal("100"))
+    second = make_invoice(default_user, "FS-2", "3000")
+    assert InvoiceFeatures.objects.count() == 2
+
+    vectors = load_matrix([second.id, first.id])
+    assert vectors.shape == (2, len(COL))
+    assert vectors[1, COL["tax_ratio"]] == pytest.approx(0.1)
+    # Vendor history as seen from each invoice leaves the invoice itself out
+    assert vectors[0, COL["vendor_history_count"]] == 1
+    assert vectors[0, COL["vendor_mean_amount"]] == pytest.approx(1000)
+    # Stored when FS-1 was the vendor's only invoice, read with the live profile that now includes FS-2
+    assert vectors[1, COL["vendor_history_count"]] == 1
+    assert vectors[1, COL["vendor_mean_amount"]] == pytest.approx(3000)
+
+    InvoiceLineItem.objects.create(
+        invoice=first, description="Paper", quantity=2, unit_price=Decimal("500"), total_price=Decimal("1000"),
+    )
+    assert load_matrix([first.id])[0, COL["line_item_count"]] == 1
+    first.total_amount = Decimal("2000")
+    first.save()
+    refreshed = load_matrix([first.id])[0]
+    assert refreshed[COL["amount"]] == 2000
+    assert refreshed[COL["vendor_mean_amount"]] == pytest.approx(3000)
+
+    # One id page and one vector read per chunk, plus the empty page that ends the walk
+    with django_assert_num_queries(3):
+        chunks = list(iter_feature_matrix(Invoice.objects.filter(number__startswith="FS-"), chunk_size=5))
+    assert chunks[0][0] == [first.id, second.id]
+
+    InvoiceFeatures.objects.all().delete()
+    assert rebuild_feature_store(chunk_size=1) == 2
+    assert load_matrix([first.id])[0, COL["line_item_count"]] == 1
+
+
+@pytest.mark.django_db
+def test_nightly_priority_rescoring_updates_changes_and_coalesces_events(default_user, django_assert_max_num_queries):
+    from asgiref.sync import async_to_sync
+    from channels.layers import get_channel_layer
+    from datetime import datetime
+
+    from .batch_scoring import rescore_priorities
+
+    # Due in 2 days on the rescoring date: 40 (due) + 15 (finance) -> medium
+    due_soon = [
+        make_invoice(default_user, f"PR-{i}", "100", due_date=date(2025, 3, 3), priority=Invoice.Priority.LOW)
+        for i in range(3)
+    ]
+    # Already stored with the priority it scores to
+    unchanged = make_invoice(default_user, "PR-OK", "100", due_date=date(2025, 6, 1), priority=Invoice.Priority.LOW)
+    hr = make_invoice(
+        default_user, "PR-HR", "20000", due_date=date(2025, 3, 2), current_service="hr",
+        priority=Invoice.Priority.LOW,
+    )
+    make_invoice(default_user, "PR-PAID", "20000", due_date=date(2025, 3, 2), status=Invoice.Status.PAID)
+    # Priorities set by a workflow rule or by hand are not rescored
+    for source in (Invoice.PrioritySource.RULE, Invoice.PrioritySource.MANUAL):
+        make_invoice(
+            default_user, f"PR-{source}", "100", due_date=date(2025, 3, 3), priority=Invoice.Priority.LOW,
+            priority_source=source,
+        )
+
+    channel_layer = get_channel_layer()
+    channel = async_to_sync(channel_layer.new_channel)()
+    async_to_sync(channel_layer.group_add)("invoice_updates", channel)
+
+    # Per chunk of two: ids, vectors, one bulk UPDATE
+    with django_assert_max_num_queries(10):
+        result = rescore_priorities(chunk_size=2, now=datetime(2025, 3, 1))
+    assert result["scored"] == 5
+    assert result["updated"] == 4
+
+    priorities = dict(Invoice.objects.values_list("number", "priority"))
+    assert all(priorities[invoice.number] == "medium" for invoice in due_soon)
+    assert priorities[unchanged.number] == "low"
+    assert priorities[hr.number] == "high"  # 30 + 40 + 5 = 75
+    assert priorities["PR-rule"] == priorities["PR-manual"] == "low"
+    scores = dict(Invoice.objects.values_list("number", "ai_priority_score"))
+    assert scores[due_soon[0].number] == pytest.approx(0.55)
+    assert scores[hr.number] == pytest.approx(0.75)
+    assert scores["PR-rule"] is None
+
+    events = [async_to_sync(channel_layer.receive)(channel) for _ in range(2)]
+    assert {event["service"]: event["changes"]["count"] for event in events} == {"finance": 3, "hr": 1}
+    assert all(event["type"] == "invoice_priorities_updated" for event in events)
+
+
+@pytest.mark.django_db
+def test_anomaly_sweep_is_chunked_resumable_and_idempotent(default_user, django_assert_max_num_queries):
+    from . import anomaly_sweep
+    from .tasks import detect_anomalies
+
+    anomaly_sweep.reset_checkpoint()
+    original = make_invoice(default_user, "INV-100", "500")
+    for i in range(4):
+        make_invoice(default_user, f"SW-{i}", str(100 + 400 * i), vendor_name=f"Vendor {i}")
+    duplicate = make_invoice(default_user, "100", "505", invoice_date=date(2025, 1, 10))
+    big = make_invoice(default_user, "SW-BIG", "50000", vendor_name="Big Co", status=Invoice.Status.PENDING_APPROVAL)
+    AIProcessingResult.objects.create(invoice=duplicate, anomalies_detected=[{"type": "timing_anomaly"}])
+
+    # A sweep that runs out of time after its first chunk leaves a checkpoint behind
+    paused = anomaly_sweep.run_sweep(chunk_size=3, max_seconds=0)
+    assert not paused["complete"]
+    assert anomaly_sweep.get_checkpoint()["cursor"] == paused["cursor"]
+
+    # Two remaining chunks, each a fixed handful of set-based queries
+    with django_assert_max_num_queries(16):
+        result = detect_anomalies(chunk_size=3)
+    assert result["success"] and result["complete"]
+    assert result["scanned"] == 7
+    assert anomaly_sweep.get_checkpoint() is None
+
+    def detected(invoice):
+        return AIProcessingResult.objects.filter(invoice=invoice).latest("id").anomalies_detected
+
+    duplicate_findings = detected(duplicate)
+    assert duplicate_findings[0] == {"type": "timing_anomaly"}
+    assert duplicate_findings[1]["type"] == "duplicate_invoice"
+    assert duplicate_findings[1]["duplicate_of"] == original.id
+    assert [a["type"] for a in detected(big)] == ["high_amount"]
+    assert not AIProcessingResult.objects.filter(invoice=original).exists()
+
+    # Re-running replaces sweep findings instead of appending them again
+    detect_anomalies(chunk_size=3)
+    assert detected(duplicate) == duplicate_findings
+    assert AIProcessingResult.objects.filter(invoice=big).count() == 1
+
+
+@pytest.mark.django_db
+def test_ai_pipeline_writes_invoice_once(default_user, django_capture_on_commit_callbacks):
+    import asyncio
+    from asgiref.sync import async_to_sync
+    from channels.layers import get_channel_layer
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    from .tasks import process_invoice_ai_pipeline
+
+    # Changes priority, assignee and both score columns
+    invoice = make_invoice(default_user, "UOW-1", "9000", current_service="FIN", priority=Invoice.Priority.LOW,
+                           due_date=date.today())
+    channel_layer = get_channel_layer()
+    channel = async_to_sync(channel_layer.new_channel)()
+    async_to_sync(channel_layer.group_add)("invoice_updates", channel)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        with CaptureQueriesContext(connection) as queries:
+            assert process_invoice_ai_pipeline(invoice.id)["success"]
+    updates = [q["sql"] for q in queries if q["sql"].startswith('UPDATE "invoice_invoice"')]
+    assert len(updates) == 1
+
+    invoice.refresh_from_db()
+    assert invoice.assigned_to_id == default_user.id
+    assert invoice.ai_priority_score is not None and invoice.ai_risk_score is not None
+
+    event = async_to_sync(channel_layer.receive)(channel)
+    assert event["type"] == "invoice_updated"
+    assert {"priority", "assigned_to", "ai_priority_score", "ai_risk_score"} <= set(event["changes"])
+
+    async def nothing_else():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(channel), 0.1)
+    async_to_sync(nothing_else)()
+
+
+@pytest.mark.django_db
+def test_ai_pipeline_canvas_checkpoints_and_retries_stages(default_user, monkeypatch, django_capture_on_commit_callbacks):
+    import io
+    from django.core.management import call_command
+    from invoice.service import workflow_service
+
+    from .pipeline import start_pipeline
+    from .tasks import process_invoice_ai_pipeline
+
+    calls = {"anomaly": 0, "priority": 0}
+    run_anomaly_stage = workflow_service.run_anomaly_stage
+    run_priority_stage = workflow_service.run_priority_stage
+
+    def flaky_anomaly_stage(invoice):
+        calls["anomaly"] += 1
+        if calls["anomaly"] == 1:
+            raise ConnectionError("model server unavailable")
+        return run_anomaly_stage(invoice)
+
+    def counted_priority_stage(invoice):
+        calls["priority"] += 1
+        return run_priority_stage(invoice)
+
+    monkeypatch.setattr(workflow_service, "run_anomaly_stage", flaky_anomaly_stage)
+    monkeypatch.setattr(workflow_service, "run_priority_stage", counted_priority_stage)
+
+    invoice = make_invoice(default_user, "CV-1", "9000", current_service="FIN", priority=Invoice.Priority.LOW)
+    # The canvas is dispatched once the reset result row commits
+    with django_capture_on_commit_callbacks() as callbacks:
+        start_pipeline(invoice.id)
+    assert calls == {"anomaly": 0, "priority": 0} and len(callbacks) == 1
+    callbacks[0]()
+
+    # Only the failed stage ran again
+    assert calls == {"anomaly": 2, "priority": 1}
+    result = invoice.ai_results.get()
+    assert result.processing_status == "completed"
+    assert result.pipeline_mode == "canvas"
+    assert set(result.stage_outputs) == {"ocr", "anomaly", "priority", "routing"}
+    assert result.processing_time_ms is not None
+    invoice.refresh_from_db()
+    assert invoice.assigned_to_id == default_user.id
+    assert invoice.ai_risk_score is not None
+
+    # Resuming a finished run reuses every checkpoint
+    with django_capture_on_commit_callbacks(execute=True):
+        start_pipeline(invoice.id, resume=True)
+    assert calls == {"anomaly": 2, "priority": 1}
+
+    # A stage that keeps failing marks the run failed once its retries run out
+    monkeypatch.setattr(workflow_service, "run_priority_stage", lambda invoice: 1 / 0)
+    with pytest.raises(ZeroDivisionError):  # eager retries re-raise the final error
+        with django_capture_on_commit_callbacks(execute=True):
+            start_pipeline(invoice.id)
+    result.refresh_from_db()
+    assert result.processing_status == "failed"
+    assert result.error_message.startswith("ai_pipeline_priority")
+
+    # Latency of both modes lands in the same column for comparison
+    monkeypatch.setattr(workflow_service, "run_priority_stage", run_priority_stage)
+    assert process_invoice_ai_pipeline(invoice.id)["success"]
+    with django_capture_on_commit_callbacks(execute=True):
+        start_pipeline(make_invoice(default_user, "CV-2", "100", current_service="FIN").id)
+    out = io.StringIO()
+    call_command("ai_pipeline_latency", stdout=out)
+    assert "Canvas p50 is" in out.getvalue()
+
+
+@pytest.mark.django_db
+def test_bulk_ai_processing_in_chunks_reports_batch_progress(
+    default_user, django_capture_on_commit_callbacks, django_assert_num_queries,
+):
+    import asyncio
+    from asgiref.sync import async_to_sync
+    from channels.layers import get_channel_layer
+    from rest_framework.test import APIClient
+    from invoice.approver_load import approver_loads
+    from invoice.service import SharedLookups, workflow_service
+
+    invoices = [
+        make_invoice(default_user, f"BT-{i}", str(100 * (i + 1)), vendor_name=f"Vendor {i % 2}", current_service="FIN")
+        for i in range(5)
+    ]
+
+    # One read each for features, vendor profiles, services and approvers; none per invoice after that
+    approver_loads.reconcile()
+    with django_assert_num_queries(4):
+        lookups = SharedLookups.load(invoices)
+    with django_assert_num_queries(0):
+        data = workflow_service._invoice_to_dict(invoices[0], lookups)
+    assert data["features"] is not None and data["vendor_profile"].display_name == "Vendor 0"
+
+    channel_layer = get_channel_layer()
+    channel = async_to_sync(channel_layer.new_channel)()
+    async_to_sync(channel_layer.group_add)("invoice_updates", channel)
+
+    client = APIClient()
+    client.force_authenticate(default_user)
+    with django_capture_on_commit_callbacks(execute=True):
+        response = client.post(
+            "/api/invoices/bulk-ai-process/",
+            {"invoice_ids": [invoice.id for invoice in invoices] + [999999], "chunk_size": 2},
+            format="json",
+        )
+    assert response.status_code == 202
+    assert response.data["chunks"] == 3
+    batch_id = response.data["batch_id"]
+
+    progress = client.get(f"/api/invoices/bulk-ai-process/{batch_id}/").data
+    assert progress["total"] == 5 and progress["completed"] == 5 and progress["failed"] == 0
+    assert progress["finished"]
+    assert all(invoice.ai_results.get().processing_status == "completed" for invoice in invoices)
+
+    async def drain():
+        events = []
+        while True:
+            try:
+                events.append(await asyncio.wait_for(channel_layer.receive(channel), 0.1))
+            except asyncio.TimeoutError:
+                return events
+    batch_events = [event["batch"] for event in async_to_sync(drain)() if event["type"] == "ai_batch_progress"]
+    assert [event["completed"] for event in batch_events] == [2, 4, 5]
+    assert batch_events[-1]["finished"]
+
+    assert client.get("/api/invoices/bulk-ai-process/not-a-batch/").status_code == 404
+    assert client.get("/api/invoices/bulk-ai-process/deadbeef-0/").status_code == 404
+    empty = client.post("/api/invoices/bulk-ai-process/", {"invoice_ids": [999999]}, format="json")
+    assert empty.status_code == 400
+    for bad_ids in (["abc"], "1,2", {"id": 1}):
+        response = client.post("/api/invoices/bulk-ai-process/", {"invoice_ids": bad_ids}, format="json")
+        assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_bulk_ai_chunk_writes_history_with_each_invoice(default_user, monkeypatch):
+    from invoice.history import record_history
+    from invoice.models import InvoiceHistory
+    from invoice.service import workflow_service
+    from .batch_processing import process_chunk
+    from .models import AIProcessingBatch
+
+    good = make_invoice(default_user, "HB-1", "100")
+    bad = make_invoice(default_user, "HB-2", "200")
+    batch = AIProcessingBatch.objects.create(total=2, chunk_size=2)
+    process = workflow_service.process_new_invoice
+
+    def flaky(invoice, unit_of_work=None, lookups=None):
+        record_history(invoice.id, "Stage note", InvoiceHistory.ActionType.SYSTEM_ACTION)
+        if invoice.id == bad.id:
+            raise RuntimeError("model unavailable")
+        return process(invoice, unit_of_work, lookups)
+
+    monkeypatch.setattr(workflow_service, "process_new_invoice", flaky)
+    InvoiceHistory.objects.all().delete()
+    assert process_chunk(str(batch.id), [good.id, bad.id]) == {"completed": 1, "failed": 1}
+    assert InvoiceHistory.objects.filter(invoice=good, action="Stage note").exists()
+    assert not InvoiceHistory.objects.filter(invoice=bad).exists()
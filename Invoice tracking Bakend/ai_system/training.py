@@ -0,0 +1,196 @@
+"""
+Training of the payment-delay model from paid invoice history.
+
+Paid invoices are streamed by primary key with values_list, so no model instances
+are built and only one chunk of rows is alive at a time. Features come from the
+shared feature store in the same layout the scorer uses, with two properties that
+avoid leaking the label:
+  - days until due is measured from the invoice date, i.e. what was known at receipt
+    (feature_store.payment_delay_training_matrix)
+  - the stored vendor on-time rate already leaves the invoice itself out of its
+    vendor's profile
+The label is 1 when payment_date is after due_date.
+
+Features are accumulated as float32 arrays (16 bytes per invoice), the model is
+cross-validated with stratified folds, refitted on all rows and published to the
+model registry together with a JSON report. The anomaly model (fit_anomaly_model)
+is published the same way.
+"""
+import logging
+import time
+from typing import Any, Dict, Optional
+
+import numpy as np
+from django.utils import timezone
+from sklearn.ensemble import HistGradientBoostingClassifier, IsolationForest
+from sklearn.model_selection import StratifiedKFold, cross_validate
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+from invoice.models import Invoice
+from . import anomaly_scoring
+from .feature_store import load_matrix, payment_delay_training_matrix
+from .model_registry import ANOMALY_MODEL, PAYMENT_DELAY_MODEL, model_registry
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+FEATURE_NAMES = ['amount_scaled', 'days_until_due', 'vendor_on_time_rate', 'service_factor']
+CV_METRICS = {'roc_auc': 'roc_auc', 'accuracy': 'accuracy', 'brier': 'neg_brier_score'}
+
+
+class TrainingError(Exception):
+    pass
+
+
+def iter_training_chunks(chunk_size: int = 50000):
+    """Yield (features, labels) arrays for paid invoices, one pk-ordered chunk at a time."""
+    queryset = Invoice.objects.filter(
+        status=Invoice.Status.PAID,
+        payment_date__isnull=False,
+        due_date__isnull=False,
+        invoice_date__isnull=False,
+    )
+    last_id = 0
+    while True:
+        rows = list(
+            queryset.filter(id__gt=last_id).order_by('id')
+            .values_list('id', 'due_date', 'payment_date')[:chunk_size]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        ids, due_dates, payment_dates = zip(*rows)
+
+        labels = np.array([paid > due for paid, due in zip(payment_dates, due_dates)], dtype=np.int8)
+        features = payment_delay_training_matrix(load_matrix(ids))
+        yield features.astype(np.float32), labels
+
+
+def train_payment_delay_model(chunk_size: int = 50000, folds: int = 5, min_rows: int = 50,
+                              publish: bool = True) -> Dict[str, Any]:
+    """Train, cross-validate and (optionally) publish a new payment-delay model; returns the report."""
+    started = time.monotonic()
+    feature_chunks, label_chunks = [], []
+    for features, labels in iter_training_chunks(chunk_size):
+        feature_chunks.append(features)
+        label_chunks.append(labels)
+    if not feature_chunks:
+        raise TrainingError("No paid invoices with payment and due dates to train on")
+    X = np.concatenate(feature_chunks)
+    y = np.concatenate(label_chunks)
+    del feature_chunks, label_chunks
+    load_seconds = time.monotonic() - started
+
+    if len(y) < min_rows:
+        raise TrainingError(f"Only {len(y)} training rows, need at least {min_rows}")
+    smallest_class = int(min(np.bincount(y, minlength=2)))
+    folds = min(folds, smallest_class)
+    if folds < 2:
+        raise TrainingError("Need at least two late and two on-time payments to cross-validate")
+
+    model = HistGradientBoostingClassifier(max_iter=200, learning_rate=0.1, random_state=42)
+    scores = cross_validate(
+        model, X, y,
+        cv=StratifiedKFold(n_splits=folds, shuffle=True, random_state=42),
+        scoring=CV_METRICS,
+    )
+    metrics = {
+        name: round(float(np.mean(scores[f'test_{name}'])) * (-1 if name == 'brier' else 1), 4)
+        for name in CV_METRICS
+    }
+    model.fit(X, y)
+
+    report = {
+        'model': PAYMENT_DELAY_MODEL,
+        'version': None,
+        'rows': int(len(y)),
+        'late_rate': round(float(y.mean()), 4),
+        'features': FEATURE_NAMES,
+        'folds': folds,
+        'metrics': metrics,
+        'load_seconds': round(load_seconds, 2),
+        'training_seconds': round(time.monotonic() - started, 2),
+        'peak_memory_mb': _peak_memory_mb(),
+        'trained_at': timezone.now().isoformat(),
+    }
+    if publish:
+        model_registry.publish(PAYMENT_DELAY_MODEL, model, report=report)
+    logger.info(f"Trained {PAYMENT_DELAY_MODEL} on {report['rows']} rows: {metrics}")
+    return report
+
+
+def _peak_memory_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    # ru_maxrss is reported in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def fit_anomaly_model(chunk_size: int = 50000, max_fit_rows: int = 200000, min_rows: int = 50,
+                      publish: bool = True) -> Dict[str, Any]:
+    """
+    Fit the StandardScaler + IsolationForest pipeline on the invoice corpus.
+    Each tree only looks at 256 samples, so at most max_fit_rows random rows are used.
+    """
+    started = time.monotonic()
+    X = np.concatenate([
+        features.astype(np.float32) for _, features in anomaly_scoring.iter_anomaly_features(chunk_size=chunk_size)
+    ] or [np.empty((0, len(anomaly_scoring.FEATURE_NAMES)), dtype=np.float32)])
+    load_seconds = time.monotonic() - started
+    if len(X) < min_rows:
+        raise TrainingError(f"Only {len(X)} invoices, need at least {min_rows} to fit the anomaly model")
+    if len(X) > max_fit_rows:
+        X = X[np.random.RandomState(42).choice(len(X), max_fit_rows, replace=False)]
+
+    fit_started = time.monotonic()
+    model = make_pipeline(
+        StandardScaler(),
+        IsolationForest(n_estimators=200, contamination='auto', random_state=42),
+    )
+    model.fit(X)
+    fit_seconds = time.monotonic() - fit_started
+
+    scores = anomaly_scoring.to_anomaly_scores(model, X)
+    report = {
+        'model': ANOMALY_MODEL,
+        'version': None,
+        'rows': int(len(X)),
+        'features': anomaly_scoring.FEATURE_NAMES,
+        'metrics': {
+            'mean_score': round(float(scores.mean()), 2),
+            'p99_score': round(float(np.percentile(scores, 99)), 2),
+        },
+        'load_seconds': round(load_seconds, 2),
+        'fit_seconds': round(fit_seconds, 2),
+        'training_seconds': round(time.monotonic() - started, 2),
+        'peak_memory_mb': _peak_memory_mb(),
+        'trained_at': timezone.now().isoformat(),
+    }
+    if publish:
+        model_registry.publish(ANOMALY_MODEL, model, report=report)
+    logger.info(f"Fitted {ANOMALY_MODEL} on {report['rows']} rows in {report['fit_seconds']}s")
+    return report
+
+
+def train_models(model: Optional[str] = None, chunk_size: int = 50000, folds: int = 5,
+                 publish: bool = True) -> Dict[str, Dict[str, Any]]:
+    """Train every known model (or just `model`); failures are reported, not raised."""
+    trainers = {
+        PAYMENT_DELAY_MODEL: lambda: train_payment_delay_model(chunk_size=chunk_size, folds=folds, publish=publish),
+        ANOMALY_MODEL: lambda: fit_anomaly_model(chunk_size=chunk_size, publish=publish),
+    }
+    reports = {}
+    for name, trainer in trainers.items():
+        if model and name != model:
+            continue
+        try:
+            reports[name] = trainer()
+        except TrainingError as e:
+            logger.warning(f"Skipped training {name}: {e}")
+            reports[name] = {'model': name, 'error': str(e)}
+    return reports
@@ -0,0 +1,186 @@
+"""
+Incremental maintenance of VendorProfile rows.
+
+Every invoice contributes (vendor_key, amount, paid, paid_on_time, invoice_date) to
+its vendor's profile. When an invoice is saved or deleted the old contribution is
+removed and the new one added, each under a row lock, so profiles stay exact
+without rescanning the invoice table.
+"""
+import logging
+import re
+import unicodedata
+from collections import namedtuple
+from typing import Optional
+
+from django.db import transaction
+from django.db.models import Avg, Count, F, Max, Min, Q, Variance
+
+from invoice.models import Invoice
+from .models import VendorProfile
+
+logger = logging.getLogger(__name__)
+
+TRACKED_FIELDS = (
+    'vendor_name', 'number', 'total_amount', 'subtotal', 'tax_amount', 'status', 'payment_date', 'due_date',
+    'invoice_date', 'current_service', 'raw_text',
+)
+LEGAL_SUFFIXES = {
+    'inc', 'incorporated', 'ltd', 'limited', 'llc', 'corp', 'corporation', 'co', 'company',
+    'sa', 'sarl', 'sas', 'gmbh', 'plc', 'bv', 'nv', 'ag',
+}
+
+Contribution = namedtuple('Contribution', 'vendor_key display_name amount paid on_time invoice_date')
+
+
+def normalize_vendor_key(name: str) -> str:
+    """Case-, accent- and punctuation-insensitive vendor key without legal suffixes."""
+    if not name:
+        return ''
+    text = unicodedata.normalize('NFKD', name)
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch)).casefold()
+    tokens = re.findall(r'[a-z0-9]+', text)
+    while len(tokens) > 1 and tokens[-1] in LEGAL_SUFFIXES:
+        tokens.pop()
+    return ' '.join(tokens)
+
+
+def snapshot(invoice: Invoice) -> Optional[dict]:
+    """Tracked field values as loaded; None when any of them is deferred."""
+    values = invoice.__dict__
+    if any(field not in values for field in TRACKED_FIELDS):
+        return None
+    return {field: values[field] for field in TRACKED_FIELDS}
+
+
+def saved_values(invoice: Invoice, previous: Optional[dict], update_fields=None) -> Optional[dict]:
+    """
+    Tracked field values after a save: the previous row overlaid with the tracked
+    fields the instance had loaded and wrote. None when it wrote none of them.
+    """
+    written = [field for field in TRACKED_FIELDS if field in invoice.__dict__]
+    if update_fields is not None:
+        written = [field for field in written if field in update_fields]
+    if previous is None:
+        return snapshot(invoice)
+    if not written:
+        return None
+    return {**previous, **{field: invoice.__dict__[field] for field in written}}
+
+
+def contribution(values: Optional[dict]) -> Optional[Contribution]:
+    if not values or not values.get('vendor_name') or values.get('total_amount') is None:
+        return None
+    # Unsaved-then-saved instances may still hold the raw (string) values they were built with
+    payment_date, due_date, invoice_date = (
+        Invoice._meta.get_field(field).to_python(values[field])
+        for field in ('payment_date', 'due_date', 'invoice_date')
+    )
+    paid = values['status'] == Invoice.Status.PAID
+    on_time = bool(paid and payment_date and due_date and payment_date <= due_date)
+    return Contribution(
+        vendor_key=normalize_vendor_key(values['vendor_name']),
+        display_name=values['vendor_name'],
+        amount=float(values['total_amount']),
+        paid=paid,
+        on_time=on_time,
+        invoice_date=invoice_date,
+    )
+
+
+def get_vendor_profile(vendor_name: str) -> Optional[VendorProfile]:
+    """Single indexed lookup on the normalized vendor key."""
+    key = normalize_vendor_key(vendor_name)
+    if not key:
+        return None
+    return VendorProfile.objects.filter(vendor_key=key).first()
+
+
+def apply_invoice_change(old: Optional[Contribution], new: Optional[Contribution]):
+    """Move an invoice's contribution from `old` to `new` (either may be None)."""
+    if old == new:
+        return
+    with transaction.atomic():
+        keys = {c.vendor_key for c in (old, new) if c and c.vendor_key}
+        profiles = {
+            p.vendor_key: p
+            for p in VendorProfile.objects.select_for_update().filter(vendor_key__in=keys)
+        }
+        if old and old.vendor_key in profiles:
+            profile = profiles[old.vendor_key]
+            profile.remove_amount(old.amount)
+            profile.paid_count -= int(old.paid)
+            profile.paid_on_time_count -= int(old.on_time)
+        if new and new.vendor_key:
+            profile = profiles.get(new.vendor_key)
+            if profile is None:
+                profile = VendorProfile(vendor_key=new.vendor_key, display_name=new.display_name)
+                profiles[new.vendor_key] = profile
+            profile.add_amount(new.amount)
+            profile.paid_count += int(new.paid)
+            profile.paid_on_time_count += int(new.on_time)
+            if new.invoice_date and (profile.last_seen is None or new.invoice_date > profile.last_seen):
+                profile.last_seen = new.invoice_date
+        for profile in profiles.values():
+            profile.save()
+
+
+def rebuild_vendor_profiles() -> int:
+    """
+    Recompute every profile from scratch with one grouped query.
+    Raw vendor names sharing a normalized key are merged with the parallel
+    (Chan et al.) combination of count/mean/m2.
+    """
+    rows = (Invoice.objects.values('vendor_name')
+            .annotate(
+                count=Count('id'),
+                mean=Avg('total_amount'),
+                var=Variance('total_amount'),
+                min_amount=Min('total_amount'),
+                max_amount=Max('total_amount'),
+                paid=Count('id', filter=Q(status=Invoice.Status.PAID)),
+                on_time=Count('id', filter=Q(status=Invoice.Status.PAID, payment_date__lte=F('due_date'))),
+                last_seen=Max('invoice_date'),
+            )
+            .order_by())
+
+    merged = {}
+    for row in rows:
+        key = normalize_vendor_key(row['vendor_name'])
+        if not key:
+            continue
+        count = row['count']
+        mean = float(row['mean'] or 0)
+        m2 = float(row['var'] or 0) * count
+        profile = merged.get(key)
+        if profile is None:
+            merged[key] = VendorProfile(
+                vendor_key=key,
+                display_name=row['vendor_name'],
+                invoice_count=count,
+                mean_amount=mean,
+                m2_amount=m2,
+                min_amount=float(row['min_amount']) if row['min_amount'] is not None else None,
+                max_amount=float(row['max_amount']) if row['max_amount'] is not None else None,
+                paid_count=row['paid'],
+                paid_on_time_count=row['on_time'],
+                last_seen=row['last_seen'],
+            )
+            continue
+        total = profile.invoice_count + count
+        delta = mean - profile.mean_amount
+        profile.m2_amount += m2 + delta * delta * profile.invoice_count * count / total
+        profile.mean_amount += delta * count / total
+        profile.invoice_count = total
+        if row['min_amount'] is not None:
+            profile.min_amount = min(profile.min_amount, float(row['min_amount']))
+            profile.max_amount = max(profile.max_amount, float(row['max_amount']))
+        profile.paid_count += row['paid']
+        profile.paid_on_time_count += row['on_time']
+        if row['last_seen'] and (profile.last_seen is None or row['last_seen'] > profile.last_seen):
+            profile.last_seen = row['last_seen']
+
+    with transaction.atomic():
+        VendorProfile.objects.all().delete()
+        VendorProfile.objects.bulk_create(merged.values(), batch_size=1000)
+    logger.info(f"Rebuilt {len(merged)} vendor profiles")
+    return len(merged)
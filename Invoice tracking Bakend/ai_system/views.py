@@ -10,6 +10,7 @@ from django.utils import timezone
 from datetime import datetime, timedelta
 from .models import AIProcessingResult
 from invoice.models import Invoice
+from invoice.analytics_utils import spending_patterns
 # Create your views here.
 
 class AIAnalyticsViewSet(viewsets.ViewSet):
@@ -62,56 +63,13 @@ class AIAnalyticsViewSet(viewsets.ViewSet):
     def analyze_spending_patterns(self, request):
         """Analyze spending patterns using AI"""
         try:
-            time_range = request.data.get('time_range', 'month')
-            service_filter = request.data.get('service', None)
-            
-            # Calculate date range
-            if time_range == 'week':
-                start_date = timezone.now().date() - timedelta(days=7)
-            elif time_range == 'month':
-                start_date = timezone.now().date() - timedelta(days=30)
-            elif time_range == 'quarter':
-                start_date = timezone.now().date() - timedelta(days=90)
-            else:
-                start_date = timezone.now().date() - timedelta(days=365)
-            
-            # Build query
-            query = Q(
-                status='paid',
-                payment_date__gte=start_date
+            data = spending_patterns(
+                time_range=request.data.get('time_range', 'month'),
+                service=request.data.get('service', None)
             )
             
-            if service_filter:
-                query &= Q(current_service=service_filter)
-            
-            # Get spending data
-            spending_data = Invoice.objects.filter(query).aggregate(
-                total_amount=Sum('total_amount'),
-                avg_amount=Avg('total_amount'),
-                invoice_count=Count('id')
-            )
-            
-            # Vendor analysis
-            top_vendors = Invoice.objects.filter(query).values(
-                'vendor_name'
-            ).annotate(
-                total_spent=Sum('total_amount'),
-                invoice_count=Count('id')
-            ).order_by('-total_spent')[:10]
-            
-            # Service analysis
-            service_breakdown = Invoice.objects.filter(query).values(
-                'current_service__name'
-            ).annotate(
-                total_spent=Sum('total_amount'),
-                invoice_count=Count('id')
-            ).order_by('-total_spent')
-            
             return Response({
-                "time_range": time_range,
-                "spending_summary": spending_data,
-                "top_vendors": list(top_vendors),
-                "service_breakdown": list(service_breakdown),
+                **data,
                 "analysis_date": timezone.now().isoformat()
             })
             
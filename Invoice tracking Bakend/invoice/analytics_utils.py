@@ -1,5 +1,6 @@
 # invoices/analytics_utils.py
-from django.db.models import Sum, Value, F
+from django.core.cache import cache
+from django.db.models import Count, Sum, Value, F, Q
 from django.db.models.functions import Coalesce, TruncMonth
 from django.utils import timezone
 from datetime import timedelta, date
@@ -24,7 +25,7 @@ def monthly_totals_last_n_months(months=6):
     qs = Invoice.objects.filter(invoice_date__gte=start_month)
     qs = qs.annotate(month=TruncMonth('invoice_date')).annotate(value=Coalesce('base_currency_amount', 'total_amount'))
     monthly = (qs.values('month')
-                 .annotate(total=Coalesce(Sum('value'), 0))
+                 .annotate(total=Coalesce(Sum('value'), Decimal('0')))
                  .order_by('month'))
     # Convert to list of dicts
     result = []
@@ -57,25 +58,154 @@ def monthly_growth_percentage(monthly_list):
 def top_vendors(limit=5):
     qs = Invoice.objects.all().annotate(value=Coalesce('base_currency_amount', 'total_amount'))
     vendors = (qs.values('vendor_name')
-               .annotate(total=Coalesce(Sum('value'), 0))
+               .annotate(total=Coalesce(Sum('value'), Decimal('0')))
                .order_by('-total')[:limit])
     return [{'vendor_name': v['vendor_name'], 'total': float(v['total'] or 0)} for v in vendors]
 
-def risk_alerts(threshold=0.8, limit=20):
+def risk_alerts(threshold=0.8, limit=20, after=None):
     """
-    returns invoices with ai_risk_score >= threshold, sorted desc
+    returns invoices with ai_risk_score >= threshold, sorted desc.
+    `after` is the (ai_risk_score, id) of the last row already returned; the next
+    page continues from there on the (ai_risk_score, id) index instead of using OFFSET.
     """
-    qs = Invoice.objects.filter(ai_risk_score__gte=threshold).order_by('-ai_risk_score')[:limit]
+    qs = Invoice.objects.filter(ai_risk_score__gte=threshold)
+    if after is not None:
+        after_score, after_id = after
+        qs = qs.filter(Q(ai_risk_score__lt=after_score) | Q(ai_risk_score=after_score, id__lt=after_id))
+    rows = qs.order_by('-ai_risk_score', '-id').values(
+        'id', 'vendor_name', 'number', 'total_amount', 'base_currency_amount',
+        'ai_risk_score', 'due_date', 'status'
+    )[:limit]
     # Return minimal fields for alerting
     return [
         {
-            'id': inv.id,
-            'vendor_name': inv.vendor_name,
-            'number': inv.number,
-            'total_amount': float((inv.base_currency_amount or inv.total_amount) or 0),
-            'ai_risk_score': float(inv.ai_risk_score or 0),
-            'due_date': inv.due_date.isoformat() if inv.due_date else None,
-            'status': inv.status
+            'id': row['id'],
+            'vendor_name': row['vendor_name'],
+            'number': row['number'],
+            'total_amount': float((row['base_currency_amount'] or row['total_amount']) or 0),
+            'ai_risk_score': float(row['ai_risk_score'] or 0),
+            'due_date': row['due_date'].isoformat() if row['due_date'] else None,
+            'status': row['status']
         }
-        for inv in qs
+        for row in rows
     ]
+
+
+SPENDING_TIME_RANGES = {'week': 7, 'month': 30, 'quarter': 90, 'year': 365}
+ANALYTICS_VERSION_KEY = "analytics:rollup_version"
+SPENDING_CACHE_PREFIX = "analytics:spending"
+SPENDING_CACHE_TTL = 60 * 30
+
+
+def rollup_version():
+    """Current analytics rollup version; bumped after every analytics refresh."""
+    version = cache.get(ANALYTICS_VERSION_KEY)
+    if version is None:
+        version = 1
+        cache.add(ANALYTICS_VERSION_KEY, version, None)
+    return version
+
+
+def bump_rollup_version():
+    try:
+        return cache.incr(ANALYTICS_VERSION_KEY)
+    except ValueError:
+        cache.set(ANALYTICS_VERSION_KEY, 2, None)
+        return 2
+
+
+def normalize_spending_params(time_range, service):
+    time_range = (time_range or 'month').strip().lower()
+    if time_range not in SPENDING_TIME_RANGES:
+        time_range = 'year'
+    service = (service or '').strip() or None
+    start_date = timezone.localdate() - timedelta(days=SPENDING_TIME_RANGES[time_range])
+    return time_range, service, start_date
+
+
+def spending_cache_key(time_range, service, start_date, version=None):
+    version = rollup_version() if version is None else version
+    return f"{SPENDING_CACHE_PREFIX}:v{version}:{time_range}:{start_date.isoformat()}:{service or '*'}"
+
+
+def _spending_rows(start_date):
+    """
+    One grouped query at the finest grain (vendor, service). The summary, vendor and
+    service rollups are derived from these rows, GROUPING SETS style, instead of
+    issuing three separate aggregate queries.
+    """
+    return list(
+        Invoice.objects.filter(status=Invoice.Status.PAID, payment_date__gte=start_date)
+        .values('vendor_name', 'current_service')
+        .annotate(total=Sum('total_amount'), count=Count('id'))
+        .order_by()
+    )
+
+
+def _rollup_spending(rows, time_range, service):
+    total = Decimal('0')
+    count = 0
+    vendors = {}
+    services = {}
+    for row in rows:
+        if service and row['current_service'] != service:
+            continue
+        row_total = row['total'] or Decimal('0')
+        total += row_total
+        count += row['count']
+        vendor = vendors.setdefault(row['vendor_name'], [Decimal('0'), 0])
+        vendor[0] += row_total
+        vendor[1] += row['count']
+        svc = services.setdefault(row['current_service'], [Decimal('0'), 0])
+        svc[0] += row_total
+        svc[1] += row['count']
+
+    top = sorted(vendors.items(), key=lambda item: item[1][0], reverse=True)[:10]
+    breakdown = sorted(services.items(), key=lambda item: item[1][0], reverse=True)
+    return {
+        'time_range': time_range,
+        'spending_summary': {
+            'total_amount': float(total) if count else None,
+            'avg_amount': float(total / count) if count else None,
+            'invoice_count': count,
+        },
+        'top_vendors': [
+            {'vendor_name': name, 'total_spent': float(t), 'invoice_count': c} for name, (t, c) in top
+        ],
+        'service_breakdown': [
+            {'current_service': name, 'total_spent': float(t), 'invoice_count': c} for name, (t, c) in breakdown
+        ],
+    }
+
+
+def spending_patterns(time_range='month', service=None):
+    """
+    Cached spending summary, top vendors and service breakdown.
+    Keyed on the normalized parameters and the rollup version.
+    """
+    time_range, service, start_date = normalize_spending_params(time_range, service)
+    key = spending_cache_key(time_range, service, start_date)
+    data = cache.get(key)
+    if data is None:
+        data = _rollup_spending(_spending_rows(start_date), time_range, service)
+        cache.set(key, data, SPENDING_CACHE_TTL)
+    return data
+
+
+def prewarm_spending_patterns():
+    """
+    Fill the spending cache for every time range, both unfiltered and per service.
+    Each time range costs one query; the per-service entries reuse its rows.
+    """
+    version = rollup_version()
+    warmed = 0
+    for time_range in SPENDING_TIME_RANGES:
+        _, _, start_date = normalize_spending_params(time_range, None)
+        rows = _spending_rows(start_date)
+        entries = {}
+        for service in [None] + sorted({row['current_service'] for row in rows}):
+            key = spending_cache_key(time_range, service, start_date, version)
+            entries[key] = _rollup_spending(rows, time_range, service)
+        cache.set_many(entries, SPENDING_CACHE_TTL)
+        warmed += len(entries)
+    return warmed
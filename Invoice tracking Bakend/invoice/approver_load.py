@@ -0,0 +1,196 @@
+"""
+Approver load index: open invoice assignments per approver, per service.
+
+Each service keeps two min-heaps of (open assignments, last login, user id): one
+for managers/admins (high priority or large invoices) and one for every approver
+role. Picking the least-loaded approver pops stale heap entries and peeks the top,
+O(log n) amortized with no database access. Loads are adjusted from invoice
+post_save/post_delete as assignments and statuses change; every change pushes a
+fresh entry and older entries for that user are skipped when they surface.
+
+Writes that bypass signals (QuerySet.update) call invalidate(), and the whole
+index is rebuilt from the database at most every RECONCILE_INTERVAL seconds, so
+drift from other processes is bounded.
+"""
+import heapq
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from django.contrib.auth import get_user_model
+from django.db.models import Count
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from departments.models import Service
+from .models import Invoice
+
+logger = logging.getLogger(__name__)
+
+MANAGER_ROLES = ('manager', 'admin')
+APPROVER_ROLES = ('manager', 'admin', 'approver')
+# Statuses in which an assigned invoice is still waiting on its assignee
+OPEN_STATUSES = (
+    Invoice.Status.DRAFT, Invoice.Status.PENDING_REVIEW, Invoice.Status.PENDING_APPROVAL, Invoice.Status.TRANSFERRED,
+)
+RECONCILE_INTERVAL = 300
+
+
+@dataclass(frozen=True)
+class Approver:
+    id: object
+    name: str
+    service_id: int
+    role: str
+    last_login: float
+
+
+class ApproverLoadIndex:
+    def __init__(self, reconcile_interval: float = RECONCILE_INTERVAL):
+        self.reconcile_interval = reconcile_interval
+        self._lock = threading.RLock()
+        self._loaded_at: Optional[float] = None
+        self._approvers: Dict[object, Approver] = {}
+        self._loads: Dict[object, int] = {}
+        self._heaps: Dict[Tuple[int, bool], List[tuple]] = {}
+        self._services: Dict[str, int] = {}
+
+    # Building
+
+    def _rebuild(self):
+        User = get_user_model()
+        services = list(Service.objects.values_list('id', 'code', 'name'))
+        # Codes are unique, so they win over a clashing name
+        self._services = {name.lower(): service_id for service_id, _, name in services if name}
+        self._services.update((code.lower(), service_id) for service_id, code, _ in services if code)
+
+        self._approvers = {
+            # Ties go to the least recent login, never-logged-in users last (as order_by('last_login') did)
+            user_id: Approver(user_id, name, service_id, role,
+                              last_login.timestamp() if last_login else float('inf'))
+            for user_id, name, service_id, role, last_login in User.objects.filter(
+                is_active=True, role__in=APPROVER_ROLES,
+            ).values_list('id', 'name', 'service_id', 'role', 'last_login')
+        }
+        self._loads = dict.fromkeys(self._approvers, 0)
+        for user_id, count in (Invoice.objects.filter(assigned_to__in=list(self._approvers), status__in=OPEN_STATUSES)
+                               .values('assigned_to').annotate(count=Count('id'))
+                               .values_list('assigned_to', 'count')):
+            self._loads[user_id] = count
+
+        self._heaps = {}
+        for approver in self._approvers.values():
+            for key in self._heap_keys(approver):
+                self._heaps.setdefault(key, []).append(self._entry(approver.id))
+        for heap in self._heaps.values():
+            heapq.heapify(heap)
+        self._loaded_at = time.monotonic()
+
+    def _heap_keys(self, approver: Approver) -> List[Tuple[int, bool]]:
+        keys = [(approver.service_id, False)]
+        if approver.role in MANAGER_ROLES:
+            keys.append((approver.service_id, True))
+        return keys
+
+    def _entry(self, user_id) -> tuple:
+        approver = self._approvers[user_id]
+        return self._loads[user_id], approver.last_login, user_id
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.reconcile_interval:
+            self._rebuild()
+
+    # Queries
+
+    def service_id_for(self, current_service) -> Optional[int]:
+        """Service id for an invoice's current_service (name or code, any case)."""
+        with self._lock:
+            self._ensure_loaded()
+            return self._services.get(str(current_service or '').lower())
+
+    def least_loaded(self, service_id: int, managers_only: bool = False) -> Optional[Approver]:
+        with self._lock:
+            self._ensure_loaded()
+            heap = self._heaps.get((service_id, managers_only))
+            while heap:
+                user_id = heap[0][2]
+                if user_id in self._approvers and self._entry(user_id) == heap[0]:
+                    return self._approvers[user_id]
+                heapq.heappop(heap)  # superseded by a newer entry for this user
+            return None
+
+    def load(self, user_id) -> int:
+        with self._lock:
+            self._ensure_loaded()
+            return self._loads.get(user_id, 0)
+
+    # Updates
+
+    def adjust(self, user_id, delta: int):
+        with self._lock:
+            if self._loaded_at is None or user_id not in self._approvers:
+                return
+            self._loads[user_id] = max(self._loads[user_id] + delta, 0)
+            entry = self._entry(user_id)
+            for key in self._heap_keys(self._approvers[user_id]):
+                heap = self._heaps.setdefault(key, [])
+                heapq.heappush(heap, entry)
+                if len(heap) > 4 * len(self._approvers) + 16:
+                    self._compact(key)
+
+    def _compact(self, key):
+        self._heaps[key] = [self._entry(a.id) for a in self._approvers.values() if key in self._heap_keys(a)]
+        heapq.heapify(self._heaps[key])
+
+    def reconcile(self):
+        """Rebuild from the database now, discarding any drift."""
+        with self._lock:
+            self._rebuild()
+
+    def invalidate(self):
+        """Rebuild on next use."""
+        with self._lock:
+            self._loaded_at = None
+
+
+approver_loads = ApproverLoadIndex()
+
+
+def _open_assignee(assigned_to_id, status):
+    return assigned_to_id if assigned_to_id and status in OPEN_STATUSES else None
+
+
+@receiver(post_init, sender=Invoice)
+def remember_assignment(sender, instance: Invoice, **kwargs):
+    instance._load_assignee = _open_assignee(instance.__dict__.get('assigned_to_id'), instance.__dict__.get('status'))
+
+
+@receiver(post_save, sender=Invoice)
+def track_assignment(sender, instance: Invoice, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    # post_init also runs for unsaved instances, whose snapshot is not in the index yet
+    previous = None if created else getattr(instance, '_load_assignee', None)
+    current = _open_assignee(instance.assigned_to_id, instance.status)
+    if previous != current:
+        if previous:
+            approver_loads.adjust(previous, -1)
+        if current:
+            approver_loads.adjust(current, +1)
+    instance._load_assignee = current
+
+
+@receiver(post_delete, sender=Invoice)
+def release_assignment(sender, instance: Invoice, **kwargs):
+    previous = getattr(instance, '_load_assignee', None)
+    if previous:
+        approver_loads.adjust(previous, -1)
+
+
+@receiver([post_save, post_delete], sender=get_user_model())
+@receiver([post_save, post_delete], sender=Service)
+def refresh_approvers(sender, **kwargs):
+    # Role, activity or service membership may have changed
+    approver_loads.invalidate()
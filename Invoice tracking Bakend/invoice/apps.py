@@ -7,3 +7,11 @@ class InvoiceConfig(AppConfig):
     def ready(self):
     # ✅ Import here to avoid "App not ready" error
         import invoice.tasks
+        # Drops the compiled workflow rule set when rules or their service links change
+        import invoice.workflow_rules  # noqa: F401
+        # Writes workflow outbox events for saved draft invoices
+        import invoice.outbox  # noqa: F401
+        # Keeps per-approver open assignment counts current
+        import invoice.approver_load  # noqa: F401
+        # Schedules due-date timers for time-triggered rules
+        import invoice.timers  # noqa: F401
@@ -0,0 +1,161 @@
+"""
+Backtesting workflow rules against historical invoices.
+
+backtest() replays a rule set (saved rules, or drafts that were never saved) over
+the invoices whose invoice_date falls in a range. Each rule's Q becomes a boolean
+annotation, so matching runs in SQL, and invoices are read as (id, total_amount,
+match flags...) tuples in keyset-paged chunks: no model instances are built and
+memory is bounded by chunk_size. An invoice counts as matched for every rule it
+satisfies and as applied for the first of them in priority order, which is where
+apply_rules_in_bulk would route it. Conditions see the invoices' current values.
+
+The returned iterator yields a progress record after each chunk and a result
+record at the end; the backtest endpoint streams them as NDJSON and the
+backtest_workflow_rules command prints them.
+"""
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from django.db.models import BooleanField, Case, Q, Value, When
+from django.utils import timezone
+
+from .models import Invoice, WorkflowRule
+from .workflow_rules import CompiledRule, RuleConditionError, compile_rule, linked_services
+
+DEFAULT_CHUNK_SIZE = 5000
+DEFAULT_SAMPLE_SIZE = 10
+DEFAULT_DAYS = 365
+DRAFT_FIELDS = ('name', 'trigger_conditions', 'action_type', 'action_parameters', 'priority', 'services')
+
+
+class BacktestError(ValueError):
+    pass
+
+
+def draft_rules(drafts: Sequence[Mapping[str, Any]]) -> Tuple[CompiledRule, ...]:
+    """
+    Compile unsaved rules, given as dicts of DRAFT_FIELDS; 'services' lists the
+    service names or codes the rule is limited to. Sorted by priority.
+    """
+    if not isinstance(drafts, (list, tuple)):
+        raise BacktestError("'rules' must be a list of rule objects")
+    compiled = []
+    for index, draft in enumerate(drafts):
+        if not isinstance(draft, Mapping):
+            raise BacktestError(f"Rule {index + 1} is not an object")
+        unknown = set(draft) - set(DRAFT_FIELDS)
+        if unknown:
+            raise BacktestError(f"Rule {index + 1} has unexpected keys {sorted(unknown)}")
+        services = draft.get('services') or []
+        if not isinstance(services, (list, tuple)):
+            raise BacktestError(f"Rule {index + 1}: 'services' must be a list")
+        try:
+            priority = int(draft.get('priority') or 0)
+        except (TypeError, ValueError):
+            raise BacktestError(f"Rule {index + 1}: 'priority' must be an integer")
+        rule = WorkflowRule(
+            name=draft.get('name') or f"Draft {index + 1}",
+            trigger_type='event',
+            trigger_conditions=draft.get('trigger_conditions'),
+            action_type=draft.get('action_type') or '',
+            action_parameters=draft.get('action_parameters'),
+            priority=priority,
+        )
+        try:
+            compiled.append(compile_rule(rule, frozenset(str(service).lower() for service in services)))
+        except RuleConditionError as e:
+            raise BacktestError(f"{rule.name}: {e}")
+    return tuple(sorted(compiled, key=lambda rule: rule.priority))
+
+
+def saved_rules(rule_ids: Iterable[int]) -> Tuple[CompiledRule, ...]:
+    """Compile saved rules (active or not) in priority order."""
+    rule_ids = set(rule_ids)
+    rules = list(WorkflowRule.objects.filter(id__in=rule_ids).order_by('priority', 'id'))
+    missing = rule_ids - {rule.id for rule in rules}
+    if missing:
+        raise BacktestError(f"Unknown workflow rules: {', '.join(map(str, sorted(missing)))}")
+    services = linked_services(rule_ids)
+    try:
+        return tuple(compile_rule(rule, services.get(rule.id, frozenset())) for rule in rules)
+    except RuleConditionError as e:
+        raise BacktestError(str(e))
+
+
+def _summaries(rules: Sequence[CompiledRule], stats: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [
+        {'id': rule.id, 'name': rule.name, 'priority': rule.priority, 'action_type': rule.action_type, **rule_stats}
+        for rule, rule_stats in zip(rules, stats)
+    ]
+
+
+def backtest(rules: Sequence[CompiledRule], date_from: Optional[date] = None, date_to: Optional[date] = None,
+             chunk_size: int = DEFAULT_CHUNK_SIZE, sample_size: int = DEFAULT_SAMPLE_SIZE) -> Iterator[Dict[str, Any]]:
+    """Validate the arguments and return the iterator of progress/result records (see module docstring)."""
+    if not rules:
+        raise BacktestError("No rules to backtest")
+    date_to = date_to or timezone.localdate()
+    date_from = date_from or date_to - timedelta(days=DEFAULT_DAYS)
+    if date_from > date_to:
+        raise BacktestError("date_from is after date_to")
+    if chunk_size < 1 or sample_size < 0:
+        raise BacktestError("chunk_size must be positive and sample_size not negative")
+    return _run(tuple(rules), date_from, date_to, chunk_size, sample_size)
+
+
+def _run(rules, date_from, date_to, chunk_size, sample_size) -> Iterator[Dict[str, Any]]:
+    started = time.monotonic()
+    flags = {
+        f'matches_rule_{index}': Case(
+            When(rule.q or Q(pk__isnull=False), then=Value(True)), default=Value(False), output_field=BooleanField(),
+        )
+        for index, rule in enumerate(rules)
+    }
+    invoices = (Invoice.objects.filter(invoice_date__range=(date_from, date_to))
+                .annotate(**flags).order_by('id').values_list('id', 'total_amount', *flags))
+    stats = [
+        {'matched': 0, 'matched_amount': Decimal(0), 'applied': 0, 'applied_amount': Decimal(0), 'sample_ids': []}
+        for _ in rules
+    ]
+    scanned = unmatched = chunks = 0
+    last_id = 0
+    while True:
+        rows = list(invoices.filter(id__gt=last_id)[:chunk_size])
+        if not rows:
+            break
+        for invoice_id, amount, *matches in rows:
+            applied = None
+            for index, matched in enumerate(matches):
+                if matched:
+                    stats[index]['matched'] += 1
+                    stats[index]['matched_amount'] += amount
+                    if applied is None:
+                        applied = index
+            if applied is None:
+                unmatched += 1
+                continue
+            rule_stats = stats[applied]
+            rule_stats['applied'] += 1
+            rule_stats['applied_amount'] += amount
+            if len(rule_stats['sample_ids']) < sample_size:
+                rule_stats['sample_ids'].append(invoice_id)
+        scanned += len(rows)
+        last_id = rows[-1][0]
+        chunks += 1
+        yield {
+            'type': 'progress', 'chunk': chunks, 'scanned': scanned,
+            'rules': [{'name': rule.name, 'matched': s['matched'], 'applied': s['applied']}
+                      for rule, s in zip(rules, stats)],
+        }
+
+    yield {
+        'type': 'result',
+        'date_from': date_from,
+        'date_to': date_to,
+        'scanned': scanned,
+        'unmatched': unmatched,
+        'duration_ms': int((time.monotonic() - started) * 1000),
+        'rules': _summaries(rules, stats),
+    }
@@ -151,5 +151,20 @@ class InvoiceConsumer(BaseAuthenticatedConsumer):
             'results': event['results'],
             'timestamp': event.get('timestamp')
         }))
-
-
+    
+    async def invoice_priorities_updated(self, event):
+        """Handle coalesced priority changes for one service"""
+        await self.send(text_data=json.dumps({
+            'type': 'invoice_priorities_updated',
+            'service': event['service'],
+            'changes': event['changes'],
+            'timestamp': event.get('timestamp')
+        }))
+    
+    async def ai_batch_progress(self, event):
+        """Handle bulk AI processing progress, sent once per processed chunk"""
+        await self.send(text_data=json.dumps({
+            'type': 'ai_batch_progress',
+            'batch': event['batch'],
+            'timestamp': event.get('timestamp')
+        }))
@@ -0,0 +1,216 @@
+# invoices/export_utils.py
+"""
+Columnar (Parquet / Arrow IPC) exports of invoices, line items and analytics rollups.
+
+Rows are read with values_list().iterator() and written one record batch at a time,
+so the Arrow side holds at most chunk_size rows. On PostgreSQL the rows stream from
+a server-side cursor; MySQL's driver buffers the result client-side. The CSV export
+reads keyset pages instead (see iter_csv).
+"""
+import csv
+import uuid
+import zlib
+
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from django.db import models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+
+from .models import Invoice, InvoiceLineItem
+
+EXPORT_FORMATS = ('parquet', 'arrow')
+DEFAULT_CHUNK_SIZE = 10000
+
+INVOICE_COLUMNS = [
+    'id', 'number', 'vendor_name', 'subtotal', 'tax_amount', 'total_amount', 'currency',
+    'base_currency_amount', 'invoice_date', 'issue_date', 'due_date', 'payment_date',
+    'status', 'priority', 'current_service', 'assigned_to', 'payment_terms',
+    'ai_risk_score', 'ai_priority_score', 'created_at', 'updated_at',
+]
+LINE_ITEM_COLUMNS = [
+    'id', 'invoice', 'description', 'quantity', 'unit_price', 'total_price', 'tax_rate',
+    'tax_amount', 'cost_center', 'gl_account', 'category',
+]
+ROLLUP_COLUMNS = ['month', 'vendor_name', 'current_service', 'currency', 'total', 'invoice_count']
+CSV_COLUMNS = [
+    'id', 'number', 'vendor_name', 'total_amount', 'currency', 'issue_date', 'due_date',
+    'status', 'created_at',
+]
+CSV_FLUSH_ROWS = 500
+
+
+class ExportError(ValueError):
+    pass
+
+
+def _arrow_type(field):
+    """Arrow type for a concrete model field (FKs export their raw key)."""
+    if field.is_relation:
+        field = field.target_field
+    if isinstance(field, models.DecimalField):
+        return pa.decimal128(field.max_digits, field.decimal_places)
+    if isinstance(field, models.DateTimeField):
+        return pa.timestamp('us', tz='UTC')
+    if isinstance(field, models.DateField):
+        return pa.date32()
+    if isinstance(field, models.BooleanField):
+        return pa.bool_()
+    if isinstance(field, models.FloatField):
+        return pa.float64()
+    if isinstance(field, (models.IntegerField, models.AutoField)):
+        return pa.int64()
+    return pa.string()
+
+
+def _project(requested, allowed):
+    if not requested:
+        return list(allowed)
+    unknown = [c for c in requested if c not in allowed]
+    if unknown:
+        raise ExportError(f"Unknown columns: {', '.join(unknown)}")
+    return list(requested)
+
+
+def _model_schema(model, columns):
+    return pa.schema([pa.field(c, _arrow_type(model._meta.get_field(c))) for c in columns])
+
+
+def _date_filtered(qs, date_field, start=None, end=None):
+    if start:
+        qs = qs.filter(**{f'{date_field}__gte': start})
+    if end:
+        qs = qs.filter(**{f'{date_field}__lte': end})
+    return qs
+
+
+def build_export(dataset, columns=None, start=None, end=None, queryset=None):
+    """
+    Return (schema, values_list queryset) for a dataset.
+    `queryset` lets callers pass an already filtered Invoice/InvoiceLineItem queryset.
+    """
+    if dataset == 'invoices':
+        columns = _project(columns, INVOICE_COLUMNS)
+        qs = queryset if queryset is not None else Invoice.objects.all()
+        qs = _date_filtered(qs, 'invoice_date', start, end).order_by('id')
+        return _model_schema(Invoice, columns), qs.values_list(*columns)
+
+    if dataset == 'line_items':
+        columns = _project(columns, LINE_ITEM_COLUMNS)
+        qs = queryset if queryset is not None else InvoiceLineItem.objects.all()
+        qs = _date_filtered(qs, 'invoice__invoice_date', start, end).order_by('id')
+        return _model_schema(InvoiceLineItem, columns), qs.values_list(*columns)
+
+    if dataset == 'monthly_rollup':
+        columns = _project(columns, ROLLUP_COLUMNS)
+        qs = _date_filtered(Invoice.objects.all(), 'invoice_date', start, end)
+        qs = (qs.annotate(month=TruncMonth('invoice_date'))
+                .values('month', 'vendor_name', 'current_service', 'currency')
+                .annotate(total=Sum('total_amount'), invoice_count=Count('id'))
+                .order_by('month', 'vendor_name', 'current_service', 'currency'))
+        types = {
+            'month': pa.date32(),
+            'vendor_name': pa.string(),
+            'current_service': pa.string(),
+            'currency': pa.string(),
+            'total': pa.decimal128(18, 2),
+            'invoice_count': pa.int64(),
+        }
+        schema = pa.schema([pa.field(c, types[c]) for c in columns])
+        return schema, qs.values_list(*columns)
+
+    raise ExportError(f"Unknown dataset: {dataset}")
+
+
+def iter_record_batches(schema, rows, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield RecordBatches of at most chunk_size rows from a values_list queryset."""
+    buffer = []
+    for row in rows.iterator(chunk_size=chunk_size):
+        buffer.append(row)
+        if len(buffer) >= chunk_size:
+            yield _to_batch(schema, buffer)
+            buffer = []
+    if buffer:
+        yield _to_batch(schema, buffer)
+
+
+def _to_batch(schema, rows):
+    arrays = []
+    for index, field in enumerate(schema):
+        values = [row[index] for row in rows]
+        if pa.types.is_string(field.type):
+            values = [str(v) if isinstance(v, uuid.UUID) else v for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def write_export(sink, dataset, fmt='parquet', columns=None, start=None, end=None,
+                 queryset=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Stream a dataset into `sink` (path or binary file object).
+    Parquet gets one row group per chunk; Arrow uses the IPC stream format.
+    Returns the number of rows written.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ExportError(f"Unknown format: {fmt}")
+    schema, rows = build_export(dataset, columns, start, end, queryset)
+
+    if fmt == 'parquet':
+        writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    else:
+        writer = ipc.new_stream(sink, schema)
+
+    written = 0
+    try:
+        for batch in iter_record_batches(schema, rows, chunk_size):
+            writer.write_batch(batch)
+            written += batch.num_rows
+    finally:
+        writer.close()
+    return written
+
+
+class _Echo:
+    """File-like object whose write() just hands the encoded line back to csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(queryset, columns=CSV_COLUMNS, chunk_size=2000, compress=False):
+    """
+    Yield CSV bytes for `queryset` in id order, reading chunk_size rows per query by
+    keyset (id > last id seen). .iterator() would not bound memory on MySQL, whose
+    driver buffers the whole result client-side, and keyset pages stay cheap deep
+    into the table where OFFSET would not. With compress=True the output is
+    gzip-encoded on the fly.
+    """
+    writer = csv.writer(_Echo())
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def encode(lines):
+        data = ''.join(lines).encode('utf-8')
+        return compressor.compress(data) if compressor else data
+
+    rows = queryset.order_by('id').values_list('id', *columns)
+    pending = [writer.writerow(columns)]
+    last_id = None
+    while True:
+        page = list(rows[:chunk_size] if last_id is None else rows.filter(id__gt=last_id)[:chunk_size])
+        if not page:
+            break
+        last_id = page[-1][0]
+        for row in page:
+            pending.append(writer.writerow(row[1:]))
+            if len(pending) >= CSV_FLUSH_ROWS:
+                chunk = encode(pending)
+                pending = []
+                if chunk:
+                    yield chunk
+
+    tail = encode(pending)
+    if compressor:
+        tail += compressor.flush()
+    if tail:
+        yield tail
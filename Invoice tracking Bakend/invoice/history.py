@@ -0,0 +1,146 @@
+"""
+Buffered InvoiceHistory writes.
+
+A HistoryRecorder collects history entries and writes them with one bulk_create
+per flush. recording_history() makes a recorder current for a request or task;
+record_history() and record_changes() add to the current recorder, or write
+straight away when none is active. The recorder is flushed when the block exits
+normally and discarded on error, so history commits or rolls back with the
+changes it describes when the block runs inside a transaction.
+
+record_changes() turns field diffs ({field: {'old', 'new'}}, as tracked by
+InvoiceUnitOfWork) into typed entries: status (with from_status/to_status),
+assignment, priority, service transfer, amount and due date changes.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from .models import Invoice, InvoiceHistory
+
+SYSTEM_USER = {'user_name': 'System', 'user_email': 'system@company.com'}
+BATCH_SIZE = 1000
+
+_current: ContextVar[Optional['HistoryRecorder']] = ContextVar('invoice_history_recorder', default=None)
+
+
+def actor_fields(user=None, request=None) -> Dict[str, Any]:
+    """Who/where fields of a history row; the system user when there is no authenticated user."""
+    user = user if user is not None else getattr(request, 'user', None)
+    if user is None or not getattr(user, 'is_authenticated', False):
+        fields = dict(SYSTEM_USER)
+    else:
+        fields = {'user': user, 'user_name': user.name, 'user_email': user.email}
+    if request is not None:
+        fields['ip_address'] = request.META.get('REMOTE_ADDR') or None
+        fields['user_agent'] = request.META.get('HTTP_USER_AGENT', '')
+        session = getattr(request, 'session', None)
+        fields['session_id'] = (getattr(session, 'session_key', None) or '') if session is not None else ''
+    return fields
+
+
+def _status_entry(old, new) -> Dict[str, Any]:
+    if new == Invoice.Status.APPROVED:
+        action_type, action = InvoiceHistory.ActionType.APPROVAL, 'Approved'
+    elif new == Invoice.Status.REJECTED:
+        action_type, action = InvoiceHistory.ActionType.REJECTION, 'Rejected'
+    else:
+        action_type, action = InvoiceHistory.ActionType.STATUS_CHANGE, f"Status changed from {old} to {new}"
+    return {'action': action, 'action_type': action_type, 'from_status': old, 'to_status': new}
+
+
+def change_entries(changes: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """History fields for each tracked field in a diff; other fields are not recorded."""
+    entries = []
+    for field, diff in changes.items():
+        old, new = diff['old'], diff['new']
+        if field == 'status':
+            entries.append(_status_entry(old, new))
+        elif field == 'assigned_to':
+            entries.append({'action': 'Assignment changed', 'action_type': InvoiceHistory.ActionType.ASSIGNMENT_CHANGE,
+                            'metadata': {'from_assigned_to': old, 'assigned_to': new}})
+        elif field == 'priority':
+            entries.append({'action': f"Priority changed from {old} to {new}",
+                            'action_type': InvoiceHistory.ActionType.PRIORITY_CHANGED})
+        elif field == 'current_service':
+            entries.append({'action': f"Transferred from {old} to {new}",
+                            'action_type': InvoiceHistory.ActionType.SERVICE_TRANSFER,
+                            'from_service': old or '', 'to_service': new or ''})
+        elif field == 'total_amount':
+            entries.append({'action': f"Amount changed from {old} to {new}",
+                            'action_type': InvoiceHistory.ActionType.AMOUNT_MODIFIED})
+        elif field == 'due_date':
+            entries.append({'action': f"Due date changed from {old} to {new}",
+                            'action_type': InvoiceHistory.ActionType.DUE_DATE_CHANGED})
+    return entries
+
+
+class HistoryRecorder:
+    def __init__(self, user=None, request=None, batch_size: int = BATCH_SIZE):
+        self.actor = actor_fields(user, request)
+        self.batch_size = batch_size
+        self._entries: List[InvoiceHistory] = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, invoice_id, action: str, action_type: str, **fields):
+        self._entries.append(InvoiceHistory(
+            invoice_id=invoice_id, action=action, action_type=action_type, **{**self.actor, **fields},
+        ))
+
+    def record_changes(self, invoice_id, changes: Dict[str, Dict[str, Any]], reason: str = '', **fields):
+        """One entry per tracked field change; reason (e.g. 'by workflow rule: X') is appended to each action."""
+        for entry in change_entries(changes):
+            if reason:
+                entry['action'] = f"{entry['action']} {reason}"
+            metadata = {**entry.pop('metadata', {}), **fields.get('metadata', {})}
+            self.record(invoice_id, **{**fields, **entry, 'metadata': metadata})
+
+    def flush(self) -> int:
+        entries, self._entries = self._entries, []
+        if entries:
+            InvoiceHistory.objects.bulk_create(entries, batch_size=self.batch_size)
+        return len(entries)
+
+    def discard(self, keep: int = 0):
+        """Drop buffered entries after the first `keep` (e.g. those of a rolled-back item)."""
+        del self._entries[keep:]
+
+
+def current_recorder() -> Optional[HistoryRecorder]:
+    return _current.get()
+
+
+@contextmanager
+def recording_history(user=None, request=None, batch_size: int = BATCH_SIZE):
+    """Buffer history for the duration of the block and write it with one INSERT (per batch_size rows)."""
+    recorder = HistoryRecorder(user=user, request=request, batch_size=batch_size)
+    token = _current.set(recorder)
+    try:
+        yield recorder
+    except BaseException:
+        recorder.discard()
+        raise
+    else:
+        recorder.flush()
+    finally:
+        _current.reset(token)
+
+
+def record_history(invoice_id, action: str, action_type: str, **fields):
+    recorder = current_recorder()
+    if recorder is not None:
+        recorder.record(invoice_id, action, action_type, **fields)
+    else:
+        with recording_history() as recorder:
+            recorder.record(invoice_id, action, action_type, **fields)
+
+
+def record_changes(invoice_id, changes: Dict[str, Dict[str, Any]], reason: str = '', **fields):
+    recorder = current_recorder()
+    if recorder is not None:
+        recorder.record_changes(invoice_id, changes, reason, **fields)
+    else:
+        with recording_history() as recorder:
+            recorder.record_changes(invoice_id, changes, reason, **fields)
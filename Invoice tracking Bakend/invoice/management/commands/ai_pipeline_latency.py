@@ -0,0 +1,55 @@
+"""
+Management command to compare AI pipeline latency of the canvas and sequential runs
+"""
+from datetime import timedelta
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ai_system.models import AIProcessingResult
+
+
+class Command(BaseCommand):
+    help = 'Report per-invoice AI pipeline latency (p50/p95/mean) by pipeline mode, and per-stage durations'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=7,
+            help='Only runs completed in the last N days'
+        )
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(days=options['days'])
+        runs = AIProcessingResult.objects.filter(
+            processing_status='completed',
+            processing_completed_at__gte=since,
+            processing_time_ms__isnull=False,
+        ).exclude(pipeline_mode='')
+
+        latencies = {}
+        stage_durations = {}
+        for mode, elapsed_ms, stage_outputs in runs.values_list(
+                'pipeline_mode', 'processing_time_ms', 'stage_outputs').iterator(chunk_size=2000):
+            latencies.setdefault(mode, []).append(elapsed_ms)
+            for stage, checkpoint in (stage_outputs or {}).items():
+                stage_durations.setdefault(stage, []).append(checkpoint.get('duration_ms', 0))
+
+        if not latencies:
+            self.stdout.write(self.style.WARNING('No completed pipeline runs in range'))
+            return
+
+        for mode, values in sorted(latencies.items()):
+            values = np.asarray(values)
+            self.stdout.write(
+                f'{mode:<10} runs={len(values):<6} p50={np.percentile(values, 50):.0f}ms '
+                f'p95={np.percentile(values, 95):.0f}ms mean={values.mean():.0f}ms'
+            )
+        for stage, values in sorted(stage_durations.items()):
+            self.stdout.write(f'  stage {stage:<9} mean={np.mean(values):.0f}ms')
+
+        if {'sequential', 'canvas'} <= latencies.keys():
+            ratio = np.percentile(latencies['canvas'], 50) / max(np.percentile(latencies['sequential'], 50), 1)
+            self.stdout.write(self.style.SUCCESS(f'Canvas p50 is {ratio:.2f}x the sequential p50'))
@@ -0,0 +1,79 @@
+"""
+Management command to copy historical AI scores onto the indexed invoice columns
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from invoice.models import Invoice
+from ai_system.models import AIProcessingResult
+
+
+class Command(BaseCommand):
+    help = 'Backfill Invoice.ai_risk_score / ai_priority_score from AIProcessingResult in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of invoices read and updated per batch'
+        )
+        parser.add_argument(
+            '--only-missing',
+            action='store_true',
+            help='Skip invoices that already have a risk score'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        start_time = timezone.now()
+
+        invoices = Invoice.objects.all()
+        if options['only_missing']:
+            invoices = invoices.filter(ai_risk_score__isnull=True)
+
+        last_id = 0
+        scanned = 0
+        updated = 0
+        while True:
+            # Walk invoices by primary key so every batch is an index range scan
+            ids = list(
+                invoices.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            last_id = ids[-1]
+            scanned += len(ids)
+
+            # Later rows overwrite earlier ones, keeping the latest result per invoice
+            latest = {}
+            results = AIProcessingResult.objects.filter(invoice_id__in=ids).order_by(
+                'invoice_id', 'updated_at', 'id'
+            ).values_list('invoice_id', 'anomaly_score', 'fraud_risk_score', 'priority_score')
+            for invoice_id, anomaly_score, fraud_risk_score, priority_score in results:
+                latest[invoice_id] = (
+                    # Rule-based risk; results written before it had its own column kept it in anomaly_score
+                    fraud_risk_score if fraud_risk_score is not None else anomaly_score,
+                    priority_score,
+                )
+
+            batch = [
+                Invoice(
+                    id=invoice_id,
+                    ai_risk_score=float(risk) / 100 if risk is not None else None,
+                    ai_priority_score=float(priority) / 100 if priority is not None else None,
+                )
+                for invoice_id, (risk, priority) in latest.items()
+            ]
+            if batch:
+                Invoice.objects.bulk_update(batch, ['ai_risk_score', 'ai_priority_score'])
+                updated += len(batch)
+
+            self.stdout.write(f'Processed invoices up to id {last_id} ({updated} updated)')
+
+        duration = timezone.now() - start_time
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Backfilled {updated} of {scanned} invoices in {duration.total_seconds():.2f} seconds'
+            )
+        )
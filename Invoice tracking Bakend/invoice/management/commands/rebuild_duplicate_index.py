@@ -0,0 +1,27 @@
+"""
+Management command to rebuild the duplicate-invoice blocking key index
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ai_system.duplicates import rebuild_duplicate_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild DuplicateBlockingKey rows for every invoice in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of invoices read and inserted per batch'
+        )
+
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        count = rebuild_duplicate_index(batch_size=options['batch_size'])
+        duration = timezone.now() - start_time
+        self.stdout.write(
+            self.style.SUCCESS(f'Indexed {count} invoices in {duration.total_seconds():.2f} seconds')
+        )
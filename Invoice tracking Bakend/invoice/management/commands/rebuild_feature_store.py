@@ -0,0 +1,27 @@
+"""
+Management command to recompute the stored ML feature vector of every invoice
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ai_system.feature_store import rebuild_feature_store
+
+
+class Command(BaseCommand):
+    help = 'Recompute InvoiceFeatures rows for every invoice in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Number of invoices computed and upserted per batch'
+        )
+
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        count = rebuild_feature_store(chunk_size=options['batch_size'])
+        duration = timezone.now() - start_time
+        self.stdout.write(
+            self.style.SUCCESS(f'Rebuilt features for {count} invoices in {duration.total_seconds():.2f} seconds')
+        )
@@ -0,0 +1,27 @@
+"""
+Management command to rebuild MinHash signatures of invoice OCR text
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ai_system.near_duplicates import rebuild_text_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild TextSignature / LSH band rows for every invoice in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of invoices read and inserted per batch'
+        )
+
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        count = rebuild_text_index(batch_size=options['batch_size'])
+        duration = timezone.now() - start_time
+        self.stdout.write(
+            self.style.SUCCESS(f'Indexed {count} invoice texts in {duration.total_seconds():.2f} seconds')
+        )
@@ -0,0 +1,19 @@
+"""
+Management command to rebuild vendor statistics profiles from invoice history
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ai_system.vendor_profiles import rebuild_vendor_profiles
+
+
+class Command(BaseCommand):
+    help = 'Rebuild VendorProfile running statistics from the invoice table'
+
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        count = rebuild_vendor_profiles()
+        duration = timezone.now() - start_time
+        self.stdout.write(
+            self.style.SUCCESS(f'Rebuilt {count} vendor profiles in {duration.total_seconds():.2f} seconds')
+        )
@@ -0,0 +1,27 @@
+"""
+Management command to rebuild the due-date timers of time-triggered workflow rules
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from invoice.timers import rebuild_timers
+
+
+class Command(BaseCommand):
+    help = 'Reschedule WorkflowTimer rows of every active time rule from the current due dates'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of timers inserted per batch'
+        )
+
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        count = rebuild_timers(batch_size=options['batch_size'])
+        duration = timezone.now() - start_time
+        self.stdout.write(
+            self.style.SUCCESS(f'Scheduled {count} timers in {duration.total_seconds():.2f} seconds')
+        )
@@ -179,8 +179,7 @@ class Command(BaseCommand):
                 'description': 'Automatically approve invoices under €1000 from known vendors',
                 'trigger_type': 'amount_threshold',
                 'trigger_conditions': {
-                    'threshold': 1000,
-                    'operator': 'lte'
+                    'field': 'total_amount', 'op': 'lte', 'value': 1000
                 },
                 'action_type': 'auto_approve',
                 'action_parameters': {
@@ -193,8 +192,7 @@ class Command(BaseCommand):
                 'description': 'Set high priority for invoices over €5000',
                 'trigger_type': 'amount_threshold',
                 'trigger_conditions': {
-                    'threshold': 5000,
-                    'operator': 'gte'
+                    'field': 'total_amount', 'op': 'gte', 'value': 5000
                 },
                 'action_type': 'set_priority',
                 'action_parameters': {
@@ -207,7 +205,7 @@ class Command(BaseCommand):
                 'description': 'Require manager approval for invoices with anomalies',
                 'trigger_type': 'anomaly_detected',
                 'trigger_conditions': {
-                    'risk_threshold': 50
+                    'field': 'ai_risk_score', 'op': 'gte', 'value': 0.5
                 },
                 'action_type': 'require_approval',
                 'action_parameters': {
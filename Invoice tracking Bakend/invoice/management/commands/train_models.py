@@ -0,0 +1,62 @@
+"""
+Management command to train the AI models from invoice history
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ai_system.training import train_models
+
+
+class Command(BaseCommand):
+    help = 'Train ML models from historical invoices and publish versioned artifacts'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model',
+            type=str,
+            help='Train only this model (default: all)'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=50000,
+            help='Number of invoices read per query'
+        )
+        parser.add_argument(
+            '--folds',
+            type=int,
+            default=5,
+            help='Cross-validation folds'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Train and report metrics without publishing an artifact'
+        )
+
+    def handle(self, *args, **options):
+        start_time = timezone.now()
+        reports = train_models(
+            model=options['model'],
+            chunk_size=options['chunk_size'],
+            folds=options['folds'],
+            publish=not options['dry_run'],
+        )
+
+        for name, report in reports.items():
+            if 'error' in report:
+                self.stdout.write(self.style.WARNING(f'{name}: skipped ({report["error"]})'))
+                continue
+            metrics = ', '.join(f'{metric}={value}' for metric, value in report['metrics'].items())
+            # Only cross-validated models report folds (the anomaly model is unsupervised)
+            if report.get('folds'):
+                metrics = f'{report["folds"]}-fold CV {metrics}'
+            self.stdout.write(
+                f'{name} {report["version"] or "(not published)"}: {report["rows"]} rows, {metrics}, '
+                f'{report["training_seconds"]}s, peak memory {report["peak_memory_mb"]} MB'
+            )
+
+        duration = timezone.now() - start_time
+        self.stdout.write(
+            self.style.SUCCESS(f'Training finished in {duration.total_seconds():.2f} seconds')
+        )
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.5 on 2026-10-19 03:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("invoice", "0004_alter_invoice_currency_alter_invoice_file"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="invoice",
+            name="ai_priority_score",
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="invoice",
+            name="ai_risk_score",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="invoice",
+            index=models.Index(
+                fields=["-ai_risk_score", "-id"], name="invoice_risk_score_idx"
+            ),
+        ),
+    ]
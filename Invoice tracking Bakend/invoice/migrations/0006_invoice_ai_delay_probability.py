@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-19 03:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("invoice", "0005_invoice_ai_priority_score_invoice_ai_risk_score_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="invoice",
+            name="ai_delay_probability",
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
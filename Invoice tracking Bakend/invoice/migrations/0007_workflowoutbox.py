@@ -0,0 +1,48 @@
+# Generated by Django 5.2.5 on 2026-10-19 03:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("invoice", "0006_invoice_ai_delay_probability"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="WorkflowOutbox",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "event",
+                    models.CharField(
+                        choices=[
+                            ("invoice_saved", "Invoice saved"),
+                            ("ocr_completed", "OCR completed"),
+                            ("ai_completed", "AI processing completed"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "invoice",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="invoice.invoice",
+                    ),
+                ),
+            ],
+        ),
+    ]
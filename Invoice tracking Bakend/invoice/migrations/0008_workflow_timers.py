@@ -0,0 +1,66 @@
+# Generated by Django 5.2.5 on 2026-10-19 04:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("invoice", "0007_workflowoutbox"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="workflowrule",
+            name="due_offset_days",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name="WorkflowTimer",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("fire_at", models.DateTimeField()),
+                ("fired_at", models.DateTimeField(blank=True, null=True)),
+                (
+                    "invoice",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="invoice.invoice",
+                    ),
+                ),
+                (
+                    "rule",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="timers",
+                        to="invoice.workflowrule",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        condition=models.Q(("fired_at__isnull", True)),
+                        fields=["fire_at"],
+                        name="workflow_timer_due_idx",
+                    )
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("rule", "invoice"),
+                        name="workflow_timer_rule_invoice_uniq",
+                    )
+                ],
+            },
+        ),
+    ]
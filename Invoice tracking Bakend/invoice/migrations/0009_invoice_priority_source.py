@@ -0,0 +1,52 @@
+# Generated by Django 5.2.5 on 2026-10-19 04:47
+
+from django.db import migrations, models
+
+
+def backfill_priority_source(apps, schema_editor):
+    """Mark invoices whose last recorded priority change came from a rule or a user."""
+    Invoice = apps.get_model("invoice", "Invoice")
+    InvoiceHistory = apps.get_model("invoice", "InvoiceHistory")
+    sources = {}
+    changes = (
+        InvoiceHistory.objects.filter(action_type="priority_changed")
+        .order_by("timestamp", "id")
+        .values_list("invoice_id", "metadata", "user_id")
+    )
+    for invoice_id, metadata, user_id in changes.iterator(chunk_size=2000):
+        if (metadata or {}).get("workflow_rule_id") is not None:
+            sources[invoice_id] = "rule"
+        elif user_id is not None:
+            sources[invoice_id] = "manual"
+        else:
+            sources[invoice_id] = "ai"
+    for source in ("rule", "manual"):
+        ids = [invoice_id for invoice_id, value in sources.items() if value == source]
+        for start in range(0, len(ids), 1000):
+            Invoice.objects.filter(id__in=ids[start : start + 1000]).update(
+                priority_source=source
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("invoice", "0008_workflow_timers"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="invoice",
+            name="priority_source",
+            field=models.CharField(
+                choices=[
+                    ("ai", "AI scoring"),
+                    ("rule", "Workflow rule"),
+                    ("manual", "Manual"),
+                ],
+                default="ai",
+                max_length=10,
+            ),
+        ),
+        migrations.RunPython(backfill_priority_source, migrations.RunPython.noop),
+    ]
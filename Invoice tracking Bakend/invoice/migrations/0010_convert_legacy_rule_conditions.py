@@ -0,0 +1,78 @@
+from django.db import migrations
+
+LEGACY_OPERATORS = {
+    "eq": "eq",
+    "==": "eq",
+    "ne": "ne",
+    "!=": "ne",
+    "lt": "lt",
+    "<": "lt",
+    "lte": "lte",
+    "<=": "lte",
+    "gt": "gt",
+    ">": "gt",
+    "gte": "gte",
+    ">=": "gte",
+}
+COMBINATORS = ("all", "any", "not")
+
+
+def convert_condition(conditions):
+    """
+    The condition language equivalent of a non-empty pre-language
+    trigger_conditions dict, the conditions unchanged when they already use the
+    language, or None when they cannot be converted.
+    """
+    if not isinstance(conditions, dict):
+        return None
+    if "field" in conditions or any(key in conditions for key in COMBINATORS):
+        return conditions
+    if set(conditions) <= {"threshold", "operator"} and "threshold" in conditions:
+        op = LEGACY_OPERATORS.get(str(conditions.get("operator", "gte")).lower())
+        if op is None or not isinstance(conditions["threshold"], (int, float)):
+            return None
+        return {"field": "total_amount", "op": op, "value": conditions["threshold"]}
+    if set(conditions) == {"risk_threshold"}:
+        threshold = conditions["risk_threshold"]
+        if isinstance(threshold, bool) or not isinstance(threshold, (int, float)):
+            return None
+        # Risk thresholds were 0..100; ai_risk_score is stored 0..1
+        return {
+            "field": "ai_risk_score",
+            "op": "gte",
+            "value": threshold / 100 if threshold > 1 else threshold,
+        }
+    return None
+
+
+def convert_legacy_conditions(apps, schema_editor):
+    WorkflowRule = apps.get_model("invoice", "WorkflowRule")
+    unconvertible = []
+    for rule in WorkflowRule.objects.order_by("id"):
+        if not rule.trigger_conditions:
+            # Empty conditions match every invoice in both formats
+            continue
+        converted = convert_condition(rule.trigger_conditions)
+        if converted is None:
+            unconvertible.append(
+                f"{rule.id} ({rule.name}): {rule.trigger_conditions!r}"
+            )
+        elif converted != rule.trigger_conditions:
+            WorkflowRule.objects.filter(id=rule.id).update(trigger_conditions=converted)
+    if unconvertible:
+        raise RuntimeError(
+            "Workflow rules with trigger_conditions that cannot be converted to the "
+            "condition language; rewrite or delete them and migrate again:\n"
+            + "\n".join(unconvertible)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("invoice", "0009_invoice_priority_source"),
+    ]
+
+    operations = [
+        migrations.RunPython(convert_legacy_conditions, migrations.RunPython.noop),
+    ]
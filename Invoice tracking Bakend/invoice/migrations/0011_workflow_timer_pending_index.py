@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-19 05:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("invoice", "0010_convert_legacy_rule_conditions"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="workflowtimer",
+            name="workflow_timer_due_idx",
+        ),
+        migrations.AddIndex(
+            model_name="workflowtimer",
+            index=models.Index(
+                fields=["fired_at", "fire_at"], name="workflow_timer_pending_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.5 on 2026-10-19 05:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("invoice", "0011_workflow_timer_pending_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="workflowoutbox",
+            name="attempts",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="workflowoutbox",
+            name="error",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="workflowoutbox",
+            name="failed_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="workflowtimer",
+            name="attempts",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="workflowtimer",
+            name="error",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="workflowtimer",
+            name="failed_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
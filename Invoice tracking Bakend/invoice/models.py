@@ -1,5 +1,5 @@
 from sys import audit
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from auditlog.registry import auditlog
 
@@ -52,6 +52,11 @@ class Invoice(models.Model):
         URGENT = "urgent", "Urgent"
         CRITICAL = "critical", "Critical"
 
+    class PrioritySource(models.TextChoices):
+        AI = "ai", "AI scoring"
+        RULE = "rule", "Workflow rule"
+        MANUAL = "manual", "Manual"
+
     number = models.CharField(max_length=100)
     #vendor = models.ForeignKey(Vendor, on_delete=models.PROTECT, related_name="invoices")
     vendor_name = models.CharField(max_length=255)
@@ -82,6 +87,8 @@ class Invoice(models.Model):
         null=True, blank=True
     )
     priority = models.CharField(max_length=10, choices=Priority.choices, default=Priority.MEDIUM)
+    # Who set priority last; the nightly rescoring only touches AI-derived priorities
+    priority_source = models.CharField(max_length=10, choices=PrioritySource.choices, default=PrioritySource.AI)
 
     approval_level = models.IntegerField(default=0)
     approved_by = models.ForeignKey(
@@ -134,13 +141,27 @@ class Invoice(models.Model):
         related_name="workflow_invoices"
     )
 
+    # Scores written by the AI pipeline, normalized to 0..1
+    ai_risk_score = models.FloatField(null=True, blank=True)
+    ai_priority_score = models.FloatField(null=True, blank=True, db_index=True)
+    ai_delay_probability = models.FloatField(null=True, blank=True)
+
     class Meta:
         unique_together = ("vendor_name", "number")
         ordering = ["-created_at"]
+        indexes = [
+            # Serves risk_alerts: range scan on score, id breaks ties for keyset paging
+            models.Index(fields=["-ai_risk_score", "-id"], name="invoice_risk_score_idx"),
+        ]
 
     def __str__(self):
         return f"{self.vendor_name} #{self.number}"
 
+    def save(self, *args, **kwargs):
+        # Keeps the row and the workflow outbox event its post_save writes in one transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
 class InvoiceAttachment(models.Model):
     invoice = models.ForeignKey(settings.INVOICE_MODEL, on_delete=models.CASCADE, related_name="attachments")
     file_name = models.CharField(max_length=255)
@@ -240,6 +261,8 @@ class WorkflowRule(models.Model):
 
     priority = models.IntegerField(default=0)
     is_active = models.BooleanField(default=True)
+    # Time rules fire this many days from an invoice's due date (-3 = three days before)
+    due_offset_days = models.IntegerField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -252,6 +275,28 @@ class WorkflowRule(models.Model):
 
     def __str__(self):
         return f"{self.name} ({self.trigger_type} → {self.action_type})"
+
+    def clean(self):
+        super().clean()
+        from .workflow_rules import validate_conditions, validate_timing
+        validate_conditions(self.trigger_conditions)
+        validate_timing(self.trigger_type, self.due_offset_days)
+
+    def save(self, *args, **kwargs):
+        # Conditions are compiled on every evaluation path; reject bad ones up front
+        from .workflow_rules import validate_conditions, validate_timing
+        validate_conditions(self.trigger_conditions)
+        validate_timing(self.trigger_type, self.due_offset_days)
+        super().save(*args, **kwargs)
+
+    def evaluate(self, invoice_data) -> bool:
+        """Whether this rule applies to an invoice dict (see workflow_rules for the condition language)."""
+        from .workflow_rules import compile_rule, linked_services, rule_set
+        compiled = rule_set.get(self.pk) if self.pk and self.is_active else None
+        if compiled is None:
+            services = linked_services([self.pk]).get(self.pk, frozenset()) if self.pk else frozenset()
+            compiled = compile_rule(self, services)
+        return compiled.matches(invoice_data)
 class WorkflowRuleServiceLink(models.Model):
     workflow_rule = models.ForeignKey(settings.WORKFLOW_MODEL, on_delete=models.CASCADE)
     service = models.ForeignKey(settings.SERVICE_MODEL, on_delete=models.CASCADE)
@@ -266,6 +311,48 @@ class WorkflowRuleServiceLink(models.Model):
     def __str__(self):
         return f"{self.workflow_rule.name} ↔ {self.service.name}"
 
+class WorkflowOutbox(models.Model):
+    """Invoices whose workflow rules need re-evaluating, written in the same transaction as the change."""
+    class Event(models.TextChoices):
+        INVOICE_SAVED = "invoice_saved", "Invoice saved"
+        OCR_COMPLETED = "ocr_completed", "OCR completed"
+        AI_COMPLETED = "ai_completed", "AI processing completed"
+
+    invoice = models.ForeignKey(settings.INVOICE_MODEL, on_delete=models.CASCADE, related_name="+")
+    event = models.CharField(max_length=20, choices=Event.choices)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Failed routing attempts; dead-lettered (failed_at set) after outbox.MAX_ATTEMPTS
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    failed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.event} for invoice {self.invoice_id}"
+
+class WorkflowTimer(models.Model):
+    """When a time-triggered rule is due for an invoice; derived from the due date and the rule's offset."""
+    rule = models.ForeignKey(settings.WORKFLOW_MODEL, on_delete=models.CASCADE, related_name="timers")
+    invoice = models.ForeignKey(settings.INVOICE_MODEL, on_delete=models.CASCADE, related_name="+")
+    fire_at = models.DateTimeField()
+    fired_at = models.DateTimeField(null=True, blank=True)
+    # Failed firing attempts; dead-lettered (failed_at set) after timers.MAX_ATTEMPTS
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    failed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["rule", "invoice"], name="workflow_timer_rule_invoice_uniq"),
+        ]
+        indexes = [
+            # fired_at IS NULL AND fire_at <= now ORDER BY fire_at reads only pending timers. Not a partial
+            # index: MySQL has none and would fall back to a plain fire_at index over every fired timer too
+            models.Index(fields=["fired_at", "fire_at"], name="workflow_timer_pending_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.rule_id} for invoice {self.invoice_id} at {self.fire_at}"
+
 auditlog.register(Invoice)
 # auditlog.register(InvoiceLineItem)
 # auditlog.register(InvoiceAttachment)
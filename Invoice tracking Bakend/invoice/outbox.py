@@ -0,0 +1,99 @@
+"""
+Transactional outbox for event-driven workflow routing.
+
+Invoice saves, OCR completion and AI completion write a WorkflowOutbox row in the
+same transaction as the change itself, so an event exists exactly when the change
+was committed. After commit a dispatch task is scheduled (at most one per
+DISPATCH_DEBOUNCE_SECONDS); it drains the outbox in batches and evaluates the
+workflow rules only for the invoices that changed. A one-minute beat entry drains
+anything a lost task left behind.
+"""
+import logging
+from typing import Dict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import Invoice, WorkflowOutbox
+from .workflow_rules import apply_rules_isolating_failures, record_routing_failure
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_LOCK_KEY = 'invoice:workflow_outbox:scheduled'
+DISPATCH_DEBOUNCE_SECONDS = 2
+DEFAULT_BATCH_SIZE = 500
+MAX_ATTEMPTS = 5
+
+
+def workflow_candidates(queryset=None):
+    """Draft invoices whose AI processing has completed; the only ones rules act on."""
+    queryset = Invoice.objects.all() if queryset is None else queryset
+    return queryset.filter(
+        status=Invoice.Status.DRAFT,
+        ai_results__processing_status='completed',
+    ).distinct()
+
+
+def record_invoice_event(invoice_id: int, event: str):
+    """Write an outbox row in the caller's transaction and schedule a dispatch once it commits."""
+    WorkflowOutbox.objects.create(invoice_id=invoice_id, event=event)
+    transaction.on_commit(schedule_dispatch)
+
+
+def schedule_dispatch():
+    # Many saves in a burst share one dispatch task
+    if cache.add(DISPATCH_LOCK_KEY, True, DISPATCH_DEBOUNCE_SECONDS):
+        from .tasks import dispatch_workflow_outbox
+        dispatch_workflow_outbox.apply_async(countdown=DISPATCH_DEBOUNCE_SECONDS)
+
+
+def drain_outbox(batch_size: int = DEFAULT_BATCH_SIZE) -> Dict[str, int]:
+    """
+    Claim outbox rows in id order, run the workflow rules over their (distinct)
+    invoices and delete the rows, one transaction per batch. Rows are locked with
+    SKIP LOCKED where the database supports it, so concurrent dispatchers split
+    the work instead of repeating it.
+
+    Rows of invoices whose rules raise are kept with an attempt count and the
+    error, and retried on the next run; after MAX_ATTEMPTS they are dead-lettered
+    (failed_at set) and no longer claimed. A run reads each row at most once, so a
+    failing batch cannot stall the rows behind it.
+    """
+    events = invoices = routed = failed = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                WorkflowOutbox.objects.select_for_update(skip_locked=True)
+                .filter(id__gt=last_id, failed_at__isnull=True)
+                .order_by('id').values_list('id', 'invoice_id')[:batch_size]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            row_ids: Dict[int, list] = {}
+            for row_id, invoice_id in rows:
+                row_ids.setdefault(invoice_id, []).append(row_id)
+            batch_routed, failures = apply_rules_isolating_failures(workflow_candidates(), list(row_ids))
+            WorkflowOutbox.objects.filter(
+                id__in=[row_id for invoice_id, ids in row_ids.items() if invoice_id not in failures for row_id in ids]
+            ).delete()
+            for invoice_id, error in failures.items():
+                record_routing_failure(WorkflowOutbox.objects.filter(id__in=row_ids[invoice_id]), error, MAX_ATTEMPTS)
+        events += len(rows)
+        invoices += len(row_ids)
+        routed += batch_routed
+        failed += len(failures)
+
+    if events:
+        logger.info(f"Workflow outbox: {events} events, {invoices} invoices, {routed} routed, {failed} failed")
+    return {'events': events, 'invoices': invoices, 'routed': routed, 'failed': failed}
+
+
+@receiver(post_save, sender=Invoice)
+def record_invoice_saved(sender, instance: Invoice, raw=False, **kwargs):
+    # Rules only act on drafts; Invoice.save wraps this in the save's transaction
+    if not raw and instance.status == Invoice.Status.DRAFT:
+        record_invoice_event(instance.pk, WorkflowOutbox.Event.INVOICE_SAVED)
@@ -1,8 +1,10 @@
 from rest_framework import serializers
 from decimal import Decimal
 from datetime import datetime
+from django.core.exceptions import ValidationError as DjangoValidationError
 
 from .models import Invoice, InvoiceComment, InvoiceTemplate,WorkflowRule
+from .workflow_rules import RuleConditionError, compile_conditions, validate_timing
 from notifications.models import Notification
 from ai_system.models import AIProcessingResult
 #Service, Vendor
@@ -168,97 +170,33 @@ class InvoiceCommentSerializer(serializers.ModelSerializer):
 
 class WorkflowRuleSerializer(serializers.ModelSerializer):
     created_by_name = serializers.CharField(source='created_by.name', read_only=True)
-    service_name = serializers.CharField(source='service.name', read_only=True)
-    
+
     class Meta:
         model = WorkflowRule
         fields = [
             "id", "name", "description", "trigger_type", "trigger_conditions",
-            "action_type", "action_parameters", "service", "service_name",
-            "priority", "is_active", "created_at", "updated_at",
+            "action_type", "action_parameters", "services",
+            "priority", "is_active", "due_offset_days", "created_at", "updated_at",
             "created_by", "created_by_name"
         ]
-        fields = [
-            # Identification
-            'id',
-            'number',
-            'external_reference',
-            
-            # Vendor info
-            'vendor_name',
-            'vendor_email',
-            'vendor_phone',
-            
-            # Description & notes
-            'description',
-            'notes',
-            
-            # Amounts & currency
-            'subtotal',
-            'tax_amount',
-            'total_amount',
-            'currency',
-            'exchange_rate',
-            'base_currency_amount',
-
-            # Dates
-            'invoice_date',
-            'issue_date',
-            'due_date',
-            'payment_date',
-            
-            # Workflow & assignment
-            'status',
-            'status_display',
-            'current_service',
-            'assigned_to',
-            
-            # Priority
-            'priority',
-            'priority_display',
-            
-            # Approval
-            'approval_level',
-            'approved_by',
-            'approved_at',
-            'rejection_reason',
-            
-            # Payment terms & discounts
-            'payment_terms',
-            'late_fees',
-            'discount_amount',
-            'discount_due_date',
-            
-            # File upload
-            'file',
-            
-            # Audit fields
-            'created_by',
-            'updated_by',
-            'version',
-            'created_at',
-            'updated_at',
-            
-            # OCR / AI fields
-            'raw_text',
-            'ocr_confidence',
-            'matched_template',
-            'workflow',
-        ]
-        
+        # services go through WorkflowRuleServiceLink rows, which are managed separately
+        read_only_fields = ["id", "services", "created_at", "updated_at", "created_by"]
+
+    def validate_trigger_conditions(self, value):
+        try:
+            compile_conditions(value)
+        except RuleConditionError as e:
+            raise serializers.ValidationError(str(e))
+        return value
 
-        read_only_fields = [
-            'id',
-            'created_at',
-            'updated_at',
-            'version',
-            'status_display',
-            'priority_display',
-            'created_by',
-            'updated_by',
-            'raw_text',
-            'ocr_confidence',
-        ]
+    def validate(self, attrs):
+        trigger_type = attrs.get('trigger_type', getattr(self.instance, 'trigger_type', None))
+        due_offset_days = attrs.get('due_offset_days', getattr(self.instance, 'due_offset_days', None))
+        try:
+            validate_timing(trigger_type, due_offset_days)
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.message_dict)
+        return attrs
 
 
 
@@ -1,5 +1,6 @@
 import logging
 import json
+from dataclasses import dataclass
 from typing import Dict, List, Optional, Tuple, Any
 from decimal import Decimal
 from datetime import datetime, timedelta
@@ -17,15 +18,48 @@ from sklearn.preprocessing import StandardScaler
 import joblib
 import os
 
+from departments.models import Service
+from invoice.approver_load import APPROVER_ROLES, Approver, approver_loads
 from invoice.models import Invoice, InvoiceTemplate
+from invoice.unit_of_work import InvoiceUnitOfWork
 from notifications.service import NotificationService
 from django.contrib.auth import get_user_model
 
+from ai_system.feature_store import get_feature_vector, load_matrix
+from ai_system.models import VendorProfile
+from ai_system.vendor_profiles import normalize_vendor_key
 from ai_system.service import OCRService,PredictiveAnalyticsService
 from notifications.service import NotificationService
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
+
+
+@dataclass
+class SharedLookups:
+    """Lookups loaded once for a chunk of invoices and shared by their pipeline runs"""
+    features: Dict[int, np.ndarray]
+    vendor_profiles: Dict[str, VendorProfile]
+    services: Dict[int, Service]
+    approvers: Dict[Any, User]
+    
+    @classmethod
+    def load(cls, invoices: List[Invoice]) -> 'SharedLookups':
+        invoice_ids = [invoice.id for invoice in invoices]
+        vendor_keys = {normalize_vendor_key(invoice.vendor_name) for invoice in invoices} - {''}
+        service_ids = {approver_loads.service_id_for(invoice.current_service) for invoice in invoices} - {None}
+        return cls(
+            features=dict(zip(invoice_ids, load_matrix(invoice_ids))),
+            vendor_profiles=VendorProfile.objects.in_bulk(vendor_keys, field_name='vendor_key'),
+            services=Service.objects.in_bulk(service_ids),
+            approvers=User.objects.filter(
+                service_id__in=service_ids, role__in=APPROVER_ROLES, is_active=True
+            ).in_bulk() if service_ids else {},
+        )
+    
+    def vendor_profile(self, vendor_name: str) -> Optional[VendorProfile]:
+        return self.vendor_profiles.get(normalize_vendor_key(vendor_name))
+
 class WorkflowAutomationService:
     """Intelligent workflow automation and routing"""
     
@@ -34,85 +68,27 @@ class WorkflowAutomationService:
         self.analytics_service = PredictiveAnalyticsService()
         self.notification_service = NotificationService()
     
-    def process_new_invoice(self, invoice: Invoice) -> Dict[str, Any]:
-        """Complete AI processing pipeline for new invoices"""
+    def process_new_invoice(self, invoice: Invoice, unit_of_work: Optional[InvoiceUnitOfWork] = None,
+                            lookups: Optional[SharedLookups] = None) -> Dict[str, Any]:
+        """
+        Complete AI processing pipeline for new invoices, one stage after another.
+        
+        Stages record their invoice changes on unit_of_work; without one the
+        pipeline flushes its own at the end, so the invoice is written once.
+        lookups, when given, replaces per-invoice reads of features, vendor
+        profiles, services and approvers (bulk processing).
+        ai_system.pipeline runs the same stages as a Celery canvas.
+        """
+        owns_unit_of_work = unit_of_work is None
+        unit_of_work = unit_of_work or InvoiceUnitOfWork(invoice)
         try:
-            results = {
-                'invoice_id': invoice.id,
-                'processing_steps': [],
-                'recommendations': [],
-                'next_actions': []
-            }
-            
-            # Step 1: OCR Processing (if file attached)
-            if invoice.file:
-                ocr_result = WorkflowAutomationService.process_new_invoice(invoice.file)
-                results['processing_steps'].append({
-                    'step': 'ocr_processing',
-                    'status': 'completed',
-                    'confidence': ocr_result.get('confidence', 0),
-                    'data_extracted': bool(ocr_result.get('extracted_data'))
-                })
-                
-                # Update invoice with extracted data if confidence is high
-                if ocr_result.get('confidence', 0) > 0.8:
-                    self._update_invoice_from_ocr(invoice, ocr_result['extracted_data'])
-            
-            # Step 2: Anomaly Detection
-            invoice_data = self._invoice_to_dict(invoice)
-            anomaly_result = self.analytics_service.detect_anomalies(invoice_data)
-            results['processing_steps'].append({
-                'step': 'anomaly_detection',
-                'status': 'completed',
-                'anomalies_found': len(anomaly_result.get('anomalies', [])),
-                'risk_score': anomaly_result.get('risk_score', 0)
-            })
-            
-            # Step 3: Priority Scoring
-            priority_result = self.analytics_service.calculate_priority_score(invoice_data)
-            results['processing_steps'].append({
-                'step': 'priority_scoring',
-                'status': 'completed',
-                'priority_score': priority_result.get('priority_score', 50),
-                'priority_level': priority_result.get('priority_level', 'medium')
-            })
-            
-            # Update invoice priority
-            invoice.priority = priority_result.get('priority_level', 'medium')
-            invoice.save()
-            
-            # Step 4: Workflow Routing
-            routing_result = self._determine_approval_workflow(invoice, priority_result, anomaly_result)
-            results['processing_steps'].append({
-                'step': 'workflow_routing',
-                'status': 'completed',
-                'assigned_to': routing_result.get('assigned_to'),
-                'approval_required': routing_result.get('approval_required', True)
-            })
+            ocr_result = self.run_ocr_stage(unit_of_work)
+            anomaly_result = self.run_anomaly_stage(invoice, lookups)
+            priority_result = self.run_priority_stage(invoice, lookups)
+            results = self.run_routing_stage(unit_of_work, anomaly_result, priority_result, ocr_result, lookups)
             
-            # Step 5: Notifications
-            if anomaly_result.get('requires_review', False):
-                self.notification_service.send_anomaly_alert(invoice, anomaly_result.get('anomalies', []))
-            
-            if routing_result.get('assigned_to'):
-                try:
-                    approver = User.objects.get(id=routing_result['assigned_to'])
-                    self.notification_service.send_approval_request(invoice, approver)
-                except User.DoesNotExist:
-                    pass
-            
-            # Compile recommendations
-            results['recommendations'].extend(priority_result.get('recommendations', []))
-            results['recommendations'].extend(anomaly_result.get('recommendations', []))
-            
-            # Determine next actions
-            if anomaly_result.get('requires_review', False):
-                results['next_actions'].append('Manual review required due to anomalies')
-            
-            if priority_result.get('priority_level') in ['high', 'critical']:
-                results['next_actions'].append('Expedited processing recommended')
-            
-            results['overall_status'] = 'completed'
+            if owns_unit_of_work:
+                unit_of_work.flush()
             return results
             
         except Exception as e:
@@ -126,48 +102,139 @@ class WorkflowAutomationService:
                 'next_actions': ['Review and process manually']
             }
     
-    def _update_invoice_from_ocr(self, invoice: Invoice, extracted_data: Dict[str, Any]):
-        """Update invoice fields from OCR extracted data"""
+    def run_ocr_stage(self, unit_of_work: InvoiceUnitOfWork) -> Optional[Dict[str, Any]]:
+        """Step 1: OCR the attached file (if any) and stage confident extractions"""
+        invoice = unit_of_work.invoice
+        if not invoice.file:
+            return None
+        
+        ocr_result = self.ocr_service.extract_invoice_data(invoice.file.path)
+        
+        # Update invoice with extracted data if confidence is high
+        if ocr_result.get('confidence', 0) > 0.8:
+            self._update_invoice_from_ocr(unit_of_work, ocr_result['extracted_data'])
+        return ocr_result
+    
+    def run_anomaly_stage(self, invoice: Invoice, lookups: Optional[SharedLookups] = None) -> Dict[str, Any]:
+        """Step 2: Anomaly Detection"""
+        return self.analytics_service.detect_anomalies(self._invoice_to_dict(invoice, lookups))
+    
+    def run_priority_stage(self, invoice: Invoice, lookups: Optional[SharedLookups] = None) -> Dict[str, Any]:
+        """Step 3: Priority Scoring"""
+        return self.analytics_service.calculate_priority_score(self._invoice_to_dict(invoice, lookups))
+    
+    def run_routing_stage(self, unit_of_work: InvoiceUnitOfWork, anomaly_result: Dict, priority_result: Dict,
+                          ocr_result: Optional[Dict] = None, lookups: Optional[SharedLookups] = None) -> Dict[str, Any]:
+        """Steps 4-5: route and notify from the earlier stages' outputs, and compile the results"""
+        invoice = unit_of_work.invoice
+        results = {
+            'invoice_id': invoice.id,
+            'processing_steps': [],
+            'recommendations': [],
+            'next_actions': []
+        }
+        
+        if ocr_result is not None:
+            results['processing_steps'].append({
+                'step': 'ocr_processing',
+                'status': 'completed',
+                'confidence': ocr_result.get('confidence', 0),
+                'data_extracted': bool(ocr_result.get('extracted_data'))
+            })
+        results['processing_steps'].append({
+            'step': 'anomaly_detection',
+            'status': 'completed',
+            'anomalies_found': len(anomaly_result.get('anomalies', [])),
+            'risk_score': anomaly_result.get('risk_score', 0)
+        })
+        results['processing_steps'].append({
+            'step': 'priority_scoring',
+            'status': 'completed',
+            'priority_score': priority_result.get('priority_score', 50),
+            'priority_level': priority_result.get('priority_level', 'medium')
+        })
+        
+        # Update invoice priority
+        unit_of_work.set(priority=priority_result.get('priority_level', 'medium'),
+                         priority_source=Invoice.PrioritySource.AI)
+        
+        # Step 4: Workflow Routing
+        routing_result = self._determine_approval_workflow(unit_of_work, priority_result, anomaly_result, lookups)
+        results['processing_steps'].append({
+            'step': 'workflow_routing',
+            'status': 'completed',
+            'assigned_to': routing_result.get('assigned_to'),
+            'approval_required': routing_result.get('approval_required', True)
+        })
+        
+        # Step 5: Notifications
+        if anomaly_result.get('requires_review', False):
+            self.notification_service.send_anomaly_alert(invoice, anomaly_result.get('anomalies', []))
+        
+        if routing_result.get('assigned_to'):
+            if lookups is not None:
+                approver = lookups.approvers.get(routing_result['assigned_to'])
+            else:
+                approver = User.objects.filter(id=routing_result['assigned_to']).first()
+            if approver:
+                self.notification_service.send_approval_request(invoice, approver)
+        
+        # Raw 0-100 scores, persisted by the pipeline task
+        results['risk_score'] = anomaly_result.get('risk_score', 0)
+        results['anomaly_score'] = anomaly_result.get('anomaly_score')
+        results['priority_score'] = priority_result.get('priority_score', 50)
+        
+        # Compile recommendations
+        results['recommendations'].extend(priority_result.get('recommendations', []))
+        results['recommendations'].extend(anomaly_result.get('recommendations', []))
+        
+        # Determine next actions
+        if anomaly_result.get('requires_review', False):
+            results['next_actions'].append('Manual review required due to anomalies')
+        
+        if priority_result.get('priority_level') in ['high', 'critical']:
+            results['next_actions'].append('Expedited processing recommended')
+        
+        results['overall_status'] = 'completed'
+        return results
+    
+    def _update_invoice_from_ocr(self, unit_of_work: InvoiceUnitOfWork, extracted_data: Dict[str, Any]):
+        """Stage invoice fields from OCR extracted data"""
+        invoice = unit_of_work.invoice
         try:
-            updated = False
-            
             # Update invoice number if not set
             if not invoice.number and extracted_data.get('invoice_number'):
-                invoice.number = extracted_data['invoice_number']
-                updated = True
+                unit_of_work.set(number=extracted_data['invoice_number'])
             
             # Update amount if not set
             if not invoice.total_amount and extracted_data.get('total_amount'):
                 try:
                     amount_str = extracted_data['total_amount'].replace(',', '')
-                    invoice.total_amount = Decimal(amount_str)
-                    updated = True
-                except (ValueError, TypeError):
+                    unit_of_work.set(total_amount=Decimal(amount_str))
+                except (ArithmeticError, ValueError, TypeError):
                     pass
             
             # Update dates if not set
             if not invoice.invoice_date and extracted_data.get('date'):
                 try:
-                    invoice.invoice_date = datetime.strptime(extracted_data['date'], '%m/%d/%Y').date()
-                    updated = True
+                    unit_of_work.set(invoice_date=datetime.strptime(extracted_data['date'], '%m/%d/%Y').date())
                 except ValueError:
                     pass
-            
-            if updated:
-                invoice.save()
                 
         except Exception as e:
             logger.error(f"Failed to update invoice from OCR data: {e}")
     
-    def _determine_approval_workflow(self, invoice: Invoice, priority_result: Dict, anomaly_result: Dict) -> Dict[str, Any]:
+    def _determine_approval_workflow(self, unit_of_work: InvoiceUnitOfWork, priority_result: Dict, anomaly_result: Dict,
+                                     lookups: Optional[SharedLookups] = None) -> Dict[str, Any]:
         """Determine appropriate approval workflow"""
+        invoice = unit_of_work.invoice
         try:
-            # Get service configuration
-            from .models import Service
-            try:
-                service = Service.objects.get(id=invoice.current_service)
-            except Service.DoesNotExist:
-                service = None
+            # current_service holds the service name or code
+            service_id = approver_loads.service_id_for(invoice.current_service)
+            if lookups is not None:
+                service = lookups.services.get(service_id)
+            else:
+                service = Service.objects.filter(id=service_id).first() if service_id else None
             
             # Determine if auto-approval is possible
             can_auto_approve = (
@@ -180,9 +247,7 @@ class WorkflowAutomationService:
             
             if can_auto_approve:
                 # Auto-approve
-                invoice.status = 'approved'
-                invoice.approved_at = timezone.now()
-                invoice.save()
+                unit_of_work.set(status='approved', approved_at=timezone.now())
                 
                 return {
                     'auto_approved': True,
@@ -194,8 +259,7 @@ class WorkflowAutomationService:
             approver = self._find_best_approver(invoice, priority_result)
             
             if approver:
-                invoice.assigned_to = approver.id
-                invoice.save()
+                unit_of_work.set(assigned_to=approver.id)
                 
                 return {
                     'auto_approved': False,
@@ -221,49 +285,47 @@ class WorkflowAutomationService:
                 'error': str(e)
             }
     
-    def _find_best_approver(self, invoice: Invoice, priority_result: Dict) -> Optional[User]:
-        """Find the best approver for an invoice"""
+    def _find_best_approver(self, invoice: Invoice, priority_result: Dict) -> Optional[Approver]:
+        """Least-loaded approver of the invoice's service, from the approver load index"""
         try:
+            service_id = approver_loads.service_id_for(invoice.current_service)
+            if service_id is None:
+                return None
+            
             # For high priority or high amounts, assign to managers
             if (priority_result.get('priority_level') in ['high', 'critical'] or 
                 invoice.total_amount > 5000):
-                
-                managers = User.objects.filter(
-                    role__in=['manager', 'admin'],
-                    service_id=invoice.current_service,
-                    is_active=True
-                ).order_by('last_login')
-                
-                if managers.exists():
-                    return managers.first()
+                manager = approver_loads.least_loaded(service_id, managers_only=True)
+                if manager:
+                    return manager
             
             # For regular invoices, assign to any approver in the service
-            approvers = User.objects.filter(
-                service_id=invoice.current_service,
-                role__in=['manager', 'admin', 'approver'],
-                is_active=True
-            ).order_by('last_login')
-            
-            return approvers.first() if approvers.exists() else None
+            return approver_loads.least_loaded(service_id)
             
         except Exception as e:
             logger.error(f"Failed to find approver: {e}")
             return None
     
-    def _invoice_to_dict(self, invoice: Invoice) -> Dict[str, Any]:
+    def _invoice_to_dict(self, invoice: Invoice, lookups: Optional[SharedLookups] = None) -> Dict[str, Any]:
         """Convert invoice model to dictionary for AI processing"""
-        return {
+        data = {
             'id': invoice.id,
             'number': invoice.number,
             'vendor_name': invoice.vendor_name,
             'total_amount': float(invoice.total_amount),
+            'subtotal': float(invoice.subtotal),
+            'tax_amount': float(invoice.tax_amount),
             'currency': invoice.currency,
             'invoice_date': invoice.invoice_date.isoformat() if invoice.invoice_date else None,
             'due_date': invoice.due_date.isoformat() if invoice.due_date else None,
             'current_service': invoice.current_service,
             'status': invoice.status,
             'priority': invoice.priority,
-            'created_at': invoice.created_at.isoformat()
+            'created_at': invoice.created_at.isoformat(),
+            'features': lookups.features.get(invoice.id) if lookups is not None else get_feature_vector(invoice.id),
         }
+        if lookups is not None:
+            data['vendor_profile'] = lookups.vendor_profile(invoice.vendor_name)
+        return data
 
 workflow_service = WorkflowAutomationService()
\ No newline at end of file
@@ -19,13 +19,18 @@ from notifications.service import notification_service
 #analytic and workflow service
 #from ai_system.service import PredictiveAnalyticsService
 
-from .models import WorkflowRule,InvoiceHistory
+from .models import WorkflowRule
+from .outbox import drain_outbox, workflow_candidates
+from .timers import fire_due_timers
+from .workflow_rules import active_rules as active_workflow_rules, apply_rules_in_bulk
 from .analytics_utils import (
     upcoming_cashflow_total,
     monthly_totals_last_n_months,
     monthly_growth_percentage,
     top_vendors,
-    risk_alerts
+    risk_alerts,
+    bump_rollup_version,
+    prewarm_spending_patterns
 )
 
 
@@ -35,41 +40,21 @@ User = get_user_model()
 def run_workflow_automation() -> dict:
     """Execute workflow automation rules"""
     try:
-        processed_count = 0
-        
-        # Get pending invoices for workflow processing
-        pending_invoices = Invoice.objects.filter(
-            ai_processing_status='completed',
-            status='draft'
-        ).select_related('vendor', 'current_service')
+        # Full scan of pending invoices; routine routing goes through the outbox
+        pending_invoices = workflow_candidates()
         
-        # Get active workflow rules
-        active_rules = WorkflowRule.objects.filter(is_active=True).order_by('priority')
+        # Active workflow rules, compiled once per process
+        active_rules = active_workflow_rules()
         
-        for invoice in pending_invoices:
-            invoice_data = {
-                'id': invoice.id,
-                'total_amount': float(invoice.total_amount),
-                'vendor_name': invoice.vendor_name,
-                'current_service': invoice.current_service.id,
-                'priority': invoice.priority,
-                'ai_risk_score': invoice.ai_risk_score or 0,
-                'ai_priority_score': invoice.ai_priority_score or 50
-            }
-            
-            # Apply workflow rules
-            for rule in active_rules:
-                if rule.evaluate(invoice_data):
-                    success = apply_workflow_action(invoice, rule)
-                    if success:
-                        processed_count += 1
-                        break  # Only apply first matching rule
+        # Each rule is one set-based match + UPDATE over the pending invoices
+        applied = apply_rules_in_bulk(pending_invoices, active_rules)
+        processed_count = sum(len(item['invoice_ids']) for item in applied.values())
         
         logger.info(f"Workflow automation processed {processed_count} invoices")
         return {
             "success": True,
             "processed_count": processed_count,
-            "rules_evaluated": active_rules.count()
+            "rules_evaluated": len(active_rules)
         }
         
     except Exception as e:
@@ -77,54 +62,24 @@ def run_workflow_automation() -> dict:
         return {"success": False, "error": str(e)}
 
 
-def apply_workflow_action(invoice: Invoice, rule: WorkflowRule) -> bool:
-    """Apply workflow rule action to invoice"""
+@shared_task
+def dispatch_workflow_outbox(batch_size: int = 500) -> dict:
+    """Route the invoices that changed since the last dispatch (see invoice.outbox)."""
     try:
-        action_params = rule.action_parameters
-        
-        if rule.action_type == 'auto_approve':
-            invoice.status = 'approved'
-            invoice.approved_at = timezone.now()
-            invoice.save()
-            
-            # Log the auto-approval
-            InvoiceHistory.objects.create(
-                invoice=invoice,
-                action=f"Auto-approved by workflow rule: {rule.name}",
-                action_type='approval',
-                to_status='approved',
-                user_name='System',
-                user_email='system@company.com'
-            )
-            
-        elif rule.action_type == 'assign_user':
-            user_id = action_params.get('user_id')
-            if user_id:
-                try:
-                    user = User.objects.get(id=user_id)
-                    invoice.assigned_to = user
-                    invoice.save()
-                    
-                    # Send notification to assigned user
-                    notification_service.send_approval_request(invoice, user)
-                    
-                except User.DoesNotExist:
-                    return False
-        
-        elif rule.action_type == 'set_priority':
-            new_priority = action_params.get('priority', 'medium')
-            invoice.priority = new_priority
-            invoice.save()
-        
-        elif rule.action_type == 'require_approval':
-            invoice.status = 'pending_approval'
-            invoice.save()
-        
-        return True
-        
+        return {"success": True, **drain_outbox(batch_size=batch_size)}
     except Exception as e:
-        logger.error(f"Failed to apply workflow action for rule {rule.id}: {e}")
-        return False
+        logger.error(f"Workflow outbox dispatch failed: {e}")
+        return {"success": False, "error": str(e)}
+
+
+@shared_task
+def fire_workflow_timers(batch_size: int = 500) -> dict:
+    """Apply time-triggered rules whose timers are due (see invoice.timers)."""
+    try:
+        return {"success": True, **fire_due_timers(batch_size=batch_size)}
+    except Exception as e:
+        logger.error(f"Workflow timer run failed: {e}")
+        return {"success": False, "error": str(e)}
 
 
 @shared_task
@@ -292,7 +247,11 @@ def compute_analytics(self):
 
         # JSON-safe: payload already uses floats, strings, iso dates
         cache.set(CACHE_KEY, payload, CACHE_TTL)
-        logger.info("Analytics computed and cached")
+
+        # New rollup version: retire cached spending patterns and pre-warm the common ones
+        bump_rollup_version()
+        warmed = prewarm_spending_patterns()
+        logger.info("Analytics computed and cached (%s spending patterns pre-warmed)", warmed)
         return {"success": True, "cached_key": CACHE_KEY}
 
     except Exception as e:
@@ -1,3 +1,4 @@
+import io
 import uuid
 from decimal import Decimal
 import pytest
@@ -173,4 +174,630 @@ def test_ocr_upload_no_file(client):
 #     invalid_uuid = uuid.uuid4()
 #     response = client.post(url, {"file": image_file, "invoice_id": str(invalid_uuid)}, format="multipart")
 #     assert response.status_code == 404
-#     assert Invoice.objects.count() == 0
\ No newline at end of file
+#     assert Invoice.objects.count() == 0
+
+@pytest.fixture
+def default_user(db):
+    from departments.models import Service
+    service = Service.objects.create(name="Finance", code="FIN")
+    return User.objects.create_user(
+        email="test@example.com",
+        password="secret",
+        name="Test User",
+        role="manager",
+        service_id=service,
+    )
+
+
+def make_invoice(user, number, **kwargs):
+    fields = dict(
+        vendor_name="Acme Corp",
+        subtotal=Decimal("100.00"),
+        tax_amount=Decimal("0.00"),
+        total_amount=Decimal("100.00"),
+        invoice_date="2025-01-01",
+        issue_date="2025-01-01",
+        due_date="2025-02-01",
+        current_service="finance",
+        created_by=user,
+    )
+    fields.update(kwargs)
+    return Invoice.objects.create(number=number, **fields)
+
+
+@pytest.mark.django_db
+def test_risk_alerts_keyset_pages(default_user):
+    from rest_framework.test import APIClient
+    from .analytics_utils import risk_alerts
+
+    make_invoice(default_user, "LOW", ai_risk_score=0.2)
+    high = [make_invoice(default_user, f"HIGH-{i}", ai_risk_score=0.9) for i in range(3)]
+    top = make_invoice(default_user, "TOP", ai_risk_score=0.95)
+
+    first = risk_alerts(threshold=0.8, limit=2)
+    assert [a["id"] for a in first] == [top.id, high[2].id]
+
+    last = first[-1]
+    second = risk_alerts(threshold=0.8, limit=2, after=(last["ai_risk_score"], last["id"]))
+    assert [a["id"] for a in second] == [high[1].id, high[0].id]
+
+    client = APIClient()
+    client.force_authenticate(default_user)
+    # limit is clamped to 1..100 and an empty page has no cursor
+    response = client.get("/api/invoices/risk-alerts/", {"limit": 0})
+    assert [a["id"] for a in response.data["results"]] == [top.id] and response.data["next"] is not None
+    response = client.get("/api/invoices/risk-alerts/", {"limit": -5, "threshold": 2})
+    assert response.data == {"results": [], "next": None}
+
+
+@pytest.mark.django_db
+def test_backfill_ai_scores_uses_latest_result(default_user):
+    from django.core.management import call_command
+    from ai_system.models import AIProcessingResult
+
+    invoice = make_invoice(default_user, "BF-1")
+    AIProcessingResult.objects.create(invoice=invoice, anomaly_score=Decimal("10"), priority_score=Decimal("20"))
+    AIProcessingResult.objects.create(invoice=invoice, anomaly_score=Decimal("85"), priority_score=Decimal("60"))
+    untouched = make_invoice(default_user, "BF-2")
+
+    call_command("backfill_ai_scores", batch_size=1, stdout=io.StringIO())
+
+    invoice.refresh_from_db()
+    untouched.refresh_from_db()
+    assert invoice.ai_risk_score == pytest.approx(0.85)
+    assert invoice.ai_priority_score == pytest.approx(0.60)
+    assert untouched.ai_risk_score is None
+
+
+@pytest.mark.django_db
+def test_spending_patterns_single_query_and_cached(default_user, django_assert_num_queries):
+    from django.core.cache import cache
+    from django.utils import timezone
+    from .analytics_utils import spending_patterns, bump_rollup_version
+
+    cache.clear()
+    paid = dict(status=Invoice.Status.PAID, payment_date=timezone.localdate())
+    make_invoice(default_user, "SP-1", total_amount=Decimal("100"), current_service="finance", **paid)
+    make_invoice(default_user, "SP-2", total_amount=Decimal("300"), current_service="hr", **paid)
+    make_invoice(default_user, "SP-3", vendor_name="Globex", total_amount=Decimal("50"), current_service="hr", **paid)
+    make_invoice(default_user, "SP-4", total_amount=Decimal("999"))  # unpaid, excluded
+
+    with django_assert_num_queries(1):
+        data = spending_patterns(" Month ", None)
+    assert data["spending_summary"] == {"total_amount": 450.0, "avg_amount": 150.0, "invoice_count": 3}
+    assert data["top_vendors"][0] == {"vendor_name": "Acme Corp", "total_spent": 400.0, "invoice_count": 2}
+    assert [s["current_service"] for s in data["service_breakdown"]] == ["hr", "finance"]
+
+    with django_assert_num_queries(0):
+        assert spending_patterns("month", "") == data
+
+    assert spending_patterns("month", "hr")["spending_summary"]["invoice_count"] == 2
+
+    bump_rollup_version()
+    with django_assert_num_queries(1):
+        spending_patterns("month", None)
+
+
+@pytest.mark.django_db
+def test_write_export_parquet_projection_and_chunks(default_user):
+    import pyarrow.parquet as pq
+    from rest_framework.test import APIClient
+    from .export_utils import write_export
+
+    for i in range(5):
+        make_invoice(default_user, f"EX-{i}", invoice_date=f"2025-01-0{i + 1}")
+    make_invoice(default_user, "EX-OLD", invoice_date="2024-06-01")
+
+    sink = io.BytesIO()
+    written = write_export(
+        sink, "invoices", columns=["id", "number", "total_amount", "invoice_date", "assigned_to"],
+        start="2025-01-01", chunk_size=2,
+    )
+    sink.seek(0)
+    parquet = pq.ParquetFile(sink)
+
+    assert written == 5
+    assert parquet.num_row_groups == 3
+    table = parquet.read()
+    assert table.column_names == ["id", "number", "total_amount", "invoice_date", "assigned_to"]
+    assert sorted(table.column("number").to_pylist()) == [f"EX-{i}" for i in range(5)]
+    assert table.column("total_amount").to_pylist()[0] == Decimal("100.00")
+
+    client = APIClient()
+    client.force_authenticate(default_user)
+    response = client.get("/api/invoices/export-columnar/", {"start": "2025-02-30"})
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_export_csv_streams_filtered_rows_with_gzip(default_user):
+    import csv
+    import gzip
+    from rest_framework.test import APIClient
+
+    make_invoice(default_user, "CSV-1", vendor_name="Comma, Inc")
+    make_invoice(default_user, "CSV-2", status=Invoice.Status.PAID)
+    client = APIClient()
+    client.force_authenticate(default_user)
+
+    response = client.get("/api/invoices/export/", {"status": "draft"})
+    assert response.streaming
+    rows = list(csv.reader(io.StringIO(b"".join(response.streaming_content).decode())))
+    assert rows[0][:4] == ["id", "number", "vendor_name", "total_amount"]
+    assert [(r[1], r[2]) for r in rows[1:]] == [("CSV-1", "Comma, Inc")]
+
+    response = client.get("/api/invoices/export/", {"compress": "gzip"})
+    assert response["Content-Type"] == "application/gzip"
+    rows = list(csv.reader(io.StringIO(gzip.decompress(b"".join(response.streaming_content)).decode())))
+    assert len(rows) == 3
+
+    # Rows are read a keyset page at a time, in id order
+    from .export_utils import iter_csv
+    for number in range(3, 6):
+        make_invoice(default_user, f"CSV-{number}")
+    rows = list(csv.reader(io.StringIO(b"".join(iter_csv(Invoice.objects.order_by("-id"), chunk_size=2)).decode())))
+    assert [r[1] for r in rows[1:]] == [f"CSV-{number}" for number in range(1, 6)]
+
+
+@pytest.mark.django_db
+def test_workflow_rules_compile_validate_and_cache(default_user, django_assert_num_queries):
+    import time
+    from django.core.exceptions import ValidationError
+    from departments.models import Service
+    from .models import WorkflowRule, WorkflowRuleServiceLink
+    from .workflow_rules import first_matching_rule, rule_set
+
+    with pytest.raises(ValidationError):
+        WorkflowRule.objects.create(
+            name="Bad", trigger_type="event", action_type="notify",
+            trigger_conditions={"field": "amount", "op": "gte", "value": 10},
+        )
+
+    large = WorkflowRule.objects.create(
+        name="Large finance", trigger_type="event", action_type="escalate", priority=1,
+        trigger_conditions={"all": [
+            {"field": "total_amount", "op": "gte", "value": 5000},
+            {"not": {"field": "vendor_name", "op": "in", "value": ["Trusted Ltd"]}},
+        ]},
+    )
+    risky = WorkflowRule.objects.create(
+        name="Risky", trigger_type="event", action_type="notify", priority=2,
+        trigger_conditions={"field": "ai_risk_score", "op": "between", "value": [0.5, 1]},
+    )
+    invoice = {"total_amount": "7500.00", "vendor_name": "Acme Corp", "current_service": "finance", "ai_risk_score": 0.7}
+
+    rule_set.rules()
+    with django_assert_num_queries(0):
+        assert first_matching_rule(invoice).id == large.id
+        assert first_matching_rule({**invoice, "vendor_name": "Trusted Ltd"}).id == risky.id
+        assert first_matching_rule({"total_amount": 10}) is None
+        assert large.evaluate(invoice)
+
+        started = time.perf_counter()
+        for _ in range(1000):
+            first_matching_rule({**invoice, "total_amount": 10, "ai_risk_score": 0.1})
+        assert (time.perf_counter() - started) / 1000 < 1e-3
+
+    # Linking a service scopes the rule and drops the cached rule set
+    hr, _ = Service.objects.get_or_create(code="hr", defaults={"name": "HR"})
+    WorkflowRuleServiceLink.objects.create(workflow_rule=large, service=hr)
+    assert first_matching_rule(invoice).id == risky.id
+    assert first_matching_rule({**invoice, "current_service": "hr"}).id == large.id
+
+    risky.is_active = False
+    risky.save()
+    assert first_matching_rule(invoice) is None
+    assert risky.evaluate(invoice)  # inactive rules can still be tested
+
+
+@pytest.mark.django_db
+def test_workflow_conditions_compare_strings_case_insensitively(default_user):
+    from .workflow_rules import compile_conditions, conditions_to_q, invoice_rule_data
+
+    invoices = [make_invoice(default_user, f"CI-{i}", vendor_name=name)
+                for i, name in enumerate(["ACME Corp", "acme corp", "Beta Ltd"])]
+    acme = {invoices[0].id, invoices[1].id}
+    for conditions, expected in [
+        ({"field": "vendor_name", "op": "eq", "value": "Acme Corp"}, acme),
+        ({"field": "vendor_name", "op": "ne", "value": "ACME CORP"}, {invoices[2].id}),
+        ({"field": "vendor_name", "op": "in", "value": ["acme CORP", "Gamma"]}, acme),
+        ({"field": "vendor_name", "op": "not_in", "value": ["BETA LTD"]}, acme),
+        ({"field": "vendor_name", "op": "lt", "value": "B"}, acme),
+    ]:
+        predicate = compile_conditions(conditions)
+        # The predicates and the SQL agree, whatever the database collation
+        assert {invoice.id for invoice in invoices if predicate(invoice_rule_data(invoice))} == expected
+        assert set(Invoice.objects.filter(conditions_to_q(conditions)).values_list("id", flat=True)) == expected
+
+
+@pytest.mark.django_db
+def test_workflow_automation_applies_rules_set_based(default_user, django_assert_max_num_queries):
+    from ai_system.models import AIProcessingResult
+    from .models import InvoiceHistory, WorkflowRule
+    from .tasks import run_workflow_automation
+    from .workflow_rules import conditions_to_q, compile_conditions, invoice_rule_data
+
+    approve = WorkflowRule.objects.create(
+        name="Approve small", trigger_type="event", action_type="approve", priority=1,
+        trigger_conditions={"field": "total_amount", "op": "lt", "value": 500},
+    )
+    prioritize = WorkflowRule.objects.create(
+        name="Flag risky", trigger_type="event", action_type="set_priority", priority=2,
+        action_parameters={"priority": "urgent"},
+        trigger_conditions={"any": [
+            {"field": "ai_risk_score", "op": "gte", "value": 0.8},
+            {"field": "vendor_name", "op": "ne", "value": "Acme Corp"},
+        ]},
+    )
+    WorkflowRule.objects.create(
+        name="Broken assignment", trigger_type="event", action_type="assign", priority=0,
+        action_parameters={"user_id": 999999},
+    )
+
+    def invoices(n, **kwargs):
+        made = [make_invoice(default_user, f"WF-{kwargs.get('ai_risk_score')}-{kwargs.get('total_amount')}-{i}",
+                             **kwargs) for i in range(n)]
+        AIProcessingResult.objects.bulk_create(
+            [AIProcessingResult(invoice=invoice, processing_status="completed") for invoice in made]
+        )
+        return made
+
+    small = invoices(5, total_amount=Decimal("100"))
+    risky = invoices(5, total_amount=Decimal("900"), ai_risk_score=0.9)
+    plain = invoices(5, total_amount=Decimal("900"), ai_risk_score=0.1)
+    make_invoice(default_user, "WF-NO-AI", total_amount=Decimal("100"))
+
+    # The SQL translation selects exactly what the Python predicate accepts
+    for conditions in (approve.trigger_conditions, prioritize.trigger_conditions):
+        predicate = compile_conditions(conditions)
+        expected = {i.id for i in Invoice.objects.all() if predicate(invoice_rule_data(i))}
+        assert set(Invoice.objects.filter(conditions_to_q(conditions)).values_list("id", flat=True)) == expected
+
+    # A fixed number of queries per rule, whatever the number of invoices
+    with django_assert_max_num_queries(12):
+        result = run_workflow_automation()
+    assert result["success"] and result["processed_count"] == 10
+
+    statuses = dict(Invoice.objects.values_list("id", "status"))
+    assert all(statuses[i.id] == Invoice.Status.APPROVED for i in small)
+    assert set(Invoice.objects.filter(id__in=[i.id for i in risky]).values_list("priority", flat=True)) == {"urgent"}
+    assert all(statuses[i.id] == Invoice.Status.DRAFT for i in plain)
+    assert Invoice.objects.get(number="WF-NO-AI").status == Invoice.Status.DRAFT
+
+    history = InvoiceHistory.objects.filter(metadata__workflow_rule_id=approve.id)
+    assert history.count() == 5
+    assert {(h.from_status, h.to_status) for h in history} == {("draft", "approved")}
+    assert InvoiceHistory.objects.filter(
+        metadata__workflow_rule_id=prioritize.id, action_type=InvoiceHistory.ActionType.PRIORITY_CHANGED,
+    ).count() == 5
+
+
+@pytest.mark.django_db
+def test_workflow_outbox_routes_only_changed_invoices(default_user, django_capture_on_commit_callbacks):
+    from django.core.cache import cache
+    from django.db import transaction
+    from ai_system.models import AIProcessingResult
+    from .models import WorkflowOutbox, WorkflowRule
+    from .outbox import DISPATCH_LOCK_KEY, drain_outbox, record_invoice_event
+
+    WorkflowRule.objects.create(
+        name="Urgent when large", trigger_type="event", action_type="set_priority",
+        action_parameters={"priority": "urgent"},
+        trigger_conditions={"field": "total_amount", "op": "gte", "value": 1000},
+    )
+    first = make_invoice(default_user, "OB-1", total_amount=Decimal("5000"))
+    second = make_invoice(default_user, "OB-2", total_amount=Decimal("5000"))
+    assert WorkflowOutbox.objects.filter(event="invoice_saved").count() == 2
+
+    # Not routed yet: AI processing has not completed
+    assert drain_outbox() == {"events": 2, "invoices": 2, "routed": 0, "failed": 0}
+    assert not WorkflowOutbox.objects.exists()
+
+    AIProcessingResult.objects.create(invoice=first, processing_status="completed")
+    AIProcessingResult.objects.create(invoice=second, processing_status="completed")
+    cache.delete(DISPATCH_LOCK_KEY)
+    with django_capture_on_commit_callbacks(execute=True) as callbacks:
+        with transaction.atomic():
+            record_invoice_event(first.id, WorkflowOutbox.Event.AI_COMPLETED)
+    # The commit scheduled a dispatch (run eagerly here) that drained the event
+    assert len(callbacks) == 1
+    assert not WorkflowOutbox.objects.exists()
+    first.refresh_from_db()
+    second.refresh_from_db()
+    assert first.priority == "urgent"
+    assert first.priority_source == Invoice.PrioritySource.RULE
+    assert second.priority == "medium"  # unchanged since the last drain, so not re-evaluated
+
+    # Events are written with the change, so a rolled-back change leaves none
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            second.notes = "edited"
+            second.save()
+            raise RuntimeError
+    assert not WorkflowOutbox.objects.exists()
+
+
+@pytest.mark.django_db
+def test_workflow_outbox_dead_letters_failing_invoices(default_user, monkeypatch):
+    from ai_system.models import AIProcessingResult
+    from . import workflow_rules
+    from .models import WorkflowOutbox, WorkflowRule
+    from .outbox import MAX_ATTEMPTS, drain_outbox
+
+    WorkflowRule.objects.create(
+        name="Urgent", trigger_type="event", action_type="set_priority", action_parameters={"priority": "urgent"},
+    )
+    good = make_invoice(default_user, "DL-GOOD")
+    bad = make_invoice(default_user, "DL-BAD")
+    for invoice in (good, bad):
+        AIProcessingResult.objects.create(invoice=invoice, processing_status="completed")
+
+    apply_rules_in_bulk = workflow_rules.apply_rules_in_bulk
+
+    def failing_for_bad(queryset, rules=None):
+        if queryset.filter(id=bad.id).exists():
+            raise RuntimeError("broken action")
+        return apply_rules_in_bulk(queryset, rules)
+
+    monkeypatch.setattr(workflow_rules, "apply_rules_in_bulk", failing_for_bad)
+
+    # The failing invoice does not hold back the one batched with it
+    assert drain_outbox(batch_size=10) == {"events": 2, "invoices": 2, "routed": 1, "failed": 1}
+    good.refresh_from_db()
+    assert good.priority == "urgent"
+    row = WorkflowOutbox.objects.get()
+    assert (row.invoice_id, row.attempts, row.error, row.failed_at) == (bad.id, 1, "broken action", None)
+
+    for _ in range(MAX_ATTEMPTS - 1):
+        assert drain_outbox()["failed"] == 1
+    row.refresh_from_db()
+    assert row.attempts == MAX_ATTEMPTS and row.failed_at is not None
+    # Dead-lettered rows are no longer claimed
+    assert drain_outbox() == {"events": 0, "invoices": 0, "routed": 0, "failed": 0}
+
+
+@pytest.mark.django_db
+def test_approver_load_index_picks_least_loaded(default_user, django_assert_num_queries):
+    from .approver_load import approver_loads
+    from .models import Invoice as InvoiceModel
+    from .service import WorkflowAutomationService
+
+    service = default_user.service_id
+    # bulk_create skips the per-user default settings, whose keys are unique across users
+    other, _ = User.objects.bulk_create([
+        User(email="other@example.com", name="Other Manager", role="manager", service_id=service),
+        User(email="viewer@example.com", name="Viewer", role="viewer", service_id=service),
+    ])
+    make_invoice(default_user, "AL-1", assigned_to=default_user, current_service="FIN")
+    make_invoice(default_user, "AL-2", assigned_to=default_user, status="approved")  # closed, not counted
+    approver_loads.reconcile()
+    assert approver_loads.load(default_user.id) == 1
+    assert approver_loads.load(other.id) == 0
+
+    invoice = make_invoice(default_user, "AL-3", total_amount=Decimal("9000"), current_service="fin")
+    automation = WorkflowAutomationService()
+    with django_assert_num_queries(0):
+        assert automation._find_best_approver(invoice, {"priority_level": "high"}).id == other.id
+
+    # Assignment and status changes move the loads without a rebuild
+    invoice.assigned_to = other
+    invoice.save()
+    with django_assert_num_queries(0):
+        assert approver_loads.load(other.id) == 1
+        assert approver_loads.least_loaded(service.id, managers_only=True).id in (default_user.id, other.id)
+    make_invoice(default_user, "AL-4", assigned_to=other)
+    with django_assert_num_queries(0):
+        assert approver_loads.least_loaded(service.id).id == default_user.id
+    invoice.status = "approved"
+    invoice.save()
+    InvoiceModel.objects.get(number="AL-1").delete()
+    with django_assert_num_queries(0):
+        assert approver_loads.load(default_user.id) == 0
+        assert approver_loads.least_loaded(service.id).id == default_user.id
+
+    # Writes that skip signals are repaired by reconciliation
+    InvoiceModel.objects.filter(number="AL-4").update(assigned_to=default_user)
+    approver_loads.reconcile()
+    assert approver_loads.load(default_user.id) == 1
+    assert approver_loads.least_loaded(service.id).id == other.id
+
+
+@pytest.mark.django_db
+def test_history_recorder_buffers_and_records_tracked_changes(default_user):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from .history import recording_history
+    from .models import InvoiceHistory, WorkflowRule
+    from .unit_of_work import InvoiceUnitOfWork
+    from .workflow_rules import apply_rules_in_bulk
+
+    approve = WorkflowRule.objects.create(
+        name="Approve small", trigger_type="event", action_type="approve", priority=1,
+        trigger_conditions={"field": "total_amount", "op": "lt", "value": 500},
+    )
+    WorkflowRule.objects.create(
+        name="Urgent", trigger_type="event", action_type="set_priority", priority=2,
+        action_parameters={"priority": "urgent"},
+        trigger_conditions={"field": "total_amount", "op": "gte", "value": 500},
+    )
+    invoices = [make_invoice(default_user, f"HR-{i}", total_amount=Decimal(100 + 500 * (i % 2))) for i in range(6)]
+
+    # Both rules' history rows go out in one INSERT
+    with CaptureQueriesContext(connection) as queries:
+        applied = apply_rules_in_bulk(Invoice.objects.filter(id__in=[i.id for i in invoices]))
+    assert len(applied) == 2
+    inserts = [q for q in queries.captured_queries if q["sql"].startswith('INSERT INTO "invoice_invoicehistory"')]
+    assert len(inserts) == 1
+    assert InvoiceHistory.objects.filter(metadata__workflow_rule_id=approve.id).count() == 3
+    assert InvoiceHistory.objects.filter(action_type=InvoiceHistory.ActionType.PRIORITY_CHANGED).count() == 3
+
+    # Field changes flushed by the unit of work are recorded with their from/to values
+    invoice = make_invoice(default_user, "HR-UOW")
+    unit_of_work = InvoiceUnitOfWork(invoice)
+    unit_of_work.set(status=Invoice.Status.REJECTED, priority="high")
+    with recording_history(user=default_user) as recorder:
+        unit_of_work.flush(broadcast=False)
+        assert len(recorder) == 2 and not invoice.history.exists()
+    rejection = invoice.history.get(action_type=InvoiceHistory.ActionType.REJECTION)
+    assert (rejection.from_status, rejection.to_status, rejection.user_id) == ("draft", "rejected", default_user.id)
+    assert invoice.history.filter(action_type=InvoiceHistory.ActionType.PRIORITY_CHANGED).exists()
+
+    # Buffered entries are dropped when the block fails
+    with pytest.raises(RuntimeError):
+        with recording_history() as recorder:
+            recorder.record(invoice.id, "Commented", InvoiceHistory.ActionType.COMMENT_ADDED)
+            raise RuntimeError("boom")
+    assert not invoice.history.filter(action="Commented").exists()
+
+
+@pytest.mark.django_db
+def test_workflow_timers_fire_only_due_time_rules(default_user, django_capture_on_commit_callbacks):
+    from datetime import timedelta
+    from django.core.exceptions import ValidationError
+    from django.utils import timezone
+    from .models import WorkflowRule, WorkflowTimer
+    from .tasks import fire_workflow_timers
+    from .workflow_rules import active_rules
+
+    with pytest.raises(ValidationError):
+        WorkflowRule.objects.create(name="No offset", trigger_type="time", action_type="notify")
+
+    today = timezone.localdate()
+    ahead = make_invoice(default_user, "TM-AHEAD", due_date=today + timedelta(days=10))
+    close = make_invoice(default_user, "TM-CLOSE", due_date=today + timedelta(days=2))
+    make_invoice(default_user, "TM-PAID", due_date=today + timedelta(days=10), status="paid")
+
+    # A new rule schedules the fire times still ahead: only TM-AHEAD (in 7 days)
+    with django_capture_on_commit_callbacks(execute=True):
+        rule = WorkflowRule.objects.create(
+            name="Escalate before due", trigger_type="time", action_type="set_priority", due_offset_days=-3,
+            action_parameters={"priority": "urgent"},
+        )
+    assert rule.id not in {r.id for r in active_rules()}  # not evaluated on invoice events
+    timer = WorkflowTimer.objects.get()
+    assert timer.invoice_id == ahead.id and timer.fire_at.date() == today + timedelta(days=7)
+
+    # New invoices and due date changes (re)schedule; past fire times are due right away
+    with django_capture_on_commit_callbacks(execute=True):
+        late = make_invoice(default_user, "TM-LATE", due_date=str(today + timedelta(days=1)))
+        ahead.due_date = today + timedelta(days=2)
+        ahead.save()
+        close.notes = "unchanged due date"
+        close.save()
+    assert set(WorkflowTimer.objects.values_list("invoice_id", flat=True)) == {ahead.id, late.id}
+
+    assert fire_workflow_timers() == {"success": True, "fired": 2, "applied": 2, "failed": 0}
+    priorities = dict(Invoice.objects.values_list("number", "priority"))
+    assert priorities["TM-AHEAD"] == priorities["TM-LATE"] == "urgent"
+    assert priorities["TM-CLOSE"] == "medium"
+    assert not WorkflowTimer.objects.filter(fired_at__isnull=True).exists()
+    assert fire_workflow_timers()["fired"] == 0
+
+    # Saves that do not write due_date, or write it unchanged, keep the fired timers
+    with django_capture_on_commit_callbacks(execute=True):
+        partial = Invoice.objects.only("id", "notes").get(id=ahead.id)
+        partial.notes = "deferred due date"
+        partial.save()
+        ahead.notes = "notes only"
+        ahead.save(update_fields=["notes"])
+        deferred = Invoice.objects.defer("due_date").get(id=late.id)
+        deferred.due_date = today + timedelta(days=1)
+        deferred.save()
+    assert WorkflowTimer.objects.count() == 2
+    assert not WorkflowTimer.objects.filter(fired_at__isnull=True).exists()
+
+    with django_capture_on_commit_callbacks(execute=True):
+        deferred.due_date = today + timedelta(days=30)
+        deferred.save()
+    timer = WorkflowTimer.objects.get(invoice_id=late.id)
+    assert timer.fired_at is None and timer.fire_at.date() == today + timedelta(days=27)
+
+
+@pytest.mark.django_db
+def test_backtest_streams_per_rule_matches_in_chunks(default_user, django_assert_num_queries):
+    import json
+    from datetime import date
+    from django.core.management import call_command
+    from rest_framework.test import APIClient
+    from .backtest import backtest, draft_rules
+    from .models import WorkflowRule
+
+    for i, amount in enumerate([100, 700, 900, 50, 2000]):
+        make_invoice(default_user, f"BT-{i}", total_amount=Decimal(amount), invoice_date="2025-03-01",
+                     vendor_name="Acme Corp" if i % 2 else "Globex")
+    make_invoice(default_user, "BT-OLD", total_amount=Decimal("5000"), invoice_date="2023-01-01")
+
+    drafts = [
+        {"name": "Acme", "priority": 2, "trigger_conditions": {"field": "vendor_name", "op": "eq", "value": "Acme Corp"}},
+        {"name": "Large", "priority": 1, "trigger_conditions": {"field": "total_amount", "op": "gte", "value": 500}},
+    ]
+    # One query per chunk plus the empty one that ends the scan
+    with django_assert_num_queries(4):
+        records = list(backtest(draft_rules(drafts), date(2025, 1, 1), date(2025, 12, 31), chunk_size=2))
+    assert [r["type"] for r in records] == ["progress"] * 3 + ["result"]
+
+    result = records[-1]
+    assert (result["scanned"], result["unmatched"]) == (5, 1)
+    large, acme = result["rules"]
+    assert (large["name"], large["matched"], large["applied"], large["applied_amount"]) == ("Large", 3, 3, Decimal("3600"))
+    assert (acme["matched"], acme["applied"], acme["sample_ids"]) == (2, 1, [Invoice.objects.get(number="BT-3").id])
+    assert large["sample_ids"] == sorted(large["sample_ids"]) and len(large["sample_ids"]) == 3
+
+    client = APIClient()
+    client.force_authenticate(default_user)
+    response = client.post("/api/workflow-rules/backtest/", {
+        "rules": drafts, "date_from": "2025-01-01", "date_to": "2025-12-31", "chunk_size": 2, "sample_size": 1,
+    }, format="json")
+    assert response.status_code == 200 and response["Content-Type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+    assert lines[-1]["rules"][0]["applied_amount"] == "3600.00" and len(lines[-1]["rules"][0]["sample_ids"]) == 1
+
+    bad = client.post("/api/workflow-rules/backtest/", {
+        "rules": [{"trigger_conditions": {"field": "amount", "op": "gte", "value": 1}}],
+    }, format="json")
+    assert bad.status_code == 400
+
+    saved = WorkflowRule.objects.create(name="Saved large", trigger_type="event", action_type="notify",
+                                        trigger_conditions=drafts[1]["trigger_conditions"])
+    out = io.StringIO()
+    call_command("backtest_workflow_rules", "--rule-id", str(saved.id), "--from", "2022-01-01", "--to", "2025-12-31",
+                 stdout=out)
+    assert "6 invoices" in out.getvalue() and "Saved large: matched=4" in out.getvalue()
+
+
+@pytest.mark.django_db
+def test_workflow_rule_api_serializes_rules(default_user):
+    from departments.models import Service
+    from rest_framework.test import APIClient
+    from .models import WorkflowRule, WorkflowRuleServiceLink
+
+    rule = WorkflowRule.objects.create(
+        name="Large", trigger_type="event", action_type="notify", created_by=default_user,
+        trigger_conditions={"field": "total_amount", "op": "gte", "value": 500},
+    )
+    WorkflowRuleServiceLink.objects.create(workflow_rule=rule, service=Service.objects.get(code="finance"))
+
+    client = APIClient()
+    client.force_authenticate(default_user)
+    response = client.get(f"/api/workflow-rules/{rule.id}/")
+    assert response.status_code == 200
+    assert response.data["services"] == [Service.objects.get(code="finance").id]
+    assert response.data["created_by_name"] == default_user.name
+    assert "number" not in response.data
+
+
+def test_legacy_rule_conditions_migration_converts_old_shapes():
+    import importlib
+    from .workflow_rules import validate_conditions
+
+    migration = importlib.import_module("invoice.migrations.0010_convert_legacy_rule_conditions")
+    amount = migration.convert_condition({"threshold": 1000, "operator": "lte"})
+    risk = migration.convert_condition({"risk_threshold": 50})
+    assert amount == {"field": "total_amount", "op": "lte", "value": 1000}
+    assert risk == {"field": "ai_risk_score", "op": "gte", "value": 0.5}
+    for converted in (amount, risk):
+        validate_conditions(converted)
+    current = {"any": [{"field": "status", "op": "eq", "value": "draft"}]}
+    assert migration.convert_condition(current) is current
+    assert migration.convert_condition({"threshold": 5, "operator": "approx"}) is None
+    assert migration.convert_condition({"vendor": "Acme"}) is None
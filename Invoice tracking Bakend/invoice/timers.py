@@ -0,0 +1,179 @@
+"""
+Due-date timers for time-triggered workflow rules.
+
+A time rule ("escalate 3 days before due") has a due_offset_days. Instead of
+scanning every invoice on each run, a WorkflowTimer row holds the moment the rule
+is due for an invoice: the start of (due_date + offset) in the current timezone.
+Timers are written when an invoice is created, rewritten when its due date
+changes, and rebuilt for a rule when the rule is saved. The fire_workflow_timers
+beat task range-scans the (fired_at, fire_at) index within fired_at IS NULL, so
+timers that already fired are never read and each run costs O(due timers); it
+applies each rule to its due invoices in one set-based pass (apply_rules_in_bulk)
+and stamps the timers as fired.
+
+A rule's conditions are checked when its timer fires, not when it is scheduled.
+Rebuilding a rule only schedules fire times still in the future, so a new or
+edited rule does not fire for every past due date at once; a changed invoice due
+date schedules all its timers, and those already past fire on the next run.
+Rescheduling an invoice keeps the timers whose fire time did not change, so a
+timer that already fired does not fire again, and saves that did not load or
+write due_date (deferred fields, update_fields) do not reschedule at all.
+"""
+import logging
+from datetime import datetime, time, timedelta
+from typing import Dict
+
+from django.db import transaction
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Invoice, WorkflowRule, WorkflowTimer
+from .workflow_rules import apply_rules_isolating_failures, record_routing_failure, rule_set
+
+logger = logging.getLogger(__name__)
+
+# Invoices time rules no longer act on
+SETTLED_STATUSES = (
+    Invoice.Status.PAID, Invoice.Status.CANCELLED, Invoice.Status.ARCHIVED, Invoice.Status.REJECTED,
+)
+DEFAULT_BATCH_SIZE = 500
+MAX_ATTEMPTS = 5
+
+
+def fire_time(due_date, offset_days: int) -> datetime:
+    return timezone.make_aware(datetime.combine(due_date + timedelta(days=offset_days), time.min))
+
+
+def schedule_invoice(invoice_id: int, due_date, status: str, replace: bool = True) -> int:
+    """
+    (Re)write an invoice's timers for every active time rule; returns the number
+    written. Replacing keeps existing timers (fired or not) whose fire time is unchanged.
+    """
+    wanted = {}
+    if due_date is not None and status not in SETTLED_STATUSES:
+        wanted = {rule.id: fire_time(due_date, rule.due_offset_days) for rule in rule_set.timed_rules()}
+    if replace:
+        stale = []
+        for timer_id, rule_id, fire_at in WorkflowTimer.objects.filter(invoice_id=invoice_id).values_list(
+                'id', 'rule_id', 'fire_at'):
+            if rule_id in wanted and wanted[rule_id] == fire_at:
+                del wanted[rule_id]
+            else:
+                stale.append(timer_id)
+        if stale:
+            WorkflowTimer.objects.filter(id__in=stale).delete()
+    WorkflowTimer.objects.bulk_create([
+        WorkflowTimer(rule_id=rule_id, invoice_id=invoice_id, fire_at=fire_at) for rule_id, fire_at in wanted.items()
+    ])
+    return len(wanted)
+
+
+def schedule_rule(rule: WorkflowRule, batch_size: int = 1000) -> int:
+    """Replace a rule's timers with one per open invoice whose fire time is still ahead."""
+    WorkflowTimer.objects.filter(rule_id=rule.id).delete()
+    if not rule.is_active or rule.trigger_type != 'time':
+        return 0
+    now = timezone.now()
+    invoices = (Invoice.objects.exclude(status__in=SETTLED_STATUSES)
+                .filter(due_date__gte=timezone.localdate(now) - timedelta(days=rule.due_offset_days))
+                .values_list('id', 'due_date'))
+    created, batch = 0, []
+    for invoice_id, due_date in invoices.iterator(chunk_size=batch_size):
+        fire_at = fire_time(due_date, rule.due_offset_days)
+        if fire_at > now:
+            batch.append(WorkflowTimer(rule_id=rule.id, invoice_id=invoice_id, fire_at=fire_at))
+        if len(batch) >= batch_size:
+            created += len(WorkflowTimer.objects.bulk_create(batch))
+            batch = []
+    if batch:
+        created += len(WorkflowTimer.objects.bulk_create(batch))
+    return created
+
+
+def rebuild_timers(batch_size: int = 1000) -> int:
+    """Reschedule every time rule, e.g. after due dates were changed with QuerySet.update."""
+    WorkflowTimer.objects.exclude(rule__is_active=True, rule__trigger_type='time').delete()
+    return sum(schedule_rule(rule, batch_size)
+               for rule in WorkflowRule.objects.filter(is_active=True, trigger_type='time'))
+
+
+def fire_due_timers(now=None, batch_size: int = DEFAULT_BATCH_SIZE) -> Dict[str, int]:
+    """
+    Claim pending timers due by now in fire_at order and apply their rules, one
+    transaction per batch. Like the outbox, rows are locked with SKIP LOCKED where
+    the database supports it so concurrent runs split the work, and timers whose
+    invoice makes the rule raise stay pending with an attempt count and the error:
+    they are not claimed again in the same run and are dead-lettered (failed_at
+    set) after MAX_ATTEMPTS.
+    """
+    now = now or timezone.now()
+    fired = applied = failed = 0
+    retry_later = []
+    while True:
+        with transaction.atomic():
+            rows = list(
+                WorkflowTimer.objects.select_for_update(skip_locked=True)
+                .filter(fired_at__isnull=True, failed_at__isnull=True, fire_at__lte=now)
+                .exclude(id__in=retry_later)
+                .order_by('fire_at').values_list('id', 'rule_id', 'invoice_id')[:batch_size]
+            )
+            if not rows:
+                break
+            due: Dict[int, Dict[int, int]] = {}
+            for timer_id, rule_id, invoice_id in rows:
+                due.setdefault(rule_id, {})[invoice_id] = timer_id
+            failures: Dict[int, str] = {}
+            for rule_id, timer_ids in due.items():
+                rule = rule_set.get(rule_id)
+                if rule is None or rule.trigger_type != 'time':
+                    # Deactivated since it was scheduled
+                    continue
+                routed, errors = apply_rules_isolating_failures(
+                    Invoice.objects.exclude(status__in=SETTLED_STATUSES), list(timer_ids), (rule,),
+                )
+                applied += routed
+                failures.update((timer_ids[invoice_id], error) for invoice_id, error in errors.items())
+            WorkflowTimer.objects.filter(
+                id__in=[timer_id for timer_id, _, _ in rows if timer_id not in failures]
+            ).update(fired_at=now)
+            for timer_id, error in failures.items():
+                record_routing_failure(WorkflowTimer.objects.filter(id=timer_id), error, MAX_ATTEMPTS, now)
+        retry_later.extend(failures)
+        fired += len(rows) - len(failures)
+        failed += len(failures)
+
+    if fired or failed:
+        logger.info(f"Workflow timers: {fired} fired, {applied} invoices acted on, {failed} failed")
+    return {'fired': fired, 'applied': applied, 'failed': failed}
+
+
+# Snapshot of an instance loaded without due_date (.only()/.defer())
+NOT_LOADED = object()
+
+
+@receiver(post_init, sender=Invoice)
+def remember_due_date(sender, instance: Invoice, **kwargs):
+    instance._timer_due_date = instance.__dict__.get('due_date', NOT_LOADED)
+
+
+@receiver(post_save, sender=Invoice)
+def reschedule_invoice_timers(sender, instance: Invoice, created=False, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    if not created and ('due_date' not in instance.__dict__
+                        or (update_fields is not None and 'due_date' not in update_fields)):
+        # This save did not write due_date
+        return
+    # A due date assigned as a string stays a string on the instance
+    due_date = Invoice._meta.get_field('due_date').to_python(instance.due_date)
+    if created or due_date != getattr(instance, '_timer_due_date', NOT_LOADED):
+        invoice_id, status = instance.pk, instance.status
+        transaction.on_commit(lambda: schedule_invoice(invoice_id, due_date, status, replace=not created))
+    instance._timer_due_date = due_date
+
+
+@receiver(post_save, sender=WorkflowRule)
+def reschedule_rule_timers(sender, instance: WorkflowRule, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(lambda: schedule_rule(instance))
@@ -0,0 +1,91 @@
+"""
+Unit of work for multi-stage invoice processing.
+
+Pipeline stages stage field changes on an InvoiceUnitOfWork instead of saving the
+invoice after each step. flush() writes every changed field with one
+save(update_fields=...) inside a transaction, so post_save handlers, auditlog and
+cache invalidation run once per pipeline run. In the same transaction it records
+history for the tracked fields (status, assignment, priority, ...) through
+invoice.history, and after commit it sends one consolidated "invoice_updated"
+event listing all changes.
+"""
+from typing import Any, Dict, List
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import models, transaction
+from django.utils import timezone
+
+from .history import record_changes
+from .models import Invoice
+
+
+def _jsonable(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+class InvoiceUnitOfWork:
+    def __init__(self, invoice: Invoice):
+        self.invoice = invoice
+        self._original: Dict[str, Any] = {}
+
+    def set(self, **fields):
+        """Assign fields on the invoice, remembering each field's value before the first change."""
+        for name, value in fields.items():
+            field = Invoice._meta.get_field(name)
+            if isinstance(value, models.Model):
+                value = value.pk
+            current = getattr(self.invoice, field.attname)
+            if field.name not in self._original:
+                if current == value:
+                    continue
+                self._original[field.name] = current
+            setattr(self.invoice, field.attname, value)
+
+    @property
+    def changes(self) -> Dict[str, Dict[str, Any]]:
+        """{field: {'old', 'new'}} for fields whose value differs from the original"""
+        changes = {}
+        for name, old in self._original.items():
+            new = getattr(self.invoice, Invoice._meta.get_field(name).attname)
+            if new != old:
+                changes[name] = {'old': _jsonable(old), 'new': _jsonable(new)}
+        return changes
+
+    def flush(self, broadcast: bool = True, history_reason: str = '', **history_fields) -> List[str]:
+        """
+        Write all staged changes with one UPDATE and record their history
+        (buffered when a history recorder is active); returns the fields written.
+        """
+        changes = self.changes
+        if not changes:
+            return []
+        update_fields = [*changes, 'updated_at']
+        with transaction.atomic():
+            self.invoice.save(update_fields=update_fields)
+            record_changes(self.invoice.id, changes, history_reason, **history_fields)
+            if broadcast:
+                transaction.on_commit(lambda: self._broadcast(changes))
+        self._original = {}
+        return list(changes)
+
+    def _broadcast(self, changes: Dict[str, Dict[str, Any]]):
+        channel_layer = get_channel_layer()
+        if not channel_layer:
+            return
+        invoice = self.invoice
+        async_to_sync(channel_layer.group_send)("invoice_updates", {
+            "type": "invoice_updated",
+            "invoice": {
+                "id": invoice.id,
+                "number": invoice.number,
+                "status": invoice.status,
+                "total_amount": str(invoice.total_amount),
+                "vendor_name": invoice.vendor_name,
+                "created": False,
+            },
+            "changes": changes,
+            "timestamp": timezone.now().isoformat(),
+        })
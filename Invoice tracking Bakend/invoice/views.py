@@ -2,7 +2,7 @@ from rest_framework import permissions, status, viewsets,parsers
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
-from django.http import HttpResponse
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
 from django.db.models import Q, Count, Sum
 from django.db import models
 from django.shortcuts import get_object_or_404
@@ -20,21 +20,35 @@ from PIL import Image
 from .ocr_utils import perform_ocr_and_extract_data, get_image_from_uploaded_file
 import json
 import io
+import tempfile
+import uuid
 from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
 
 from .tasks import compute_analytics, CACHE_KEY,invoice_ocr_task
+from .analytics_utils import risk_alerts
+from .export_utils import ExportError, iter_csv, write_export
+from .history import recording_history
+from .backtest import (
+    DEFAULT_CHUNK_SIZE as BACKTEST_CHUNK_SIZE, DEFAULT_SAMPLE_SIZE as BACKTEST_SAMPLE_SIZE, BacktestError,
+    backtest as run_backtest, draft_rules, saved_rules,
+)
+from .workflow_rules import active_rules
 import re
 from .models import Invoice, InvoiceComment, InvoiceTemplate,WorkflowRule
 from notifications.models import Notification
 
 #WorkflowRule, Service, Vendor
-from ai_system.models import  AIProcessingResult
+from ai_system.models import  AIProcessingBatch, AIProcessingResult
 from .serializers import (
     InvoiceCommentSerializer, InvoiceSerializer, InvoiceCreateSerializer,
-    InvoiceStatusUpdateSerializer, InvoiceTemplateSerializer
+    InvoiceStatusUpdateSerializer, InvoiceTemplateSerializer, WorkflowRuleSerializer
 )
 from .permissions import IsManagerOrReadOnly
-from ai_system.tasks import process_invoice_ocr, process_invoice_ai_pipeline
+from ai_system.batch_processing import DEFAULT_CHUNK_SIZE as AI_BATCH_CHUNK_SIZE, start_batch as start_ai_batch
+from ai_system.pipeline import start_pipeline as start_ai_pipeline
+from ai_system.tasks import process_invoice_ocr, process_invoice_ai_pipeline, bulk_predict_payment_delay
+from ai_system.batch_scoring import score_payment_delays
 from notifications.tasks import send_automated_reminders
 #from .ai_services import workflow_service, analytics_service
 
@@ -58,6 +72,11 @@ class InvoiceTemplateViewSet(viewsets.ModelViewSet):
     filterset_fields = ["vendor_name", "enabled"]
 
 
+def _is_id_list(value) -> bool:
+    """A JSON list of integer ids (booleans are ints in Python but not ids)."""
+    return isinstance(value, list) and all(isinstance(item, int) and not isinstance(item, bool) for item in value)
+
+
 class InvoiceViewSet(viewsets.ModelViewSet):
     queryset = Invoice.objects.select_related("assigned_to", "created_by", "matched_template").all()
     serializer_class = InvoiceSerializer
@@ -69,6 +88,7 @@ class InvoiceViewSet(viewsets.ModelViewSet):
     filterset_fields = ["status", "current_service", "due_date", "assigned_to"]
     search_fields = ["number", "vendor_name", "raw_text"]
     ordering_fields = ["created_at", "due_date", "total_amount"]
+    BULK_PREDICT_SYNC_LIMIT = 1000
 
     def get_serializer_class(self):
         # Use a simpler serializer for creation to avoid 400s on missing read-only/derived fields
@@ -83,13 +103,26 @@ class InvoiceViewSet(viewsets.ModelViewSet):
         if instance.file:
             invoice_ocr_task.delay(instance.id)
 
+    def perform_update(self, serializer):
+        extra = {}
+        priority = serializer.validated_data.get('priority')
+        if priority is not None and priority != serializer.instance.priority:
+            # Priorities set by hand are kept out of the nightly rescoring
+            extra['priority_source'] = Invoice.PrioritySource.MANUAL
+        serializer.save(**extra)
+
     @action(detail=True, methods=["patch"], url_path="status")
     def update_status(self, request, pk=None):
         """Update invoice status with workflow validation."""
         invoice = self.get_object()
         serializer = InvoiceStatusUpdateSerializer(invoice, data=request.data, partial=True)
         serializer.is_valid(raise_exception=True)
-        serializer.save()
+        old_status = invoice.status
+        with transaction.atomic(), recording_history(request=request) as history:
+            serializer.save()
+            if invoice.status != old_status:
+                history.record_changes(invoice.id, {'status': {'old': old_status, 'new': invoice.status}},
+                                       comment=request.data.get('comment') or '')
         
         # Send notification about status change
         from notifications.tasks import send_status_notification
@@ -148,22 +181,50 @@ class InvoiceViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=["get"], url_path="export")
     def export_csv(self, request):
-        """Export filtered invoices to CSV."""
+        """Stream filtered invoices as CSV, optionally gzip-compressed (?compress=gzip)."""
         qs = self.filter_queryset(self.get_queryset())
-        response = HttpResponse(content_type="text/csv")
-        response["Content-Disposition"] = f"attachment; filename=invoices_{timezone.now().strftime('%Y%m%d')}.csv"
-        
-        # CSV header
-        response.write("id,number,supplier,amount,currency,issue_date,due_date,status,created_at\n")
-        
-        # CSV data
-        for inv in qs:
-            response.write(
-                f"{inv.id},{inv.number},{inv.supplier.name},{inv.amount},{inv.currency},"
-                f"{inv.issue_date},{inv.due_date},{inv.status},{inv.created_at.strftime('%Y-%m-%d')}\n"
-            )
+        compress = request.query_params.get('compress', '').lower() == 'gzip'
+
+        filename = f"invoices_{timezone.now().strftime('%Y%m%d')}.csv"
+        response = StreamingHttpResponse(
+            iter_csv(qs, compress=compress),
+            content_type="application/gzip" if compress else "text/csv"
+        )
+        if compress:
+            filename += ".gz"
+        response["Content-Disposition"] = f"attachment; filename={filename}"
         return response
 
+    @action(detail=False, methods=["get"], url_path="export-columnar")
+    def export_columnar(self, request):
+        """Export invoices, line items or monthly rollups as Parquet / Arrow IPC."""
+        dataset = request.query_params.get('dataset', 'invoices')
+        fmt = request.query_params.get('file_format', 'parquet')
+        columns = [c.strip() for c in request.query_params.get('columns', '').split(',') if c.strip()]
+        try:
+            # parse_date returns None for malformed input but raises for impossible dates
+            start = parse_date(request.query_params.get('start', '') or '')
+            end = parse_date(request.query_params.get('end', '') or '')
+        except ValueError:
+            return Response({"error": "start and end must be valid YYYY-MM-DD dates"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        queryset = self.filter_queryset(self.get_queryset()) if dataset == 'invoices' else None
+
+        # `format` is reserved by DRF for renderer selection, hence `file_format`.
+        # Parquet needs a seekable sink for its footer, so spool to disk rather than memory
+        sink = tempfile.TemporaryFile()
+        try:
+            write_export(sink, dataset, fmt=fmt, columns=columns, start=start, end=end, queryset=queryset)
+        except ExportError as e:
+            sink.close()
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        sink.seek(0)
+
+        extension = 'parquet' if fmt == 'parquet' else 'arrows'
+        filename = f"{dataset}_{timezone.now().strftime('%Y%m%d')}.{extension}"
+        content_type = 'application/vnd.apache.parquet' if fmt == 'parquet' else 'application/vnd.apache.arrow.stream'
+        return FileResponse(sink, as_attachment=True, filename=filename, content_type=content_type)
+
     @action(detail=True, methods=["post"], url_path="reprocess-ocr")
     def reprocess_ocr(self, request, pk=None):
         """Manually trigger OCR reprocessing."""
@@ -218,9 +279,44 @@ class InvoiceViewSet(viewsets.ModelViewSet):
         prediction = analytics_service.predict_payment_delay(invoice_data)
         return Response(prediction)
     
+    @action(detail=False, methods=["post"], url_path="bulk-predict-payment-delay")
+    def bulk_predict_payment_delay(self, request):
+        """
+        Score payment delay for many invoices at once.
+        Up to BULK_PREDICT_SYNC_LIMIT ids are scored inline; larger requests (or no ids,
+        meaning every open invoice) run as a Celery task.
+        """
+        invoice_ids = request.data.get('invoice_ids') or []
+        if not _is_id_list(invoice_ids):
+            return Response(
+                {"error": "invoice_ids must be a list of integers"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if not invoice_ids or len(invoice_ids) > self.BULK_PREDICT_SYNC_LIMIT:
+            task = bulk_predict_payment_delay.delay(invoice_ids or None)
+            return Response({
+                "message": "Payment delay scoring started",
+                "task_id": task.id
+            }, status=status.HTTP_202_ACCEPTED)
+        
+        queryset = self.get_queryset().filter(id__in=invoice_ids)
+        result = score_payment_delays(queryset)
+        return Response({
+            **result,
+            "results": list(queryset.order_by('id').values('id', 'ai_delay_probability'))
+        })
+    
     @action(detail=False, methods=["post"], url_path="bulk-ai-process")
     def bulk_ai_process(self, request):
-        """Trigger AI processing for multiple invoices"""
+        """
+        Trigger AI processing for multiple invoices.
+        
+        By default ids are processed in chunks (one task per chunk) and a single
+        batch id is returned; poll bulk-ai-process/<batch_id> or listen for
+        ai_batch_progress events. mode="per_invoice" dispatches the pipeline
+        canvas for each invoice instead.
+        """
         invoice_ids = request.data.get('invoice_ids', [])
         
         if not invoice_ids:
@@ -228,17 +324,51 @@ class InvoiceViewSet(viewsets.ModelViewSet):
                 {"error": "No invoice IDs provided"},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        if not _is_id_list(invoice_ids):
+            return Response(
+                {"error": "invoice_ids must be a list of integers"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        ids = list(self.get_queryset().filter(id__in=invoice_ids).values_list('id', flat=True))
+        if not ids:
+            return Response(
+                {"error": "None of the invoice IDs exist"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if request.data.get('mode') == 'per_invoice':
+            # Trigger the AI pipeline canvas for each invoice
+            task_ids = [start_ai_pipeline(invoice_id).id for invoice_id in ids]
+            return Response({
+                "message": f"AI processing started for {len(task_ids)} invoices",
+                "task_ids": task_ids
+            })
         
-        # Trigger AI processing for each invoice
-        task_ids = []
-        for invoice_id in invoice_ids:
-            task = process_invoice_ai_pipeline.delay(invoice_id)
-            task_ids.append(task.id)
+        try:
+            chunk_size = max(int(request.data.get('chunk_size', AI_BATCH_CHUNK_SIZE)), 1)
+        except (TypeError, ValueError):
+            return Response({"error": "chunk_size must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
         
+        created_by = request.user if request.user.is_authenticated else None
+        batch = start_ai_batch(ids, created_by=created_by, chunk_size=chunk_size)
         return Response({
-            "message": f"AI processing started for {len(invoice_ids)} invoices",
-            "task_ids": task_ids
-        })
+            "message": f"AI processing started for {batch.total} invoices",
+            "batch_id": str(batch.id),
+            "chunks": -(-batch.total // chunk_size),
+        }, status=status.HTTP_202_ACCEPTED)
+    
+    @action(detail=False, methods=["get"], url_path=r"bulk-ai-process/(?P<batch_id>[^/.]+)")
+    def bulk_ai_progress(self, request, batch_id=None):
+        """Completed/failed counts of a bulk AI processing batch"""
+        try:
+            batch_id = uuid.UUID(batch_id)
+        except ValueError:
+            return Response({"error": "Batch not found"}, status=status.HTTP_404_NOT_FOUND)
+        batch = AIProcessingBatch.objects.filter(id=batch_id).first()
+        if batch is None:
+            return Response({"error": "Batch not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(batch.progress())
     
     @action(detail=False, methods=["get"], url_path="predictive-insights")
     def predictive_insights(self, request):
@@ -263,6 +393,28 @@ class InvoiceViewSet(viewsets.ModelViewSet):
             "insights": insights,
             "generated_at": cache.get('insights_generated_at', timezone.now().isoformat())
         })
+    @action(detail=False, methods=["get"], url_path="risk-alerts")
+    def risk_alerts(self, request):
+        """Top-k high-risk invoices, paged with an (ai_risk_score, id) cursor"""
+        try:
+            threshold = float(request.query_params.get('threshold', 0.8))
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), 100)
+            after = None
+            if 'after_score' in request.query_params and 'after_id' in request.query_params:
+                after = (float(request.query_params['after_score']), int(request.query_params['after_id']))
+        except ValueError:
+            return Response(
+                {"error": "threshold, limit, after_score and after_id must be numeric"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        alerts = risk_alerts(threshold=threshold, limit=limit, after=after)
+        next_cursor = None
+        if alerts and len(alerts) == limit:
+            next_cursor = {"after_score": alerts[-1]['ai_risk_score'], "after_id": alerts[-1]['id']}
+
+        return Response({"results": alerts, "next": next_cursor})
+
     @action(detail=False, methods=["post"], url_path="ocr-upload")
     def ocr_upload(self, request):
         uploaded_file = request.FILES.get("file")
@@ -374,7 +526,8 @@ class InvoiceOCRUploadView(APIView):
 
 class WorkflowRuleViewSet(viewsets.ModelViewSet):
     """Workflow automation rule management"""
-    queryset = WorkflowRule.objects.all()
+    queryset = WorkflowRule.objects.select_related("created_by").prefetch_related("services")
+    serializer_class = WorkflowRuleSerializer
     permission_classes = [permissions.IsAuthenticated, IsManagerOrReadOnly]
     filterset_fields = ["trigger_type", "action_type", "is_active"]
     ordering_fields = ["priority", "name", "created_at"]
@@ -405,6 +558,40 @@ class WorkflowRuleViewSet(viewsets.ModelViewSet):
             "action_parameters": rule.action_parameters
         })
 
+    # A dry run that writes nothing, so open to every authenticated user
+    @action(detail=False, methods=["post"], url_path="backtest", permission_classes=[permissions.IsAuthenticated])
+    def backtest(self, request):
+        """
+        Replay draft rules ('rules') or saved ones ('rule_ids', default: the active
+        event rules) over invoices dated date_from..date_to (default: the last year).
+        Streams NDJSON: one progress record per chunk, then the per-rule result.
+        """
+        data = request.data
+        try:
+            if data.get('rules'):
+                rules = draft_rules(data['rules'])
+            elif data.get('rule_ids'):
+                rules = saved_rules(data['rule_ids'])
+            else:
+                rules = active_rules()
+            dates = {}
+            for key in ('date_from', 'date_to'):
+                dates[key] = parse_date(str(data[key])) if data.get(key) else None
+                if data.get(key) and dates[key] is None:
+                    raise BacktestError(f"{key} must be a YYYY-MM-DD date")
+            records = run_backtest(
+                rules, dates['date_from'], dates['date_to'],
+                chunk_size=int(data.get('chunk_size', BACKTEST_CHUNK_SIZE)),
+                sample_size=int(data.get('sample_size', BACKTEST_SAMPLE_SIZE)),
+            )
+        except (BacktestError, TypeError, ValueError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return StreamingHttpResponse(
+            (json.dumps(record, cls=DjangoJSONEncoder) + "\n" for record in records),
+            content_type="application/x-ndjson"
+        )
+
 
 
 class AnalyticsAPIView(APIView):
@@ -0,0 +1,528 @@
+"""
+Condition language and compiled rule set for WorkflowRule.
+
+trigger_conditions is a JSON tree:
+  {"field": "total_amount", "op": "gte", "value": 5000}
+  {"field": "current_service", "op": "in", "value": ["finance", "accounting"]}
+  {"field": "ai_risk_score", "op": "between", "value": [0.5, 0.8]}
+  {"all": [...]}, {"any": [...]}, {"not": {...}}
+An empty or null condition matches every invoice. Conditions are validated when a
+rule is saved and compiled into nested Python closures, so evaluating a rule is a
+handful of dict lookups and comparisons. The same tree is also translated into a
+Django Q, which lets apply_rules_in_bulk match and update whole querysets in SQL.
+String fields compare case-insensitively on both paths: the predicates lower-case
+both sides and the Q compares LOWER(column), matching MySQL's default collation
+on every backend.
+
+Active rules are compiled once per process into ordered tuples: event rules,
+which the outbox and the periodic automation evaluate, and time rules, which
+only run when one of their WorkflowTimers is due (see invoice.timers). The set is
+dropped when a WorkflowRule or WorkflowRuleServiceLink changes in this process;
+other processes notice through a version stamp in the shared cache, checked at
+most every RULES_VERSION_CHECK_INTERVAL seconds.
+"""
+import logging
+import operator
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, FrozenSet, Mapping, Optional, Tuple
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, DateTimeField, F, IntegerField, Q, Value, When
+from django.db.models.functions import Lower
+from django.db.models.lookups import Exact, GreaterThan, GreaterThanOrEqual, In, LessThan, LessThanOrEqual, Range
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from notifications.service import notification_service
+from .approver_load import approver_loads
+from .history import recording_history
+from .models import Invoice, InvoiceHistory, WorkflowRule, WorkflowRuleServiceLink
+
+logger = logging.getLogger(__name__)
+
+Predicate = Callable[[Mapping[str, Any]], bool]
+
+# Fields a condition may test, with the type values are coerced to
+RULE_FIELDS: Dict[str, type] = {
+    'total_amount': float,
+    'subtotal': float,
+    'tax_amount': float,
+    'ai_risk_score': float,
+    'ai_priority_score': float,
+    'ai_delay_probability': float,
+    'vendor_name': str,
+    'current_service': str,
+    'currency': str,
+    'status': str,
+    'priority': str,
+}
+COMPARISONS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'gt': operator.gt,
+    'gte': operator.ge,
+}
+SET_OPERATORS = ('in', 'not_in')
+RANGE_OPERATORS = ('between',)
+SQL_LOOKUPS = {
+    'eq': Exact, 'lt': LessThan, 'lte': LessThanOrEqual, 'gt': GreaterThan, 'gte': GreaterThanOrEqual,
+    'in': In, 'between': Range,
+}
+MAX_DEPTH = 20
+UPDATE_BATCH_SIZE = 5000
+
+RULES_VERSION_KEY = 'invoice:workflow_rules:version'
+RULES_VERSION_CHECK_INTERVAL = 5
+
+
+class RuleConditionError(ValueError):
+    pass
+
+
+def _coerce(field: str, value: Any) -> Any:
+    kind = RULE_FIELDS[field]
+    if kind is float and (isinstance(value, bool) or not isinstance(value, (int, float, str))):
+        raise RuleConditionError(f"'{field}' compares against numbers, got {value!r}")
+    try:
+        value = kind(value)
+    except (TypeError, ValueError):
+        raise RuleConditionError(f"'{field}' compares against numbers, got {value!r}")
+    return value.lower() if kind is str else value
+
+
+def _leaf(node: Mapping[str, Any]) -> Predicate:
+    field, op = node.get('field'), node.get('op')
+    if field not in RULE_FIELDS:
+        raise RuleConditionError(f"Unknown field {field!r}; allowed: {', '.join(sorted(RULE_FIELDS))}")
+    if 'value' not in node:
+        raise RuleConditionError(f"Condition on '{field}' has no value")
+    value = node['value']
+    kind = RULE_FIELDS[field]
+
+    def read(data, _field=field, _kind=kind):
+        raw = data.get(_field)
+        if raw is None:
+            return None
+        try:
+            raw = _kind(raw)
+        except (TypeError, ValueError):
+            return None
+        return raw.lower() if _kind is str else raw
+
+    if op in COMPARISONS:
+        compare, expected = COMPARISONS[op], _coerce(field, value)
+
+        def predicate(data):
+            actual = read(data)
+            return actual is not None and compare(actual, expected)
+        return predicate
+
+    if op in SET_OPERATORS:
+        if not isinstance(value, (list, tuple)) or not value:
+            raise RuleConditionError(f"'{op}' on '{field}' needs a non-empty list")
+        members, negate = frozenset(_coerce(field, item) for item in value), op == 'not_in'
+
+        def predicate(data):
+            actual = read(data)
+            return actual is not None and (actual in members) != negate
+        return predicate
+
+    if op in RANGE_OPERATORS:
+        if not isinstance(value, (list, tuple)) or len(value) != 2:
+            raise RuleConditionError(f"'between' on '{field}' needs [low, high]")
+        low, high = (_coerce(field, item) for item in value)
+        if low > high:
+            raise RuleConditionError(f"'between' on '{field}' has low > high")
+
+        def predicate(data):
+            actual = read(data)
+            return actual is not None and low <= actual <= high
+        return predicate
+
+    raise RuleConditionError(
+        f"Unknown operator {op!r}; allowed: {', '.join([*COMPARISONS, *SET_OPERATORS, *RANGE_OPERATORS])}"
+    )
+
+
+def _compile(node: Any, depth: int) -> Predicate:
+    if depth > MAX_DEPTH:
+        raise RuleConditionError(f"Conditions nest deeper than {MAX_DEPTH} levels")
+    if not isinstance(node, Mapping):
+        raise RuleConditionError(f"Expected a condition object, got {node!r}")
+
+    if 'all' in node or 'any' in node:
+        combinator = 'all' if 'all' in node else 'any'
+        children = node[combinator]
+        if len(node) != 1 or not isinstance(children, list) or not children:
+            raise RuleConditionError(f"'{combinator}' must be the only key and hold a non-empty list")
+        predicates = tuple(_compile(child, depth + 1) for child in children)
+        if combinator == 'all':
+            return lambda data: all(predicate(data) for predicate in predicates)
+        return lambda data: any(predicate(data) for predicate in predicates)
+
+    if 'not' in node:
+        if len(node) != 1:
+            raise RuleConditionError("'not' must be the only key")
+        inner = _compile(node['not'], depth + 1)
+        return lambda data: not inner(data)
+
+    unknown = set(node) - {'field', 'op', 'value'}
+    if unknown:
+        raise RuleConditionError(f"Unexpected keys {sorted(unknown)}")
+    return _leaf(node)
+
+
+def _always(data) -> bool:
+    return True
+
+
+def compile_conditions(conditions: Any) -> Predicate:
+    """Validate trigger_conditions and return a predicate over an invoice dict."""
+    if not conditions:
+        return _always
+    return _compile(conditions, 0)
+
+
+def _leaf_q(node: Mapping[str, Any]) -> Q:
+    field, op, value = node['field'], node['op'], node['value']
+    if op in SET_OPERATORS or op in RANGE_OPERATORS:
+        value = [_coerce(field, item) for item in value]
+    else:
+        value = _coerce(field, value)
+    column = Lower(field) if RULE_FIELDS[field] is str else F(field)
+    if op in ('ne', 'not_in'):
+        # Like the predicates, a missing value never satisfies a comparison
+        lookup = Exact if op == 'ne' else In
+        return ~Q(lookup(column, value)) & Q(**{f'{field}__isnull': False})
+    return Q(SQL_LOOKUPS[op](column, value))
+
+
+def _to_q(node: Mapping[str, Any]) -> Q:
+    if 'all' in node or 'any' in node:
+        children = [_to_q(child) for child in node.get('all') or node.get('any')]
+        combined = children[0]
+        for child in children[1:]:
+            combined = (combined & child) if 'all' in node else (combined | child)
+        return combined
+    if 'not' in node:
+        return ~_to_q(node['not'])
+    return _leaf_q(node)
+
+
+def conditions_to_q(conditions: Any) -> Q:
+    """The Q equivalent of compile_conditions(conditions); validates first."""
+    compile_conditions(conditions)
+    return _to_q(conditions) if conditions else Q()
+
+
+def validate_conditions(conditions: Any):
+    """Raise django ValidationError for an invalid trigger_conditions tree."""
+    try:
+        compile_conditions(conditions)
+    except RuleConditionError as e:
+        raise ValidationError({'trigger_conditions': str(e)})
+
+
+def validate_timing(trigger_type: str, due_offset_days: Optional[int]):
+    """Time rules need a due-date offset; other rules must not have one."""
+    if trigger_type == 'time' and due_offset_days is None:
+        raise ValidationError({'due_offset_days': "Time rules need a due date offset in days"})
+    if trigger_type != 'time' and due_offset_days is not None:
+        raise ValidationError({'due_offset_days': "Only time rules fire relative to the due date"})
+
+
+def invoice_rule_data(invoice: Invoice) -> Dict[str, Any]:
+    """The RULE_FIELDS of an invoice, as rules see them."""
+    return {field: getattr(invoice, field) for field in RULE_FIELDS}
+
+
+@dataclass(frozen=True)
+class CompiledRule:
+    id: int
+    name: str
+    priority: int
+    action_type: str
+    action_parameters: Mapping[str, Any]
+    trigger_type: str
+    due_offset_days: Optional[int]
+    services: FrozenSet[str]     # enabled linked service names/codes; empty means every service
+    predicate: Predicate
+    q: Q                         # same test as matches(), for querysets
+
+    def matches(self, data: Mapping[str, Any]) -> bool:
+        if self.services and str(data.get('current_service') or '').lower() not in self.services:
+            return False
+        return self.predicate(data)
+
+
+def compile_rule(rule: WorkflowRule, services: FrozenSet[str] = frozenset()) -> CompiledRule:
+    return CompiledRule(
+        id=rule.id,
+        name=rule.name,
+        priority=rule.priority,
+        action_type=rule.action_type,
+        action_parameters=rule.action_parameters or {},
+        trigger_type=rule.trigger_type,
+        due_offset_days=rule.due_offset_days,
+        services=services,
+        predicate=compile_conditions(rule.trigger_conditions),
+        q=_service_q(services) & conditions_to_q(rule.trigger_conditions),
+    )
+
+
+def _service_q(services: FrozenSet[str]) -> Q:
+    q = Q()
+    for service in sorted(services):
+        q |= Q(current_service__iexact=service)
+    return q
+
+
+def linked_services(rule_ids=None) -> Dict[int, FrozenSet[str]]:
+    """Lower-cased names and codes of each rule's enabled services, in one query."""
+    links = WorkflowRuleServiceLink.objects.filter(is_enabled=True)
+    if rule_ids is not None:
+        links = links.filter(workflow_rule_id__in=rule_ids)
+    services: Dict[int, set] = {}
+    for rule_id, name, code in links.values_list('workflow_rule_id', 'service__name', 'service__code'):
+        services.setdefault(rule_id, set()).update(value.lower() for value in (name, code) if value)
+    return {rule_id: frozenset(values) for rule_id, values in services.items()}
+
+
+class RuleSetCache:
+    """Process-wide compiled rule set (active rules in priority order)."""
+
+    def __init__(self, check_interval: float = RULES_VERSION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._rules: Optional[Tuple[CompiledRule, ...]] = None
+        self._timed: Tuple[CompiledRule, ...] = ()
+        self._by_id: Dict[int, CompiledRule] = {}
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _shared_version(self):
+        return cache.get(RULES_VERSION_KEY, 0)
+
+    def _load(self) -> Tuple[CompiledRule, ...]:
+        services = linked_services()
+        compiled = []
+        for rule in WorkflowRule.objects.filter(is_active=True).order_by('priority', 'id'):
+            try:
+                compiled.append(compile_rule(rule, services.get(rule.id, frozenset())))
+            except RuleConditionError as e:
+                # Written around save() (e.g. QuerySet.update); skip rather than break every evaluation
+                logger.error(f"Workflow rule {rule.id} has invalid conditions and is skipped: {e}")
+        return tuple(compiled)
+
+    def rules(self) -> Tuple[CompiledRule, ...]:
+        """Active event rules."""
+        rules, now = self._rules, time.monotonic()
+        if rules is not None and now - self._checked_at < self.check_interval:
+            return rules
+        with self._lock:
+            version = self._shared_version()
+            if self._rules is None or version != self._version:
+                loaded = self._load()
+                self._rules = tuple(rule for rule in loaded if rule.trigger_type != 'time')
+                self._timed = tuple(rule for rule in loaded if rule.trigger_type == 'time')
+                self._by_id = {rule.id: rule for rule in loaded}
+                self._version = version
+            self._checked_at = now
+            return self._rules
+
+    def timed_rules(self) -> Tuple[CompiledRule, ...]:
+        """Active time rules."""
+        self.rules()
+        return self._timed
+
+    def get(self, rule_id: int) -> Optional[CompiledRule]:
+        self.rules()
+        return self._by_id.get(rule_id)
+
+    def invalidate(self):
+        """Drop the local set and tell other processes to reload theirs."""
+        with self._lock:
+            self._rules = None
+            self._timed = ()
+            self._by_id = {}
+        try:
+            cache.incr(RULES_VERSION_KEY)
+        except ValueError:
+            cache.set(RULES_VERSION_KEY, 1, None)
+
+
+rule_set = RuleSetCache()
+
+
+def active_rules() -> Tuple[CompiledRule, ...]:
+    return rule_set.rules()
+
+
+def first_matching_rule(data: Mapping[str, Any]) -> Optional[CompiledRule]:
+    """The highest-priority active rule matching the invoice dict."""
+    for rule in rule_set.rules():
+        if rule.matches(data):
+            return rule
+    return None
+
+
+@receiver([post_save, post_delete], sender=WorkflowRule)
+@receiver([post_save, post_delete], sender=WorkflowRuleServiceLink)
+def invalidate_rule_set(sender, **kwargs):
+    rule_set.invalidate()
+
+
+@receiver(m2m_changed, sender=WorkflowRule.services.through)
+def invalidate_rule_set_on_links(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        rule_set.invalidate()
+
+
+# Set-based application of rule actions
+
+def _rule_action(rule: CompiledRule, now) -> Optional[Tuple[Dict[str, Any], Optional[Dict[str, Any]]]]:
+    """
+    (field updates, history fields) for a rule's action, or None when the action
+    cannot be applied (invoices then fall through to the next matching rule).
+    """
+    params = rule.action_parameters
+    if rule.action_type in ('auto_approve', 'approve'):
+        return (
+            {'status': Invoice.Status.APPROVED, 'approved_at': now},
+            {'action': f"Auto-approved by workflow rule: {rule.name}",
+             'action_type': InvoiceHistory.ActionType.APPROVAL, 'to_status': Invoice.Status.APPROVED},
+        )
+    if rule.action_type == 'require_approval':
+        return (
+            {'status': Invoice.Status.PENDING_APPROVAL},
+            {'action': f"Approval required by workflow rule: {rule.name}",
+             'action_type': InvoiceHistory.ActionType.STATUS_CHANGE, 'to_status': Invoice.Status.PENDING_APPROVAL},
+        )
+    if rule.action_type == 'set_priority':
+        priority = params.get('priority', Invoice.Priority.MEDIUM)
+        if priority not in Invoice.Priority.values:
+            return None
+        return (
+            {'priority': priority, 'priority_source': Invoice.PrioritySource.RULE},
+            {'action': f"Priority set to {priority} by workflow rule: {rule.name}",
+             'action_type': InvoiceHistory.ActionType.PRIORITY_CHANGED},
+        )
+    if rule.action_type in ('assign_user', 'assign'):
+        from django.contrib.auth import get_user_model
+        user = get_user_model().objects.filter(id=params.get('user_id')).first() if params.get('user_id') else None
+        if user is None:
+            return None
+        return (
+            {'assigned_to': user},
+            {'action': f"Assigned to {user.name} by workflow rule: {rule.name}",
+             'action_type': InvoiceHistory.ActionType.ASSIGNMENT_CHANGE, 'metadata': {'assigned_to': str(user.id)}},
+        )
+    # Other actions only claim the invoice, as before
+    return {}, None
+
+
+def apply_rules_in_bulk(queryset, rules: Optional[Tuple[CompiledRule, ...]] = None) -> Dict[int, Dict[str, Any]]:
+    """
+    Apply each invoice's first matching rule to a whole queryset.
+
+    One query tags every matching invoice with its first applicable rule (a CASE
+    over the rules' Q, in priority order), so all rules see the invoices as they
+    were before any action ran. Each rule's action is then one UPDATE (per
+    UPDATE_BATCH_SIZE invoices); the history rows of all rules are written with
+    one bulk insert, in the same transaction.
+    Assignees get one summary notification per rule once the transaction commits.
+    Returns {rule_id: {'rule': CompiledRule, 'invoice_ids': [...]}} for rules that applied.
+    """
+    rules = active_rules() if rules is None else rules
+    now = timezone.now()
+    applicable = [(rule, action) for rule in rules if (action := _rule_action(rule, now)) is not None]
+    if not applicable:
+        return {}
+
+    first_match = Case(
+        *[When(rule.q or Q(pk__isnull=False), then=Value(rule.id)) for rule, _ in applicable],
+        default=Value(None),
+        output_field=IntegerField(),
+    )
+    claims: Dict[int, list] = {}
+    for invoice_id, status, rule_id in (queryset.annotate(workflow_rule_id=first_match)
+                                        .filter(workflow_rule_id__isnull=False).order_by('id')
+                                        .values_list('id', 'status', 'workflow_rule_id')):
+        claims.setdefault(rule_id, []).append((invoice_id, status))
+
+    applied = {}
+    # History for every rule is buffered and written with one INSERT
+    with transaction.atomic(), recording_history() as recorder:
+        for rule, (updates, history) in applicable:
+            claimed = claims.get(rule.id)
+            if not claimed:
+                continue
+            invoice_ids = [invoice_id for invoice_id, _ in claimed]
+            if updates:
+                for start in range(0, len(invoice_ids), UPDATE_BATCH_SIZE):
+                    Invoice.objects.filter(id__in=invoice_ids[start:start + UPDATE_BATCH_SIZE]).update(
+                        **updates, updated_at=now,
+                    )
+            if history:
+                metadata = {'workflow_rule_id': rule.id, **history.get('metadata', {})}
+                for invoice_id, status in claimed:
+                    recorder.record(invoice_id, from_status=status if 'to_status' in history else None,
+                                    **{**history, 'metadata': metadata})
+            if 'status' in updates or 'assigned_to' in updates:
+                # QuerySet.update skips the signals that keep approver loads current
+                transaction.on_commit(approver_loads.invalidate)
+            if updates.get('assigned_to') is not None:
+                assignee = updates['assigned_to']
+                transaction.on_commit(lambda assignee=assignee, ids=invoice_ids, name=rule.name:
+                                      notification_service.send_assignment_summary(assignee, ids, name))
+            applied[rule.id] = {'rule': rule, 'invoice_ids': invoice_ids}
+            logger.info(f"Workflow rule {rule.id} ({rule.name}) applied to {len(invoice_ids)} invoices")
+    return applied
+
+
+def apply_rules_isolating_failures(queryset, invoice_ids, rules: Optional[Tuple[CompiledRule, ...]] = None
+                                   ) -> Tuple[int, Dict[int, str]]:
+    """
+    apply_rules_in_bulk over the given invoices of queryset, in a savepoint. If the
+    batch raises, its invoices are retried one at a time so a single bad invoice
+    does not hold the others back. Returns (invoices routed, {invoice_id: error}).
+    """
+    try:
+        with transaction.atomic():
+            applied = apply_rules_in_bulk(queryset.filter(id__in=invoice_ids), rules)
+        return sum(len(item['invoice_ids']) for item in applied.values()), {}
+    except Exception as e:
+        logger.warning(f"Workflow rules failed for a batch of {len(invoice_ids)} invoices ({e}); retrying one by one")
+
+    routed, failures = 0, {}
+    for invoice_id in invoice_ids:
+        try:
+            with transaction.atomic():
+                applied = apply_rules_in_bulk(queryset.filter(id=invoice_id), rules)
+            routed += sum(len(item['invoice_ids']) for item in applied.values())
+        except Exception as e:
+            logger.error(f"Workflow rules failed for invoice {invoice_id}: {e}")
+            failures[invoice_id] = str(e)
+    return routed, failures
+
+
+def record_routing_failure(queryset, error: str, max_attempts: int, now=None) -> int:
+    """
+    Count a failed attempt on outbox/timer rows and keep the error; rows reaching
+    max_attempts are dead-lettered (failed_at set) and no longer claimed.
+    """
+    now = now or timezone.now()
+    # failed_at is assigned first and reads the old attempts: MySQL evaluates SET left to right
+    return queryset.update(
+        failed_at=Case(When(attempts__gte=max_attempts - 1, then=Value(now)), default=Value(None),
+                       output_field=DateTimeField()),
+        attempts=F('attempts') + 1,
+        error=error,
+    )
@@ -0,0 +1,176 @@
+"""
+Queued, batched email delivery.
+
+queue_email() / queue_emails() write QueuedEmail rows instead of talking to SMTP,
+and after commit schedule the deliver_queued_emails task (at most one per
+DELIVERY_DEBOUNCE_SECONDS; a one-minute beat entry picks up anything left over).
+
+deliver_queued() reads pending rows in id order, EMAIL_BATCH_SIZE at a time.
+Only one delivery run sends at a time (acquire_run_lock), so EMAIL_RATE_LIMIT
+holds across overlapping beat and on-commit runs, and rows need no database
+locks: a batch is read, sent outside any transaction, and its outcome written
+back in one short transaction.
+Each batch renders its HTML templates with one lookup of the users and invoices
+the batch refers to, and goes out over a single SMTP connection from
+get_connection(), so the TCP/TLS handshake and login happen once per batch
+instead of once per message. Messages are handed to send_messages() one at a
+time on that open connection, so a refused recipient fails only its own row;
+failed rows are retried on later runs, up to MAX_ATTEMPTS. Sending is paced to
+EMAIL_RATE_LIMIT messages per second across the whole run.
+"""
+import logging
+import time
+from typing import Any, Dict, Iterable, Mapping, Optional
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.template.loader import get_template
+from django.utils import timezone
+
+from invoice.models import Invoice
+from .models import QueuedEmail
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_LOCK_KEY = 'notifications:email_delivery:scheduled'
+RUN_LOCK_KEY = 'notifications:email_delivery:running'
+DELIVERY_DEBOUNCE_SECONDS = 2
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_RATE_LIMIT = 10.0
+MAX_ATTEMPTS = 3
+
+
+def _setting(name: str, default):
+    return getattr(settings, 'NOTIFICATION_SETTINGS', {}).get(name, default)
+
+
+def _queued(to: str, subject: str, body: str, template: str = '', context: Optional[Mapping[str, Any]] = None):
+    return QueuedEmail(to=to, subject=subject[:255], body=body, template=template, context=dict(context or {}))
+
+
+def queue_email(to: str, subject: str, body: str, template: str = '',
+                context: Optional[Mapping[str, Any]] = None) -> QueuedEmail:
+    """Queue one message in the caller's transaction; delivery is scheduled once it commits."""
+    email = _queued(to, subject, body, template, context)
+    email.save()
+    transaction.on_commit(schedule_delivery)
+    return email
+
+
+def queue_emails(messages: Iterable[Mapping[str, Any]]) -> int:
+    """Queue many messages (dicts of queue_email's arguments) with one INSERT per batch."""
+    emails = [_queued(**message) for message in messages]
+    if emails:
+        QueuedEmail.objects.bulk_create(emails, batch_size=1000)
+        transaction.on_commit(schedule_delivery)
+    return len(emails)
+
+
+def schedule_delivery():
+    if cache.add(DELIVERY_LOCK_KEY, True, DELIVERY_DEBOUNCE_SECONDS):
+        from .tasks import deliver_queued_emails
+        deliver_queued_emails.apply_async(countdown=DELIVERY_DEBOUNCE_SECONDS)
+
+
+def acquire_run_lock(timeout: int) -> bool:
+    """Only one delivery run sends at a time; the lock expires on its own if a worker dies."""
+    return cache.add(RUN_LOCK_KEY, timezone.now().isoformat(), timeout)
+
+
+def release_run_lock():
+    cache.delete(RUN_LOCK_KEY)
+
+
+def _render(emails) -> list:
+    """EmailMultiAlternatives for a batch; templates and referenced objects are loaded once per batch."""
+    user_ids = {e.context['user_id'] for e in emails if e.context.get('user_id')}
+    invoice_ids = {e.context['invoice_id'] for e in emails if e.context.get('invoice_id')}
+    # Keys come back from JSON as strings (user ids are UUIDs)
+    users = {str(pk): user for pk, user in get_user_model().objects.in_bulk(user_ids).items()} if user_ids else {}
+    invoices = {str(pk): invoice for pk, invoice in Invoice.objects.in_bulk(invoice_ids).items()} if invoice_ids else {}
+    templates = {}
+
+    messages = []
+    for email in emails:
+        message = EmailMultiAlternatives(email.subject, email.body, settings.DEFAULT_FROM_EMAIL, [email.to])
+        if email.template:
+            if email.template not in templates:
+                templates[email.template] = get_template(email.template)
+            context = {
+                **email.context,
+                'user': users.get(str(email.context.get('user_id'))),
+                'invoice': invoices.get(str(email.context.get('invoice_id'))),
+            }
+            message.attach_alternative(templates[email.template].render(context), 'text/html')
+        messages.append(message)
+    return messages
+
+
+def deliver_queued(batch_size: Optional[int] = None, rate_limit: Optional[float] = None,
+                   max_batches: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Send pending emails batch by batch (see module docstring); returns counts and
+    messages per second. Callers hold the run lock.
+    """
+    batch_size = batch_size or _setting('EMAIL_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    rate_limit = _setting('EMAIL_RATE_LIMIT', DEFAULT_RATE_LIMIT) if rate_limit is None else rate_limit
+    started = time.monotonic()
+    sent = failed = batches = last_id = 0
+    while max_batches is None or batches < max_batches:
+        # Rows that fail stay pending; paging by id tries each at most once per run
+        emails = list(
+            QueuedEmail.objects.filter(status=QueuedEmail.Status.PENDING, id__gt=last_id).order_by('id')[:batch_size]
+        )
+        if not emails:
+            break
+        batches += 1
+        last_id = emails[-1].id
+        delivered, errors = [], {}
+        connection = get_connection(fail_silently=False)
+        try:
+            with connection:
+                for email, message in zip(emails, _render(emails)):
+                    if rate_limit:
+                        # Pace the whole run, not each batch, to the configured rate
+                        delay = (sent + len(delivered)) / rate_limit - (time.monotonic() - started)
+                        if delay > 0:
+                            time.sleep(delay)
+                    try:
+                        connection.send_messages([message])
+                        delivered.append(email.id)
+                    except Exception as e:
+                        errors[email.id] = str(e)
+        except Exception as e:
+            # The connection itself failed; everything not yet sent is retried later
+            errors.update({email.id: str(e) for email in emails if email.id not in delivered})
+
+        now = timezone.now()
+        for email in emails:
+            if email.id in errors:
+                email.attempts += 1
+                email.error = errors[email.id]
+                if email.attempts >= MAX_ATTEMPTS:
+                    email.status = QueuedEmail.Status.FAILED
+        retried = [email for email in emails if email.id in errors]
+        with transaction.atomic():
+            QueuedEmail.objects.filter(id__in=delivered).update(status=QueuedEmail.Status.SENT, sent_at=now)
+            if retried:
+                QueuedEmail.objects.bulk_update(retried, ['attempts', 'error', 'status'])
+        sent += len(delivered)
+        failed += len(errors)
+        if errors and len(errors) == len(emails):
+            # Nothing got through; leave the rest for the next run
+            break
+
+    elapsed = time.monotonic() - started
+    if sent or failed:
+        logger.info(f"Email delivery: {sent} sent, {failed} failed in {batches} batches ({elapsed:.2f}s)")
+    return {
+        'sent': sent,
+        'failed': failed,
+        'batches': batches,
+        'messages_per_second': round(sent / elapsed, 1) if elapsed else 0.0,
+    }
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.5 on 2026-10-19 05:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0006_queuedemail"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="queuedemail",
+            name="queued_email_pending_idx",
+        ),
+        migrations.AddIndex(
+            model_name="queuedemail",
+            index=models.Index(fields=["status", "id"], name="queued_email_status_idx"),
+        ),
+    ]
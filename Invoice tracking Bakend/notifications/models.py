@@ -1,5 +1,6 @@
 from django.db import models
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from auditlog.registry import auditlog
 # Create your models here.
 class Notification(models.Model):
@@ -40,4 +41,32 @@ class UserNotification(models.Model):
     def __str__(self):
         return f"{self.user.username} ↔ {self.notif.title}"
 
+class QueuedEmail(models.Model):
+    """Outgoing email waiting for the delivery task (see notifications.email_delivery)."""
+    class Status(models.TextChoices):
+        PENDING = "pending", "Pending"
+        SENT = "sent", "Sent"
+        FAILED = "failed", "Failed"
+
+    to = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    # HTML alternative rendered at delivery time; user_id / invoice_id in the context load those objects
+    template = models.CharField(max_length=255, blank=True)
+    context = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Delivery pages pending rows by id; a partial index would lose its condition on MySQL
+            models.Index(fields=["status", "id"], name="queued_email_status_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {self.to} ({self.status})"
+
 auditlog.register(Notification)
@@ -100,6 +100,19 @@ class NotificationService:
         except Exception as e:
             logger.error(f"Failed to send approval request for invoice {invoice.id}: {e}")
     
+    def send_assignment_summary(self, assignee: User, invoice_ids: List[int], rule_name: str):
+        """One notification for all invoices a workflow rule assigned in a run"""
+        try:
+            self._send_notification(
+                user=assignee,
+                title="Invoices Assigned",
+                message=f"{len(invoice_ids)} invoice(s) were assigned to you by workflow rule '{rule_name}'",
+                notification_type='info',
+                priority='medium'
+            )
+        except Exception as e:
+            logger.error(f"Failed to send assignment summary for rule {rule_name}: {e}")
+    
     def _get_notification_recipients(self, invoice: Invoice) -> List[User]:
         """Get list of users who should receive notifications for this invoice"""
         recipients = []
@@ -158,28 +171,22 @@ class NotificationService:
         return notification
     
     def _send_email_notification(self, user: User, title: str, message: str, invoice: Invoice = None):
-        """Send email notification"""
+        """Queue an email notification; it is rendered and sent in a batch by the delivery task"""
         try:
-            from django.core.mail import send_mail
-            from django.template.loader import render_to_string
-            
-            context = {
-                'user': user,
-                'title': title,
-                'message': message,
-                'invoice': invoice,
-                'app_url': getattr(settings, 'FRONTEND_URL', 'https://default-frontend-url.com')
-            }
-            
-            html_message = render_to_string('emails/notification.html', context)
+            from .email_delivery import queue_email
             
-            send_mail(
+            queue_email(
+                to=user.email,
                 subject=title,
-                message=message,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=[user.email],
-                html_message=html_message,
-                fail_silently=True
+                body=message,
+                template='emails/notification.html',
+                context={
+                    'title': title,
+                    'message': message,
+                    'user_id': user.id,
+                    'invoice_id': invoice.id if invoice else None,
+                    'app_url': getattr(settings, 'FRONTEND_URL', 'https://default-frontend-url.com')
+                }
             )
             
         except Exception as e:
@@ -1,7 +1,6 @@
 from celery import shared_task
 from django.db import transaction, models
 from django.db.models import Count, Avg
-from django.core.mail import send_mail
 from django.conf import settings
 from django.utils import timezone
 from datetime import datetime, timedelta
@@ -9,64 +8,57 @@ from decimal import Decimal, InvalidOperation
 import logging
 
 from invoice.models import Invoice
+from .email_delivery import acquire_run_lock, deliver_queued, queue_emails, release_run_lock
 
 @shared_task
 def send_due_reminders() -> dict:
-    """Send email reminders for upcoming due invoices."""
+    """Queue email reminders for upcoming due invoices."""
     try:
+        today = timezone.now().date()
+        open_statuses = [Invoice.Status.APPROVED, Invoice.Status.PENDING_APPROVAL]
         # Find invoices due in 3 days
-        due_soon = timezone.now().date() + timedelta(days=3)
+        due_soon = today + timedelta(days=3)
         upcoming_invoices = Invoice.objects.filter(
             due_date__lte=due_soon,
-            due_date__gte=timezone.now().date(),
-            status__in=[Invoice.Status.APPROVED, Invoice.Status.PENDING]
-        ).select_related('supplier', 'created_by')
+            due_date__gte=today,
+            status__in=open_statuses
+        )
         
         # Find overdue invoices
         overdue_invoices = Invoice.objects.filter(
-            due_date__lt=timezone.now().date(),
-            status__in=[Invoice.Status.APPROVED, Invoice.Status.PENDING]
-        ).select_related('supplier', 'created_by')
+            due_date__lt=today,
+            status__in=open_statuses
+        )
         
-        sent_count = 0
+        columns = ('number', 'vendor_name', 'total_amount', 'due_date', 'created_by__email')
+        reminders = []
         
-        # Send reminders for upcoming invoices
-        for invoice in upcoming_invoices:
-            try:
-                send_mail(
-                    subject=f"Invoice {invoice.number} Due Soon",
-                    message=f"Invoice {invoice.number} from {invoice.supplier.name} "
-                           f"for ${invoice.amount} is due on {invoice.due_date}",
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    recipient_list=[invoice.created_by.email],
-                    fail_silently=False
-                )
-                sent_count += 1
-            except Exception as e:
-                logging.error(f"Failed to send reminder for invoice {invoice.id}: {e}")
+        # Reminders for upcoming invoices
+        for number, vendor_name, total_amount, due_date, email in upcoming_invoices.values_list(*columns):
+            reminders.append({
+                'to': email,
+                'subject': f"Invoice {number} Due Soon",
+                'body': f"Invoice {number} from {vendor_name} for {total_amount} is due on {due_date}",
+            })
+        upcoming_count = len(reminders)
         
-        # Send overdue notifications
-        for invoice in overdue_invoices:
-            try:
-                days_overdue = (timezone.now().date() - invoice.due_date).days
-                send_mail(
-                    subject=f"OVERDUE: Invoice {invoice.number}",
-                    message=f"Invoice {invoice.number} from {invoice.supplier.name} "
-                           f"for ${invoice.amount} is {days_overdue} days overdue!",
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    recipient_list=[invoice.created_by.email],
-                    fail_silently=False
-                )
-                sent_count += 1
-            except Exception as e:
-                logging.error(f"Failed to send overdue notice for invoice {invoice.id}: {e}")
+        # Overdue notifications
+        for number, vendor_name, total_amount, due_date, email in overdue_invoices.values_list(*columns):
+            days_overdue = (today - due_date).days
+            reminders.append({
+                'to': email,
+                'subject': f"OVERDUE: Invoice {number}",
+                'body': f"Invoice {number} from {vendor_name} for {total_amount} is {days_overdue} days overdue!",
+            })
         
-        logging.info(f"Sent {sent_count} due date reminders")
+        # Sent in batches over one SMTP connection each by deliver_queued_emails
+        queued_count = queue_emails(reminders)
+        logging.info(f"Queued {queued_count} due date reminders")
         return {
             "success": True,
-            "upcoming_count": upcoming_invoices.count(),
-            "overdue_count": overdue_invoices.count(),
-            "sent_count": sent_count
+            "upcoming_count": upcoming_count,
+            "overdue_count": queued_count - upcoming_count,
+            "queued_count": queued_count
         }
         
     except Exception as e:
@@ -74,6 +66,21 @@ def send_due_reminders() -> dict:
         return {"success": False, "error": str(e)}
 
 
+@shared_task
+def deliver_queued_emails(batch_size: int = None, rate_limit: float = None) -> dict:
+    """Send queued emails in batches, one SMTP connection per batch (see notifications.email_delivery)."""
+    if not acquire_run_lock(timeout=getattr(settings, 'CELERY_TASK_TIME_LIMIT', 30 * 60)):
+        # The running delivery picks up what was queued since it started
+        return {"success": True, "skipped": True}
+    try:
+        return {"success": True, **deliver_queued(batch_size=batch_size, rate_limit=rate_limit)}
+    except Exception as e:
+        logging.error(f"Email delivery failed: {e}")
+        return {"success": False, "error": str(e)}
+    finally:
+        release_run_lock()
+
+
 @shared_task
 def send_automated_reminders() -> dict:
     """Send automated reminders for due invoices with configurable timing"""
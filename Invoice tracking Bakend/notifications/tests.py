@@ -1,3 +1,100 @@
+import socket
+import time
+from decimal import Decimal
+
+import pytest
+from aiosmtpd.controller import Controller
 from django.test import TestCase
 
+from users.models import User
+
 # Create your tests here.
+
+
+class RecordingSMTPHandler:
+    """aiosmtpd handler that keeps every session and message and refuses bounce@ recipients."""
+
+    def __init__(self):
+        self.sessions = []
+        self.messages = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith("bounce@"):
+            return "550 No such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.sessions.append(session)
+        self.messages.append(envelope.content.decode("utf8", errors="replace"))
+        return "250 Message accepted for delivery"
+
+    @property
+    def connections(self):
+        return len({id(session) for session in self.sessions})
+
+
+@pytest.fixture
+def smtp_server(settings):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    handler = RecordingSMTPHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    settings.EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+    settings.EMAIL_HOST, settings.EMAIL_PORT = "127.0.0.1", port
+    settings.EMAIL_HOST_USER = settings.EMAIL_HOST_PASSWORD = ""
+    settings.EMAIL_USE_TLS = False
+    yield handler
+    controller.stop()
+
+
+@pytest.mark.django_db
+def test_queued_emails_go_out_in_batches_over_one_connection(smtp_server):
+    from departments.models import Service
+    from invoice.models import Invoice
+    from .email_delivery import acquire_run_lock, deliver_queued, queue_emails, release_run_lock
+    from .models import QueuedEmail
+    from .service import notification_service
+    from .tasks import deliver_queued_emails
+
+    user = User.objects.create_user(email="notify@example.com", password="secret", name="Notify User",
+                                    role="manager", service_id=Service.objects.create(name="Finance", code="FIN"))
+    invoice = Invoice.objects.create(
+        number="MAIL-1", vendor_name="Acme Corp", subtotal=Decimal("100"), tax_amount=Decimal("0"),
+        total_amount=Decimal("100"), invoice_date="2025-01-01", issue_date="2025-01-01", due_date="2025-02-01",
+        current_service="FIN", created_by=user,
+    )
+    queue_emails({"to": f"user{i}@example.com", "subject": f"Reminder {i}", "body": "Due soon"} for i in range(249))
+    notification_service._send_email_notification(user, "Invoice Approval Required", "Please review", invoice)
+
+    result = deliver_queued_emails(batch_size=100, rate_limit=0)
+    assert result["success"] and (result["sent"], result["failed"], result["batches"]) == (250, 0, 3)
+    assert len(smtp_server.messages) == 250
+    assert smtp_server.connections == 3  # one SMTP session per batch, not per message
+    assert result["messages_per_second"] > 0
+    templated = next(m for m in smtp_server.messages if "Invoice Approval Required" in m)
+    assert "text/html" in templated and "Notify User" in templated and "MAIL-1" in templated
+    assert not QueuedEmail.objects.exclude(status=QueuedEmail.Status.SENT).exists()
+
+    # A refused recipient fails only its own message, which stays queued for a retry
+    queue_emails([{"to": "bounce@example.com", "subject": "Bounce", "body": "x"},
+                  {"to": "ok@example.com", "subject": "Fine", "body": "x"}])
+    assert deliver_queued(rate_limit=0)["sent"] == 1
+    bounced = QueuedEmail.objects.get(to="bounce@example.com")
+    assert (bounced.status, bounced.attempts) == (QueuedEmail.Status.PENDING, 1) and "550" in bounced.error
+    bounced.delete()
+
+    # One delivery run at a time, so overlapping runs cannot multiply the rate
+    queue_emails([{"to": "later@example.com", "subject": "Later", "body": "x"}])
+    assert acquire_run_lock(timeout=60)
+    assert deliver_queued_emails(rate_limit=0) == {"success": True, "skipped": True}
+    release_run_lock()
+    assert deliver_queued_emails(rate_limit=0)["sent"] == 1
+
+    # Sending is paced to the rate limit across batches
+    queue_emails({"to": f"paced{i}@example.com", "subject": "Paced", "body": "x"} for i in range(20))
+    started = time.monotonic()
+    assert deliver_queued(batch_size=10, rate_limit=100)["sent"] == 20
+    assert time.monotonic() - started >= 0.19